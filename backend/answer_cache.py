@@ -0,0 +1,207 @@
+"""
+Semantic cache of generated answers.
+
+Questions are embedded and compared to the questions already answered; a close
+enough neighbour naming the same companies and report years returns the stored
+generation without running the graph. Entries are dropped when the files they
+cite change in the vectorstore.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Iterable, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from backend.vectorstore import get_vectorstore
+
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.95)
+)
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 512))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))  # In seconds
+
+
+@dataclass
+class CachedAnswer:
+    """An answer and what it was generated from."""
+
+    question: str
+    embedding: np.ndarray  # Normalized question embedding
+    answer: str  # The model answer, without the restated question
+    sources: List[str]  # Source IDs of the documents it cites
+    filenames: frozenset[str]  # Files of the documents the generation cites
+    created_at: float
+
+
+class SemanticAnswerCache:
+    """
+    An in-memory LRU cache of answers, looked up by question similarity and
+    expiring after a time to live.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl: float = ANSWER_CACHE_TTL,
+        query_filter: Callable[[str], dict | None] | None = None,
+    ):
+        """
+        Initialize the answer cache.
+
+        Args:
+            embedding_function (Embeddings): Model embedding the questions.
+            similarity_threshold (float): Minimum cosine similarity for a hit.
+            max_entries (int): Number of answers kept, least recently used first out.
+            ttl (float): Seconds after which an answer expires.
+            query_filter (Callable[[str], dict | None] | None): Metadata filter
+                of a question, e.g. `MultiModalVectorstore.get_query_filter`. A
+                similar question is only a hit when both filters are equal, so
+                that questions on another company or year are not confused.
+        """
+        self._embedding_function = embedding_function
+        self._similarity_threshold = similarity_threshold
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._query_filter = query_filter
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, CachedAnswer] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, question: str) -> CachedAnswer | None:
+        """Return the answer of the most similar cached question, if close enough.
+
+        Args:
+            question (str): The user question.
+
+        Returns:
+            CachedAnswer | None: The cached answer, None on a miss.
+        """
+        embedding = self._embed(question)
+        with self._lock:
+            self._drop_expired()
+            best_question, best_similarity = None, -1.0
+            for cached_question, entry in self._entries.items():
+                similarity = float(np.dot(embedding, entry.embedding))
+                if similarity > best_similarity:
+                    best_question, best_similarity = cached_question, similarity
+
+            if (
+                best_question is None
+                or best_similarity < self._similarity_threshold
+                or not self._same_filter(question, best_question)
+            ):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(best_question)
+            print(f"---ANSWER CACHE HIT: {best_similarity:.3f} '{best_question}'---")
+            return self._entries[best_question]
+
+    def store(
+        self,
+        question: str,
+        answer: str,
+        sources: List[str],
+        documents: List[Document],
+    ) -> None:
+        """Cache the answer to a question.
+
+        Only the model answer and its sources are kept: the question restated
+        before the answer is the one of each user, not of the cached question.
+        Answers relying on no documents, or on documents that are not stored
+        files (e.g. web search results), are not cached, since they cannot be
+        invalidated when files are ingested.
+
+        Args:
+            question (str): The user question.
+            answer (str): The model answer.
+            sources (List[str]): Source IDs of the documents it cites.
+            documents (List[Document]): The documents the answer was generated from.
+        """
+        filenames = [document.metadata.get("filename") for document in documents]
+        if len(filenames) == 0 or None in filenames:
+            return
+
+        entry = CachedAnswer(
+            question=question,
+            embedding=self._embed(question),
+            answer=answer,
+            sources=sources,
+            filenames=frozenset(filenames),
+            created_at=time.time(),
+        )
+        with self._lock:
+            self._entries[question] = entry
+            self._entries.move_to_end(question)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_files(self, filenames: Iterable[str]) -> None:
+        """Drop the answers citing any of the given files.
+
+        Args:
+            filenames (Iterable[str]): Files deleted or re-ingested.
+        """
+        filenames = set(filenames)
+        with self._lock:
+            for question in [
+                question
+                for question, entry in self._entries.items()
+                if entry.filenames & filenames
+            ]:
+                del self._entries[question]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _same_filter(self, question: str, cached_question: str) -> bool:
+        if self._query_filter is None:
+            return True
+        return self._query_filter(question) == self._query_filter(cached_question)
+
+    def _embed(self, question: str) -> np.ndarray:
+        embedding = np.asarray(self._embedding_function.embed_query(question))
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def _drop_expired(self) -> None:
+        expiration = time.time() - self._ttl
+        for question in [
+            question
+            for question, entry in self._entries.items()
+            if entry.created_at < expiration
+        ]:
+            del self._entries[question]
+
+
+_shared_answer_cache: SemanticAnswerCache | None = None
+_shared_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> SemanticAnswerCache:
+    """Return the process-wide answer cache, kept in sync with the shared vectorstore.
+
+    Returns:
+        SemanticAnswerCache: The shared answer cache.
+    """
+    global _shared_answer_cache
+    if _shared_answer_cache is None:
+        with _shared_answer_cache_lock:
+            if _shared_answer_cache is None:
+                db = get_vectorstore()
+                answer_cache = SemanticAnswerCache(
+                    db.embedding_function, query_filter=db.get_query_filter
+                )
+                db.add_change_listener(answer_cache.invalidate_files)
+                _shared_answer_cache = answer_cache
+    return _shared_answer_cache
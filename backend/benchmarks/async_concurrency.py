@@ -0,0 +1,84 @@
+"""
+Measure how the throughput of the async chat graph scales with the number of
+simultaneous questions served by a single event loop.
+
+Usage:
+    python -m backend.benchmarks.async_concurrency "Quel est le chiffre d'affaires de TotalEnergies en 2023 ?" --concurrency 1 2 4 8
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List
+
+from backend.rag_graph.graph import async_graph
+
+
+async def answer(question: str) -> float:
+    """Run one question through the async graph.
+
+    Args:
+        question (str): The user question.
+
+    Returns:
+        float: Time to the full answer, in seconds.
+    """
+    start = time.perf_counter()
+    await async_graph.ainvoke({"question": question, "max_retries": 3})
+    return time.perf_counter() - start
+
+
+async def run(questions: List[str], concurrency: int) -> tuple[float, List[float]]:
+    """Answer the questions, `concurrency` of them at a time.
+
+    Args:
+        questions (List[str]): The questions to answer.
+        concurrency (int): Maximum number of questions in flight.
+
+    Returns:
+        tuple[float, List[float]]: Wall time in seconds and latency of each question.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer_when_allowed(question: str) -> float:
+        async with semaphore:
+            return await answer(question)
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(
+        *(answer_when_allowed(question) for question in questions)
+    )
+    return time.perf_counter() - start, list(latencies)
+
+
+def report(concurrency: int, wall_time: float, latencies: List[float]) -> None:
+    print(
+        f"concurrency={concurrency:<3} "
+        f"throughput={len(latencies) / wall_time:6.2f} questions/s  "
+        f"latency p50={statistics.median(latencies):7.3f}s  max={max(latencies):7.3f}s"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    for concurrency in args.concurrency:
+        questions = [
+            question
+            for _ in range(args.repeat * concurrency)
+            for question in args.questions
+        ]
+        wall_time, latencies = await run(questions, concurrency)
+        report(concurrency, wall_time, latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("questions", nargs="+")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Questions per concurrency slot, so each level keeps every slot busy",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,145 @@
+"""
+Local stand-ins for the OpenAI chat and embedding models and for the web
+search, for the benchmarks that run without network access.
+"""
+
+import asyncio
+import re
+import time
+import zlib
+from typing import AsyncIterator, Callable, Iterator, List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from backend.vectorstore import EMBEDDING_DIMENSION
+
+# Response of a chat model role, from the messages it receives
+Responder = Callable[[List[BaseMessage]], str]
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering a deterministic response after a fixed latency."""
+
+    respond: Responder
+    latency: float = 0.0  # Seconds before the first token
+    token_latency: float = 0.0  # Seconds between two streamed tokens
+
+    @property
+    def _llm_type(self) -> str:
+        return "offline-fake"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        return re.findall(r"\S+\s*", self.respond(messages))
+
+    def _usage(self, messages: List[BaseMessage], tokens: List[str]) -> dict:
+        input_tokens = sum(len(str(message.content).split()) for message in messages)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": len(tokens),
+            "total_tokens": input_tokens + len(tokens),
+        }
+
+    def _result(self, messages: List[BaseMessage], tokens: List[str]) -> ChatResult:
+        message = AIMessage(
+            content="".join(tokens), usage_metadata=self._usage(messages, tokens)
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.latency + self.token_latency * len(tokens))
+        return self._result(messages, tokens)
+
+    async def _agenerate(
+        self, messages, stop=None, run_manager=None, **kwargs
+    ) -> ChatResult:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency + self.token_latency * len(tokens))
+        return self._result(messages, tokens)
+
+    def _stream(
+        self, messages, stop=None, run_manager=None, **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        time.sleep(self.latency)
+        for token in tokens:
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(
+            message=AIMessageChunk(
+                content="", usage_metadata=self._usage(messages, tokens)
+            )
+        )
+
+    async def _astream(
+        self, messages, stop=None, run_manager=None, **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        tokens = self._tokens(messages)
+        await asyncio.sleep(self.latency)
+        for token in tokens:
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+        yield ChatGenerationChunk(
+            message=AIMessageChunk(
+                content="", usage_metadata=self._usage(messages, tokens)
+            )
+        )
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words embeddings, returned after a fixed latency per call."""
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION, latency: float = 0.0):
+        """
+        Args:
+            dimension (int): Size of the vectors.
+            latency (float): Seconds taken by each call.
+        """
+        self._dimension = dimension
+        self._latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self._dimension
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode()) % self._dimension] += 1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self._latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self._latency)
+        return self._embed(text)
+
+
+class FakeWebSearch:
+    """Web search tool, in place of `TavilySearchResults`, returning k results
+    quoting the query after a fixed latency."""
+
+    def __init__(self, k: int = 3, latency: float = 0.0):
+        """
+        Args:
+            k (int): Number of results.
+            latency (float): Seconds taken by each search.
+        """
+        self._k = k
+        self._latency = latency
+
+    def _results(self, query: str) -> List[dict[str, str]]:
+        return [
+            {"url": f"https://example.com/{i}", "content": f"Résultat {i} : {query}"}
+            for i in range(self._k)
+        ]
+
+    def invoke(self, inputs: dict[str, str]) -> List[dict[str, str]]:
+        time.sleep(self._latency)
+        return self._results(inputs["query"])
+
+    async def ainvoke(self, inputs: dict[str, str]) -> List[dict[str, str]]:
+        await asyncio.sleep(self._latency)
+        return self._results(inputs["query"])
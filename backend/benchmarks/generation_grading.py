@@ -0,0 +1,147 @@
+"""
+Compare the latency and token cost of the sequential and combined grading of a
+generation against its documents and its question.
+
+The documents and the generation are produced once per question, then graded
+`--repeat` times in each mode. Keep LLM_RESPONSE_CACHE off to measure the calls.
+
+Usage:
+    python -m backend.benchmarks.generation_grading "Quel est le chiffre d'affaires de TotalEnergies en 2023 ?" --repeat 3
+"""
+
+import argparse
+import json
+import statistics
+import time
+from typing import List
+
+from langchain_core.documents import Document
+
+from backend.chat_models.llms import (
+    LLM,
+    hallucination_grader,
+    answer_grader,
+    generation_grader,
+    explained_generation_grader,
+)
+from backend.rag_graph.edges import (
+    get_combined_grading_inputs,
+    get_hallucination_grading_inputs,
+)
+from backend.rag_graph.graph import graph
+from backend.utils import count_tokens
+from backend.vectorstore import get_vectorstore
+
+
+class Measure:
+    """Latency and tokens of the grading calls of one mode."""
+
+    def __init__(self):
+        self.latencies = []
+        self.prompt_tokens = []
+        self.completion_tokens = []
+        self.nb_calls = []
+
+    def report(self, mode: str) -> None:
+        print(
+            f"{mode:<22} calls={statistics.mean(self.nb_calls):4.1f}  "
+            f"latency p50={statistics.median(self.latencies):6.3f}s "
+            f"max={max(self.latencies):6.3f}s  "
+            f"prompt tokens={statistics.mean(self.prompt_tokens):7.0f}  "
+            f"completion tokens={statistics.mean(self.completion_tokens):5.0f}"
+        )
+
+
+def call(llm: LLM, inputs: dict[str, str]) -> tuple[dict, int, int]:
+    """Invoke a grader and count the tokens of the exchange.
+
+    Args:
+        llm (LLM): The grader.
+        inputs (dict[str, str]): Values of the prompt inputs.
+
+    Returns:
+        tuple[dict, int, int]: The grade, the prompt and the completion tokens.
+    """
+    prompt_tokens = sum(
+        count_tokens(content, llm.model_name)
+        for _, content in llm._build_messages(inputs)
+    )
+    result = llm.invoke(inputs=inputs)
+    completion_tokens = count_tokens(
+        json.dumps(result, ensure_ascii=False), llm.model_name
+    )
+    return result, prompt_tokens, completion_tokens
+
+
+def grade_sequential(
+    question: str, documents: List[Document], generation: str
+) -> tuple[int, int, int]:
+    """Grade as the "sequential" mode of the graph does.
+
+    Returns:
+        tuple[int, int, int]: Number of calls, prompt and completion tokens.
+    """
+    result, prompt_tokens, completion_tokens = call(
+        hallucination_grader,
+        get_hallucination_grading_inputs(documents, generation),
+    )
+    if result["binary_score"] != "yes":
+        return 1, prompt_tokens, completion_tokens
+    _, answer_prompt_tokens, answer_completion_tokens = call(
+        answer_grader, {"question": question, "generation": generation}
+    )
+    return (
+        2,
+        prompt_tokens + answer_prompt_tokens,
+        completion_tokens + answer_completion_tokens,
+    )
+
+
+def grade_combined(
+    question: str, documents: List[Document], generation: str, explain: bool
+) -> tuple[int, int, int]:
+    """Grade as the "combined" mode of the graph does.
+
+    Returns:
+        tuple[int, int, int]: Number of calls, prompt and completion tokens.
+    """
+    grader = explained_generation_grader if explain else generation_grader
+    _, prompt_tokens, completion_tokens = call(
+        grader, get_combined_grading_inputs(question, documents, generation)
+    )
+    return 1, prompt_tokens, completion_tokens
+
+
+def main(args: argparse.Namespace) -> None:
+    config = {"configurable": {"vectorstore": get_vectorstore()}}
+    modes = {
+        "sequential": lambda q, d, g: grade_sequential(q, d, g),
+        "combined": lambda q, d, g: grade_combined(q, d, g, explain=False),
+        "combined+explanation": lambda q, d, g: grade_combined(q, d, g, explain=True),
+    }
+    measures = {mode: Measure() for mode in modes}
+
+    for question in args.questions:
+        state = graph.invoke({"question": question, "max_retries": 3}, config)
+        for _ in range(args.repeat):
+            for mode, grade in modes.items():
+                start = time.perf_counter()
+                nb_calls, prompt_tokens, completion_tokens = grade(
+                    question, state["documents"], state["generation"]
+                )
+                measures[mode].latencies.append(time.perf_counter() - start)
+                measures[mode].nb_calls.append(nb_calls)
+                measures[mode].prompt_tokens.append(prompt_tokens)
+                measures[mode].completion_tokens.append(completion_tokens)
+
+    for mode, measure in measures.items():
+        measure.report(mode)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("questions", nargs="+")
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Gradings of each generation per mode"
+    )
+    main(parser.parse_args())
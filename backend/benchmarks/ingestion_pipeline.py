@@ -0,0 +1,64 @@
+"""
+Measure the ingestion throughput (pages/sec) of a PDF file.
+
+Each run ingests the file into a fresh temporary vectorstore, so every page is
+partitioned, summarized and embedded. Runs the sequential configuration (one
+worker per stage, one page per write) and the pipelined one.
+
+Usage:
+    python -m backend.benchmarks.ingestion_pipeline path/to/report.pdf
+"""
+
+import argparse
+import tempfile
+from pathlib import Path
+
+from backend.ingestion import (
+    PARTITION_WORKERS,
+    SUMMARY_WORKERS,
+    WRITE_BATCH_SIZE,
+    IngestionPipeline,
+)
+from backend.vectorstore import MultiModalVectorstore
+
+
+def run(
+    pdf_filepath: Path, partition_workers: int, summary_workers: int, batch_size: int
+) -> None:
+    with tempfile.TemporaryDirectory() as vectorstore_path:
+        db = MultiModalVectorstore(vectorstore_path=vectorstore_path)
+        pipeline = IngestionPipeline(
+            db,
+            partition_workers=partition_workers,
+            summary_workers=summary_workers,
+            write_batch_size=batch_size,
+        )
+        report = pipeline.ingest(pdf_filepath)
+        db.close()
+
+    print(
+        f"partition_workers={partition_workers:<3} summary_workers={summary_workers:<3} "
+        f"batch_size={batch_size:<3} -> {report.processed_pages} pages "
+        f"in {report.duration:.1f}s, {report.pages_per_second:.2f} pages/s, "
+        f"{len(report.failed_pages)} failed"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("pdf_filepath", type=Path)
+    parser.add_argument("--partition-workers", type=int, default=PARTITION_WORKERS)
+    parser.add_argument("--summary-workers", type=int, default=SUMMARY_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=WRITE_BATCH_SIZE)
+    parser.add_argument(
+        "--skip-sequential",
+        action="store_true",
+        help="Only run the pipelined configuration",
+    )
+    args = parser.parse_args()
+
+    if not args.skip_sequential:
+        run(args.pdf_filepath, 1, 1, 1)
+    run(
+        args.pdf_filepath, args.partition_workers, args.summary_workers, args.batch_size
+    )
@@ -0,0 +1,415 @@
+"""
+Measure the ingestion throughput of generated PDF reports, stage by stage.
+
+The reports mix text, table-heavy and mixed pages. Table summaries and
+embeddings come from local stand-ins with a configurable latency, so that the
+rest of the time is spent in pypdf, unstructured and Chroma. Each stage runs on
+its own over all the pages, as `add_new_pdf_page_to_vectorstore` chains them:
+page split, `partition_pdf`, table summarization, embedding and Chroma write.
+The whole `IngestionPipeline` then runs on a fresh vectorstore, as
+`upload_file` does.
+
+The results, with the peak RSS, are written as a JSON baseline; a later run
+compares itself to a baseline and exits with an error on a regression.
+
+Usage:
+    python -m backend.benchmarks.ingestion_stages --pages 60 --output ingestion_baseline.json
+    python -m backend.benchmarks.ingestion_stages --pages 60 --baseline ingestion_baseline.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import List
+
+# The OpenAI clients are built at import, but never called
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from langchain_core.embeddings import Embeddings
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from backend.benchmarks.fakes import FakeChatModel, FakeEmbeddings
+from backend.chat_models.llms import summarizer
+from backend.ingestion import WRITE_BATCH_SIZE, IngestionPipeline, split_pdf_pages
+from backend.vectorstore import MultiModalVectorstore, partition_pdf_page
+
+PAGE_KINDS = ["text", "table", "mixed"]
+STAGES = ["split", "partition", "summarization", "embedding", "write"]
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4, in points
+MARGIN = 50
+LINE_HEIGHT = 14
+WORDS = (
+    "groupe activite croissance exercice hausse baisse millions euros segment "
+    "strategie transition energie clients marche risque performance durable "
+    "capital filiales production couts volume prix rapport annuel resultat"
+).split()
+TABLE_HEADER = ["Indicateur", "2020", "2021", "2022", "2023", "Variation"]
+
+
+class TimedEmbeddings(Embeddings):
+    """Embeddings wrapper adding up the time spent embedding."""
+
+    def __init__(self, embeddings: Embeddings):
+        self._embeddings = embeddings
+        self.seconds = 0.0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        try:
+            return self._embeddings.embed_documents(texts)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def embed_query(self, text: str) -> List[float]:
+        start = time.perf_counter()
+        try:
+            return self._embeddings.embed_query(text)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _text_operations(generator: random.Random, top: float, nb_lines: int) -> str:
+    lines = []
+    for index in range(nb_lines):
+        text = " ".join(generator.choices(WORDS, k=12)).capitalize() + "."
+        y = top - index * LINE_HEIGHT
+        lines.append(f"BT /F1 10 Tf {MARGIN} {y} Td ({_escape(text)}) Tj ET")
+    return "\n".join(lines)
+
+
+def _table_operations(generator: random.Random, top: float, nb_rows: int) -> str:
+    column_width = (PAGE_WIDTH - 2 * MARGIN) / len(TABLE_HEADER)
+    operations = []
+    for row in range(nb_rows + 1):
+        y = top - (row + 1) * LINE_HEIGHT * 1.5
+        if row == 0:
+            cells = TABLE_HEADER
+        else:
+            values = [generator.randint(100, 99999) for _ in TABLE_HEADER[1:-1]]
+            variation = (values[-1] - values[-2]) / values[-2] * 100
+            cells = [
+                " ".join(generator.choices(WORDS, k=2)).capitalize(),
+                *(f"{value:,}".replace(",", " ") for value in values),
+                f"{variation:+.1f} %",
+            ]
+        for column, cell in enumerate(cells):
+            x = MARGIN + column * column_width
+            operations.append(
+                f"{x} {y} {column_width} {LINE_HEIGHT * 1.5} re S "
+                f"BT /F1 9 Tf {x + 3} {y + 6} Td ({_escape(cell)}) Tj ET"
+            )
+    return "\n".join(operations)
+
+
+def generate_pdf(page_kinds: List[str], seed: int) -> bytes:
+    """Generate a report whose pages are of the given kinds.
+
+    Args:
+        page_kinds (List[str]): Kind of each page: "text" (paragraphs), "table"
+            (two tables) or "mixed" (paragraphs and a table).
+        seed (int): Seed of the page contents.
+
+    Returns:
+        bytes: The PDF content.
+    """
+    generator = random.Random(seed)
+    font = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Helvetica"),
+        }
+    )
+    top = PAGE_HEIGHT - MARGIN
+    writer = PdfWriter()
+    for page_number, kind in enumerate(page_kinds):
+        title = f"BT /F1 14 Tf {MARGIN} {top} Td (Section {page_number + 1}) Tj ET"
+        if kind == "text":
+            body = _text_operations(generator, top - 30, 50)
+        elif kind == "table":
+            body = "\n".join(
+                [
+                    _table_operations(generator, top - 30, 12),
+                    _table_operations(generator, top - 400, 12),
+                ]
+            )
+        else:
+            body = "\n".join(
+                [
+                    _text_operations(generator, top - 30, 20),
+                    _table_operations(generator, top - 330, 12),
+                ]
+            )
+        page = writer.add_blank_page(PAGE_WIDTH, PAGE_HEIGHT)
+        page[NameObject("/Resources")] = DictionaryObject(
+            {NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})}
+        )
+        content = DecodedStreamObject()
+        content.set_data(f"{title}\n{body}".encode("latin-1"))
+        page.replace_contents(content)
+
+    pdf_content = BytesIO()
+    writer.write(pdf_content)
+    return pdf_content.getvalue()
+
+
+def get_peak_rss_mb() -> dict[str, float]:
+    """Peak resident memory of this process and of its finished children."""
+    # Kilobytes on Linux, bytes on macOS
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit,
+    }
+
+
+def run_stages(
+    pdf_content: bytes,
+    pdf_filename: str,
+    page_kinds: List[str],
+    embeddings: Embeddings,
+    batch_size: int,
+) -> dict:
+    """Run each ingestion stage over all the pages, one stage after the other.
+
+    Returns:
+        dict: By stage, its duration, pages per second and peak RSS once done;
+        the partition time of each page kind; the number of summarized tables.
+    """
+    timed_embeddings = TimedEmbeddings(embeddings)
+    durations = {}
+    peak_rss = {}
+
+    start = time.perf_counter()
+    pdf_reader = PdfReader(BytesIO(pdf_content))
+    pdf_pages = split_pdf_pages(pdf_reader, list(range(len(pdf_reader.pages))))
+    durations["split"] = time.perf_counter() - start
+    peak_rss["split"] = get_peak_rss_mb()["self"]
+
+    partition_durations = {kind: 0.0 for kind in PAGE_KINDS}
+    pages_elements = []
+    for pdf_page, kind in zip(pdf_pages, page_kinds):
+        start = time.perf_counter()
+        pages_elements.append(partition_pdf_page(pdf_page))
+        partition_durations[kind] += time.perf_counter() - start
+    durations["partition"] = sum(partition_durations.values())
+    peak_rss["partition"] = get_peak_rss_mb()["self"]
+
+    with tempfile.TemporaryDirectory() as vectorstore_path:
+        db = MultiModalVectorstore(timed_embeddings, vectorstore_path)
+
+        start = time.perf_counter()
+        pages_chunks = [
+            db.build_page_chunks(page_elements, pdf_filename, page_number)
+            for page_number, page_elements in enumerate(pages_elements)
+        ]
+        durations["summarization"] = time.perf_counter() - start
+        peak_rss["summarization"] = get_peak_rss_mb()["self"]
+
+        start = time.perf_counter()
+        for i in range(0, len(pages_chunks), batch_size):
+            db.add_pdf_pages_to_vectorstore(
+                [
+                    chunk
+                    for chunks in pages_chunks[i : i + batch_size]
+                    for chunk in chunks
+                ]
+            )
+        store_duration = time.perf_counter() - start
+        durations["embedding"] = timed_embeddings.seconds
+        durations["write"] = store_duration - timed_embeddings.seconds
+        peak_rss["embedding"] = peak_rss["write"] = get_peak_rss_mb()["self"]
+        db.close()
+
+    nb_pages = len(page_kinds)
+    return {
+        "stages": {
+            stage: {
+                "seconds": durations[stage],
+                "pages_per_second": (
+                    nb_pages / durations[stage] if durations[stage] > 0 else None
+                ),
+                "peak_rss_mb": peak_rss[stage],
+            }
+            for stage in STAGES
+        },
+        "partition_seconds_per_page": {
+            kind: partition_durations[kind] / page_kinds.count(kind)
+            for kind in PAGE_KINDS
+            if kind in page_kinds
+        },
+        "summarized_tables": sum(
+            element_type.startswith("Table")
+            for page_elements in pages_elements
+            for element_type, _ in page_elements
+        ),
+    }
+
+
+def run_pipeline(pdf_filepath: Path, embeddings: Embeddings, batch_size: int) -> dict:
+    """Ingest the file with the `IngestionPipeline`, as `upload_file` does."""
+    with tempfile.TemporaryDirectory() as vectorstore_path:
+        db = MultiModalVectorstore(embeddings, vectorstore_path)
+        report = IngestionPipeline(db, write_batch_size=batch_size).ingest(pdf_filepath)
+        db.close()
+    return {
+        "seconds": report.duration,
+        "pages_per_second": report.pages_per_second,
+        "failed_pages": len(report.failed_pages),
+    }
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result: dict) -> None:
+    print(f"{result['pages']} pages {result['page_kinds']}")
+    for stage, measure in result["stages"].items():
+        pages_per_second = measure["pages_per_second"]
+        print(
+            f"  {stage:<14} {measure['seconds']:8.3f}s  "
+            + (
+                f"{pages_per_second:9.2f} pages/s"
+                if pages_per_second
+                else f"{'-':>9} pages/s"
+            )
+            + f"  peak RSS {measure['peak_rss_mb']:8.1f} MB"
+        )
+    for kind, seconds in result["partition_seconds_per_page"].items():
+        print(f"  partition of a {kind} page: {seconds * 1000:8.1f} ms")
+    pipeline = result["pipeline"]
+    print(
+        f"  pipeline       {pipeline['seconds']:8.3f}s  "
+        f"{pipeline['pages_per_second']:9.2f} pages/s  "
+        f"{pipeline['failed_pages']} failed"
+    )
+    print(
+        f"  peak RSS: {result['peak_rss_mb']['self']:.1f} MB, "
+        f"{result['peak_rss_mb']['children']:.1f} MB in partition workers"
+    )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the change of each stage against a baseline.
+
+    Args:
+        result (dict): This run.
+        baseline (dict): A previous run, as written by `--output`.
+        tolerance (float): Relative slowdown accepted, e.g. 0.2 for 20%.
+
+    Returns:
+        bool: Whether no stage nor the pipeline got slower than accepted.
+    """
+    print(f"\nCompared to the baseline of commit {baseline.get('commit')}:")
+    measures = [
+        (stage, result["stages"][stage], baseline["stages"].get(stage))
+        for stage in STAGES
+    ] + [("pipeline", result["pipeline"], baseline.get("pipeline"))]
+    passed = True
+    for name, measure, baseline_measure in measures:
+        if not baseline_measure or not baseline_measure.get("pages_per_second"):
+            continue
+        if not measure.get("pages_per_second"):
+            continue
+        ratio = measure["pages_per_second"] / baseline_measure["pages_per_second"]
+        regression = ratio < 1 / (1 + tolerance)
+        passed = passed and not regression
+        print(
+            f"  {name:<14} {ratio:6.2f}x the baseline throughput"
+            + ("  REGRESSION" if regression else "")
+        )
+    return passed
+
+
+def main(args: argparse.Namespace) -> bool:
+    summarizer.cache = None
+    summarizer.scheduler = None
+    summarizer.chat_model = FakeChatModel(
+        respond=lambda messages: "Le tableau présente les indicateurs du groupe.",
+        latency=args.summary_latency,
+    )
+    embeddings = FakeEmbeddings(latency=args.embedding_latency)
+
+    page_kinds = [PAGE_KINDS[page % len(PAGE_KINDS)] for page in range(args.pages)]
+    pdf_content = generate_pdf(page_kinds, args.seed)
+
+    with (
+        tempfile.TemporaryDirectory() as documents_path,
+        open(os.devnull, "w") as devnull,
+        # The page contents printed while ingesting are not what is measured
+        contextlib.redirect_stdout(sys.stdout if args.verbose else devnull),
+    ):
+        pdf_filepath = Path(documents_path) / "Benchmark_URD_2023.pdf"
+        pdf_filepath.write_bytes(pdf_content)
+        result = run_stages(
+            pdf_content, pdf_filepath.name, page_kinds, embeddings, args.batch_size
+        )
+        result["pipeline"] = run_pipeline(pdf_filepath, embeddings, args.batch_size)
+
+    result = {
+        "commit": get_commit(),
+        "pages": args.pages,
+        "page_kinds": {kind: page_kinds.count(kind) for kind in PAGE_KINDS},
+        "summary_latency": args.summary_latency,
+        "embedding_latency": args.embedding_latency,
+        "batch_size": args.batch_size,
+        **result,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+    report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            return compare(result, json.load(f), args.tolerance)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument(
+        "--summary-latency", type=float, default=0.2, help="Seconds per table summary"
+    )
+    parser.add_argument(
+        "--embedding-latency", type=float, default=0.05, help="Seconds per call"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=WRITE_BATCH_SIZE, help="Pages per write"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare to the results of a previous run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown accepted before reporting a regression",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Keep page prints")
+    sys.exit(0 if main(parser.parse_args()) else 1)
@@ -0,0 +1,384 @@
+"""
+Load-test the chat graph offline, with local stand-ins for the OpenAI chat and
+embedding models.
+
+Every chat model role answers a deterministic response after a configurable
+latency, the web search returns fixed results, and the vectorstore is a
+temporary Chroma collection seeded with synthetic pages embedded locally. The
+compiled graph is then driven with concurrent synthetic questions and the wall
+time of each node is reported, so that regressions of the orchestration layer
+show up without network access. With `--route websearch`, the router sends
+every question to the web search, to exercise that branch of the full graph.
+
+Tokens are counted with tiktoken if its BPE file is in `TIKTOKEN_CACHE_DIR`
+(or was downloaded before), else approximated (see `backend.utils`).
+
+Usage:
+    python -m backend.benchmarks.offline_load --pages 500 --questions 200 --concurrency 8 --llm-latency 0.05
+    python -m backend.benchmarks.offline_load --graph full --asynchronous --output load.json
+    python -m backend.benchmarks.offline_load --graph full --route websearch --speculative-routing --speculative-web-search
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+# The OpenAI clients are built at import, but never called
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from langchain_core.messages import BaseMessage
+
+from backend.benchmarks.fakes import (
+    FakeChatModel,
+    FakeEmbeddings,
+    FakeWebSearch,
+    Responder,
+)
+from backend.chat_models import llms
+from backend.metrics import metrics
+from backend.rag_graph import nodes
+from backend.rag_graph.graph import build_workflow, build_simple_workflow
+from backend.vectorstore import MultiModalVectorstore
+
+COMPANIES = [
+    "TotalEnergies",
+    "Kering",
+    "Danone",
+    "Orange",
+    "Engie",
+    "Carrefour",
+    "Renault",
+    "Sanofi",
+]
+YEARS = [2020, 2021, 2022, 2023]
+TOPICS = [
+    "chiffre d'affaires",
+    "résultat net",
+    "émissions de CO2",
+    "effectifs",
+    "dividende",
+    "dette nette",
+    "investissements",
+    "marge opérationnelle",
+]
+QUESTION_TEMPLATES = [
+    "Quel est le {topic} de {company} en {year} ?",
+    "Comment a évolué le {topic} de {company} en {year} ?",
+    "Quels sont les objectifs de {company} concernant le {topic} ?",
+]
+WORDS = (
+    "groupe activité croissance exercice hausse baisse millions euros segment "
+    "stratégie transition énergie clients marché risque performance durable "
+    "capital filiales production coûts volume prix rapport annuel"
+).split()
+
+
+def _count_documents(messages: List[BaseMessage]) -> int:
+    return len(re.findall(r"^Document \d+ :", str(messages[-1].content), re.M))
+
+
+def _words(nb_words: int) -> str:
+    return " ".join(WORDS[i % len(WORDS)] for i in range(nb_words))
+
+
+def get_responders(
+    answer_words: int, route: str = "vectorstore"
+) -> dict[str, Responder]:
+    """Response of each chat model role.
+
+    Args:
+        answer_words (int): Number of words of the generated answers.
+        route (str): Datasource the router picks, "vectorstore" or "websearch".
+
+    Returns:
+        dict[str, Responder]: By role name, the function building its response.
+    """
+    graded = {"binary_score": "yes", "explanation": "Les faits le confirment."}
+    return {
+        "router": lambda messages: json.dumps({"relevant": route}),
+        "retrieval_grader": lambda messages: json.dumps(graded),
+        "batch_retrieval_grader": lambda messages: json.dumps(
+            {"binary_scores": ["yes"] * _count_documents(messages)}
+        ),
+        "hallucination_grader": lambda messages: json.dumps(graded),
+        "answer_grader": lambda messages: json.dumps(graded),
+        "generation_grader": lambda messages: json.dumps(
+            {"grounded": "yes", "answers_question": "yes"}
+        ),
+        "generation_grader_with_explanation": lambda messages: json.dumps(
+            {
+                "grounded": "yes",
+                "answers_question": "yes",
+                "explanation": "Les faits le confirment.",
+            }
+        ),
+        "question_rewriter": lambda messages: _words(20),
+        "retrieval_augmented_generator": lambda messages: _words(answer_words),
+        "multi_modal_summarizer": lambda messages: _words(answer_words),
+    }
+
+
+def install_fake_chat_models(
+    latency: float, token_latency: float, answer_words: int, route: str = "vectorstore"
+) -> None:
+    """Replace the chat model of every role, and disable the response cache and
+    the rate limiter."""
+    responders = get_responders(answer_words, route)
+    for llm in vars(llms).values():
+        if isinstance(llm, llms.LLM):
+            llm.cache = None
+            llm.scheduler = None
+            llm.chat_model = FakeChatModel(
+                respond=responders.get(llm.name, lambda messages: _words(20)),
+                latency=latency,
+                token_latency=token_latency,
+            )
+
+
+def install_fake_web_search(latency: float) -> None:
+    """Replace the web search tool of the graph nodes."""
+    nodes.TavilySearchResults = lambda k: FakeWebSearch(k=k, latency=latency)
+
+
+def seed_vectorstore(
+    db: MultiModalVectorstore, nb_pages: int, page_words: int, seed: int
+) -> None:
+    """Store synthetic report pages, spread over the companies and years.
+
+    Args:
+        db (MultiModalVectorstore): The vectorstore to fill.
+        nb_pages (int): Number of pages.
+        page_words (int): Number of words of each page.
+        seed (int): Seed of the page contents.
+    """
+    generator = random.Random(seed)
+    reports = [(company, year) for company in COMPANIES for year in YEARS]
+    batch = []
+    for page in range(nb_pages):
+        company, year = reports[page % len(reports)]
+        topic = generator.choice(TOPICS)
+        text = (
+            f"{company} {year} : {topic}. "
+            + " ".join(generator.choices(WORDS, k=page_words))
+            + f" Le {topic} de {company} atteint {generator.randint(1, 999)} "
+            f"millions d'euros en {year}."
+        )
+        batch.extend(
+            db.build_page_chunks(
+                [("CompositeElement", text)],
+                f"{company}_URD_{year}.pdf",
+                page // len(reports),
+            )
+        )
+        if len(batch) >= 200:
+            db.add_pdf_pages_to_vectorstore(batch)
+            batch = []
+    if len(batch) > 0:
+        db.add_pdf_pages_to_vectorstore(batch)
+
+
+def get_questions(nb_questions: int, seed: int) -> List[str]:
+    generator = random.Random(seed)
+    return [
+        generator.choice(QUESTION_TEMPLATES).format(
+            topic=generator.choice(TOPICS),
+            company=generator.choice(COMPANIES),
+            year=generator.choice(YEARS),
+        )
+        for _ in range(nb_questions)
+    ]
+
+
+def run_threads(
+    graph, questions: List[str], config: dict, concurrency: int
+) -> tuple[float, List[float]]:
+    """Answer the questions with the sync graph, `concurrency` threads at a time.
+
+    Returns:
+        tuple[float, List[float]]: Wall time and latency of each question, in seconds.
+    """
+
+    def answer(question: str) -> float:
+        start = time.perf_counter()
+        graph.invoke({"question": question, "max_retries": 3}, config)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(answer, questions))
+    return time.perf_counter() - start, latencies
+
+
+async def run_tasks(
+    graph, questions: List[str], config: dict, concurrency: int
+) -> tuple[float, List[float]]:
+    """Answer the questions with the async graph, `concurrency` at a time.
+
+    Returns:
+        tuple[float, List[float]]: Wall time and latency of each question, in seconds.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(question: str) -> float:
+        async with semaphore:
+            start = time.perf_counter()
+            await graph.ainvoke({"question": question, "max_retries": 3}, config)
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(answer(question) for question in questions))
+    return time.perf_counter() - start, list(latencies)
+
+
+def percentiles(values: List[float]) -> dict[str, float]:
+    if len(values) < 2:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def report(summary: dict) -> None:
+    latency = summary["latency"]
+    print(
+        f"questions={summary['questions']}  concurrency={summary['concurrency']}  "
+        f"throughput={summary['throughput']:.2f} questions/s\n"
+        f"end to end   p50={latency['p50'] * 1000:9.1f} ms  "
+        f"p95={latency['p95'] * 1000:9.1f} ms  p99={latency['p99'] * 1000:9.1f} ms"
+    )
+    for name, label in (
+        ("node_duration_seconds", "node"),
+        ("llm_duration_seconds", "role"),
+        ("retrieval_stage_duration_seconds", "stage"),
+    ):
+        print(f"\n{name}")
+        for series in summary["metrics"].get(name, []):
+            print(
+                f"  {series['labels'][label]:<36} count={series['count']:<6} "
+                f"p50={series['p50'] * 1000:9.1f} ms  "
+                f"p95={series['p95'] * 1000:9.1f} ms  "
+                f"p99={series['p99'] * 1000:9.1f} ms"
+            )
+
+
+def main(args: argparse.Namespace) -> dict:
+    install_fake_chat_models(
+        args.llm_latency, args.token_latency, args.answer_words, args.route
+    )
+    install_fake_web_search(args.web_search_latency)
+    if args.graph == "full":
+        graph = build_workflow(
+            asynchronous=args.asynchronous,
+            speculative_routing=args.speculative_routing,
+        ).compile()
+    else:
+        graph = build_simple_workflow(asynchronous=args.asynchronous).compile()
+    questions = get_questions(args.questions, args.seed)
+
+    with (
+        tempfile.TemporaryDirectory() as vectorstore_path,
+        open(os.devnull, "w") as devnull,
+        # The node progress prints are not what is measured
+        contextlib.redirect_stdout(sys.stdout if args.verbose else devnull),
+    ):
+        db = MultiModalVectorstore(
+            FakeEmbeddings(latency=args.embedding_latency), vectorstore_path
+        )
+        seed_vectorstore(db, args.pages, args.page_words, args.seed)
+        config = {
+            "configurable": {
+                "vectorstore": db,
+                "speculative_web_search": args.speculative_web_search,
+            }
+        }
+
+        def run(questions: List[str]) -> tuple[float, List[float]]:
+            if args.asynchronous:
+                return asyncio.run(
+                    run_tasks(graph, questions, config, args.concurrency)
+                )
+            return run_threads(graph, questions, config, args.concurrency)
+
+        run(questions[: args.warmup])
+        metrics.enabled = True
+        metrics.keep_samples = True
+        metrics.reset()
+        wall_time, latencies = run(questions)
+        db.close()
+
+    summary = {
+        "graph": args.graph,
+        "asynchronous": args.asynchronous,
+        "route": args.route,
+        "pages": args.pages,
+        "questions": len(questions),
+        "concurrency": args.concurrency,
+        "llm_latency": args.llm_latency,
+        "embedding_latency": args.embedding_latency,
+        "wall_time": wall_time,
+        "throughput": len(latencies) / wall_time,
+        "latency": percentiles(latencies),
+        "metrics": metrics.to_json(),
+    }
+    report(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--graph", choices=["simple", "full"], default="simple")
+    parser.add_argument(
+        "--asynchronous",
+        action="store_true",
+        help="Drive the async graph from one event loop instead of threads",
+    )
+    parser.add_argument(
+        "--route",
+        choices=["vectorstore", "websearch"],
+        default="vectorstore",
+        help="Datasource the router picks for every question (full graph)",
+    )
+    parser.add_argument(
+        "--speculative-routing",
+        action="store_true",
+        help="Route and retrieve in the same entry node (full graph)",
+    )
+    parser.add_argument(
+        "--speculative-web-search",
+        action="store_true",
+        help="Also search the web along with the routing call",
+    )
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--page-words", type=int, default=300)
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.05, help="Seconds per chat model call"
+    )
+    parser.add_argument(
+        "--token-latency", type=float, default=0.0, help="Seconds per generated token"
+    )
+    parser.add_argument(
+        "--embedding-latency", type=float, default=0.01, help="Seconds per call"
+    )
+    parser.add_argument(
+        "--web-search-latency", type=float, default=0.2, help="Seconds per search"
+    )
+    parser.add_argument("--answer-words", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the summary to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Keep node prints")
+    main(parser.parse_args())
@@ -0,0 +1,156 @@
+"""
+Check that the server keeps answering while its vectorstore is reloaded.
+
+The server app runs in-process on a temporary vectorstore embedded locally,
+with the offline chat models of `offline_load`. Concurrent /invoke and /stream
+requests are sent while another handle, standing for the ingestion page, keeps
+writing pages to the same collection, so that the worker reloads its
+vectorstore every `--reload-interval` seconds under load. Every failed request
+(non-200 status, or "error" event of a stream) is reported.
+
+Usage:
+    python -m backend.benchmarks.server_reload --requests 400 --concurrency 8
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# The OpenAI clients are built at import, but never called
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from starlette.testclient import TestClient
+
+import backend.server as server
+from backend.benchmarks.fakes import FakeEmbeddings
+from backend.benchmarks.offline_load import (
+    get_questions,
+    install_fake_chat_models,
+    seed_vectorstore,
+)
+from backend.vectorstore import MultiModalVectorstore, set_vectorstore
+
+
+def write_pages(
+    db: MultiModalVectorstore, interval: float, stop: threading.Event
+) -> int:
+    """Store a new page every `interval` seconds until stopped.
+
+    Returns:
+        int: The number of pages written.
+    """
+    generator = random.Random(0)
+    nb_pages = 0
+    while not stop.wait(interval):
+        db.add_pdf_pages_to_vectorstore(
+            db.build_page_chunks(
+                [
+                    (
+                        "CompositeElement",
+                        f"Kering chiffre d'affaires {generator.random()}",
+                    )
+                ],
+                "Kering_URD_2024.pdf",
+                nb_pages,
+            )
+        )
+        nb_pages += 1
+    return nb_pages
+
+
+def send(client: TestClient, question: str, streamed: bool) -> str:
+    """Ask a question, return "ok" or the reason of the failure."""
+    payload = {"question": question, "max_retries": 1}
+    if not streamed:
+        response = client.post("/invoke", json=payload)
+        return (
+            "ok" if response.status_code == 200 else f"/invoke {response.status_code}"
+        )
+    with client.stream("POST", "/stream", json=payload) as response:
+        if response.status_code != 200:
+            return f"/stream {response.status_code}"
+        for line in response.iter_lines():
+            if line == "event: error":
+                return "/stream error event"
+    return "ok"
+
+
+def main(args: argparse.Namespace) -> Counter:
+    install_fake_chat_models(args.llm_latency, 0.0, 20)
+    server.SERVER_RELOAD_INTERVAL = args.reload_interval
+    server.SERVER_ANSWER_CACHE = False
+    questions = get_questions(args.requests, seed=0)
+
+    with (
+        tempfile.TemporaryDirectory() as vectorstore_path,
+        open(os.devnull, "w") as devnull,
+        # The node progress prints are not what is checked
+        contextlib.redirect_stdout(sys.stdout if args.verbose else devnull),
+    ):
+        db = MultiModalVectorstore(FakeEmbeddings(), vectorstore_path)
+        seed_vectorstore(db, args.pages, 100, seed=0)
+        set_vectorstore(db)
+        nb_reloads = 0
+
+        def count_reload(filenames) -> None:
+            nonlocal nb_reloads
+            nb_reloads += 1
+
+        # The worker's handle only notifies the changes it reloads
+        db.add_change_listener(count_reload)
+        writer = MultiModalVectorstore(FakeEmbeddings(), vectorstore_path)
+        stop = threading.Event()
+
+        start = time.perf_counter()
+        with (
+            TestClient(server.app, raise_server_exceptions=False) as client,
+            ThreadPoolExecutor(max_workers=1) as writer_executor,
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor,
+        ):
+            written = writer_executor.submit(
+                write_pages, writer, args.write_interval, stop
+            )
+            outcomes = Counter(
+                executor.map(
+                    lambda index: send(client, questions[index], index % 2 == 1),
+                    range(len(questions)),
+                )
+            )
+            stop.set()
+            nb_written = written.result()
+        duration = time.perf_counter() - start
+        writer.close()
+
+    print(
+        f"{len(questions)} requests in {duration:.1f}s, {nb_written} pages written, "
+        f"{nb_reloads} reloads"
+    )
+    for outcome, count in outcomes.most_common():
+        print(f"  {outcome:<24} {count}")
+    return outcomes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument(
+        "--reload-interval", type=float, default=0.05, help="Seconds between checks"
+    )
+    parser.add_argument(
+        "--write-interval", type=float, default=0.1, help="Seconds between pages"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.01, help="Seconds per chat model call"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Keep node prints")
+    outcomes = main(parser.parse_args())
+    sys.exit(0 if set(outcomes) <= {"ok"} else 1)
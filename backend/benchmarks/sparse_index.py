@@ -0,0 +1,57 @@
+"""
+Measure the BM25 search latency on a synthetic corpus.
+
+Pages are drawn from a Zipf-distributed vocabulary so that, as in real reports,
+a few terms appear in most pages.
+
+Usage:
+    python -m backend.benchmarks.sparse_index --nb-pages 100000
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from backend.sparse_index import BM25Index
+
+VOCABULARY_SIZE = 50_000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nb-pages", type=int, default=100_000)
+    parser.add_argument("--page-length", type=int, default=300)
+    parser.add_argument("--nb-queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    term_probabilities = 1 / np.arange(1, VOCABULARY_SIZE + 1)
+    term_probabilities /= term_probabilities.sum()
+
+    def random_text(length: int) -> str:
+        terms = rng.choice(VOCABULARY_SIZE, size=length, p=term_probabilities)
+        return " ".join(f"t{term}" for term in terms)
+
+    start = time.perf_counter()
+    index = BM25Index()
+    index.add_documents(
+        (f"page::{i:06}", random_text(args.page_length)) for i in range(args.nb_pages)
+    )
+    print(f"Indexed {len(index)} pages in {time.perf_counter() - start:.1f}s")
+
+    queries = [random_text(8) for _ in range(args.nb_queries)]
+    durations = []
+    for query in queries:
+        query_start = time.perf_counter()
+        index.search(query, args.k)
+        durations.append((time.perf_counter() - query_start) * 1000)
+
+    durations.sort()
+    print(
+        f"Search latency: mean={statistics.mean(durations):.3f} ms  "
+        f"p50={durations[len(durations) // 2]:.3f} ms  "
+        f"p99={durations[int(len(durations) * 0.99)]:.3f} ms"
+    )
@@ -0,0 +1,55 @@
+"""
+Measure the time to first token of the chat graph against the time to the
+full answer.
+
+Usage:
+    python -m backend.benchmarks.time_to_first_token "Quel est le chiffre d'affaires de TotalEnergies en 2023 ?"
+"""
+
+import argparse
+import statistics
+import time
+from typing import List
+
+from backend.rag_graph.graph import graph
+from backend.rag_graph.streaming import is_model_token
+
+
+def measure(question: str) -> tuple[float, float]:
+    """Stream one question through the graph.
+
+    Args:
+        question (str): The user question.
+
+    Returns:
+        tuple[float, float]: Time to the first token generated by the model and
+        to the full answer, in seconds.
+    """
+    start = time.perf_counter()
+    time_to_first_token = None
+    for mode, chunk in graph.stream(
+        {"question": question, "max_retries": 3}, stream_mode=["custom", "values"]
+    ):
+        if mode == "custom" and time_to_first_token is None and is_model_token(chunk):
+            time_to_first_token = time.perf_counter() - start
+    return time_to_first_token, time.perf_counter() - start
+
+
+def report(name: str, durations: List[float]) -> None:
+    print(
+        f"{name:<20} mean={statistics.mean(durations):7.3f}s  "
+        f"p50={statistics.median(durations):7.3f}s  max={max(durations):7.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("questions", nargs="+")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    measures = [
+        measure(question) for _ in range(args.repeat) for question in args.questions
+    ]
+    report("time to first token", [ttft for ttft, _ in measures])
+    report("time to full answer", [total for _, total in measures])
@@ -0,0 +1,68 @@
+"""
+Measure the per-query setup cost removed by the shared vectorstore handle.
+
+Compares opening a new `MultiModalVectorstore` for every question (the former
+behaviour of the `retrieve` node) against reusing the process-wide handle.
+No embedding request is sent: only the setup is timed.
+
+Usage:
+    python -m backend.benchmarks.vectorstore_setup --iterations 50
+"""
+
+import argparse
+import os
+import statistics
+import time
+from typing import Callable, List
+
+# The OpenAI clients are only built, never called
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from backend.vectorstore import (
+    MultiModalVectorstore,
+    close_vectorstore,
+    get_vectorstore,
+)
+
+
+def time_calls(fn: Callable[[], object], iterations: int) -> List[float]:
+    """Time `iterations` calls of `fn`.
+
+    Args:
+        fn (Callable[[], object]): The function to time.
+        iterations (int): Number of calls.
+
+    Returns:
+        List[float]: Duration of each call in milliseconds.
+    """
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def report(name: str, durations: List[float]) -> None:
+    print(
+        f"{name:<28} mean={statistics.mean(durations):8.3f} ms  "
+        f"p50={statistics.median(durations):8.3f} ms  max={max(durations):8.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    per_call = time_calls(lambda: MultiModalVectorstore().close(), args.iterations)
+    get_vectorstore()  # Opened once per process
+    shared = time_calls(get_vectorstore, args.iterations)
+    close_vectorstore()
+
+    report("new vectorstore per query", per_call)
+    report("shared vectorstore", shared)
+    print(
+        f"Setup cost removed per query: "
+        f"{statistics.mean(per_call) - statistics.mean(shared):.3f} ms"
+    )
@@ -1,15 +1,35 @@
+import asyncio
 import json
-from typing import List
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, TypeVar
 
 import yaml
 from dotenv import load_dotenv
 from langchain_ollama import ChatOllama
 from langchain_openai import ChatOpenAI
 
+from backend.chat_models.response_cache import ResponseCache
+from backend.metrics import metrics
+from backend.rate_limiter import Priority, RateLimiter, llm_scheduler
+from backend.utils import count_tokens
 
 # Load env variables
 load_dotenv()
 
+T = TypeVar("T")
+
+CHAT_MODEL_NAME = "gpt-3.5-turbo"
+# Retries of a call by the scheduler, on 429 and transient errors
+LLM_MAX_RETRIES = 5
+# Tokens reserved for the answer when estimating the cost of a call
+EXPECTED_COMPLETION_TOKENS = 300
+
+# Opt-in disk cache of the responses, shared by every role
+response_cache = (
+    ResponseCache() if os.getenv("LLM_RESPONSE_CACHE", "false") == "true" else None
+)
+
 
 class LLM:
     def __init__(
@@ -19,55 +39,355 @@ class LLM:
         instructions: str | None,
         format_json: bool,
         language: str = "fra",
+        name: str = "llm",
+        cache: ResponseCache | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        scheduler: RateLimiter | None = None,
     ):
         self.prompt = prompt[language]
         self.prompt_inputs = prompt_inputs
         self.instructions = instructions or ""
         self.format_json = format_json
+        self.name = name
+        self.cache = cache
+        self.priority = priority
+        self.scheduler = scheduler
+        self.model_name = CHAT_MODEL_NAME
 
         self.chat_model = ChatOpenAI(
-            model="gpt-3.5-turbo",
+            model=self.model_name,
             temperature=0,
+            # Report the token usage of streamed responses too
+            stream_usage=True,
+            # Retried by the scheduler, which pauses every role on 429
+            max_retries=0,
         )
         if self.format_json:
             self.chat_model = self.chat_model.bind(
                 response_format={"type": "json_object"}
             )
 
-    def invoke(self, inputs: dict[str, str]) -> str:
-        if len(set(self.prompt_inputs) - set(list(inputs.keys()))) > 0:
-            raise ValueError(f"Input dict should contain {self.prompt_inputs} keys")
-        formatted_prompt = self.prompt.format(**inputs)
+    def invoke(
+        self, inputs: dict[str, str], priority: Priority | None = None
+    ) -> str | dict:
+        """Generate the full response.
+
+        Args:
+            inputs (dict[str, str]): Values of the prompt inputs.
+            priority (Priority | None): Class of the call in the scheduler.
+                Defaults to the priority of the role.
+
+        Returns:
+            str | dict: The response, parsed when the role answers in JSON.
+        """
+        messages = self._build_messages(inputs)
+        cache_key = self._get_cache_key(messages)
+
+        result = self.cache.get(cache_key, self.name) if self.cache else None
+        if result is None:
+            start = time.perf_counter()
+            response = self._call(
+                lambda: self.chat_model.invoke(input=messages), messages, priority
+            )
+            result = response.content
+            self._record_call(
+                "invoke", start, messages, result, response.usage_metadata
+            )
+            if self.cache:
+                self.cache.put(cache_key, result)
+
+        if self.format_json:
+            return json.loads(result)
+        return result
+
+    async def ainvoke(
+        self, inputs: dict[str, str], priority: Priority | None = None
+    ) -> str | dict:
+        """Asynchronously generate the full response.
 
-        result = self.chat_model.invoke(
-            input=[
-                (
-                    "system",
-                    self.instructions,
-                ),
-                (
-                    "user",
-                    formatted_prompt,
-                ),
-            ],
-        ).content
+        Args:
+            inputs (dict[str, str]): Values of the prompt inputs.
+            priority (Priority | None): Class of the call in the scheduler.
+                Defaults to the priority of the role.
+
+        Returns:
+            str | dict: The response, parsed when the role answers in JSON.
+        """
+        messages = self._build_messages(inputs)
+        cache_key = self._get_cache_key(messages)
+
+        result = self.cache.get(cache_key, self.name) if self.cache else None
+        if result is None:
+            start = time.perf_counter()
+            response = await self._acall(
+                lambda: self.chat_model.ainvoke(input=messages), messages, priority
+            )
+            result = response.content
+            self._record_call(
+                "ainvoke", start, messages, result, response.usage_metadata
+            )
+            if self.cache:
+                self.cache.put(cache_key, result)
 
         if self.format_json:
             return json.loads(result)
         return result
 
+    def stream(
+        self, inputs: dict[str, str], priority: Priority | None = None
+    ) -> Iterator[str]:
+        """Yield the generated tokens as they arrive.
+
+        A cached response is yielded as a single chunk. The call is retried by
+        the scheduler only until its first chunk is yielded.
+
+        Args:
+            inputs (dict[str, str]): Values of the prompt inputs.
+            priority (Priority | None): Class of the call in the scheduler.
+                Defaults to the priority of the role.
+
+        Yields:
+            str: The content of each generated chunk.
+        """
+        messages = self._build_messages(inputs)
+        cache_key = self._get_cache_key(messages)
+
+        result = self.cache.get(cache_key, self.name) if self.cache else None
+        if result is not None:
+            yield result
+            return
+
+        start = time.perf_counter()
+        tokens = self._estimate_tokens(messages)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            if self.scheduler:
+                self.scheduler.acquire(
+                    tokens, self.priority if priority is None else priority
+                )
+            chunks = []
+            usage_metadata = None
+            try:
+                for chunk in self.chat_model.stream(input=messages):
+                    if chunk.content:
+                        chunks.append(chunk.content)
+                        yield chunk.content
+                    if chunk.usage_metadata:
+                        usage_metadata = chunk.usage_metadata
+                break
+            except Exception as e:
+                delay = self._get_stream_retry_delay(e, attempt, chunks)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+        if self.scheduler:
+            self.scheduler.on_success()
+        self._record_call("stream", start, messages, "".join(chunks), usage_metadata)
+        if self.cache:
+            self.cache.put(cache_key, "".join(chunks))
+
+    async def astream(
+        self, inputs: dict[str, str], priority: Priority | None = None
+    ) -> AsyncIterator[str]:
+        """Asynchronously yield the generated tokens as they arrive.
+
+        A cached response is yielded as a single chunk. The call is retried by
+        the scheduler only until its first chunk is yielded.
+
+        Args:
+            inputs (dict[str, str]): Values of the prompt inputs.
+            priority (Priority | None): Class of the call in the scheduler.
+                Defaults to the priority of the role.
+
+        Yields:
+            str: The content of each generated chunk.
+        """
+        messages = self._build_messages(inputs)
+        cache_key = self._get_cache_key(messages)
+
+        result = self.cache.get(cache_key, self.name) if self.cache else None
+        if result is not None:
+            yield result
+            return
+
+        start = time.perf_counter()
+        tokens = self._estimate_tokens(messages)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            if self.scheduler:
+                await self.scheduler.aacquire(
+                    tokens, self.priority if priority is None else priority
+                )
+            chunks = []
+            usage_metadata = None
+            try:
+                async for chunk in self.chat_model.astream(input=messages):
+                    if chunk.content:
+                        chunks.append(chunk.content)
+                        yield chunk.content
+                    if chunk.usage_metadata:
+                        usage_metadata = chunk.usage_metadata
+                break
+            except Exception as e:
+                delay = self._get_stream_retry_delay(e, attempt, chunks)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+        if self.scheduler:
+            self.scheduler.on_success()
+        self._record_call("astream", start, messages, "".join(chunks), usage_metadata)
+        if self.cache:
+            self.cache.put(cache_key, "".join(chunks))
+
+    def count_prompt_tokens(self, inputs: dict[str, str]) -> int:
+        """Count the tokens of the messages sent for these inputs.
+
+        Args:
+            inputs (dict[str, str]): Values of the prompt inputs.
+
+        Returns:
+            int: The number of tokens of the instructions and of the prompt.
+        """
+        return sum(
+            count_tokens(content, self.model_name)
+            for _, content in self._build_messages(inputs)
+        )
+
+    def _call(
+        self,
+        request: Callable[[], T],
+        messages: List[tuple[str, str]],
+        priority: Priority | None,
+    ) -> T:
+        if self.scheduler is None:
+            return request()
+        return self.scheduler.call(
+            request,
+            tokens=self._estimate_tokens(messages),
+            max_retries=LLM_MAX_RETRIES,
+            priority=self.priority if priority is None else priority,
+        )
+
+    async def _acall(
+        self,
+        request: Callable[[], Awaitable[T]],
+        messages: List[tuple[str, str]],
+        priority: Priority | None,
+    ) -> T:
+        if self.scheduler is None:
+            return await request()
+        return await self.scheduler.acall(
+            request,
+            tokens=self._estimate_tokens(messages),
+            max_retries=LLM_MAX_RETRIES,
+            priority=self.priority if priority is None else priority,
+        )
+
+    def _get_stream_retry_delay(
+        self, error: Exception, attempt: int, chunks: List[str]
+    ) -> float | None:
+        """Seconds to wait before streaming again, None to raise the error.
+
+        A partly yielded response can not be taken back, so it is not retried.
+        """
+        if self.scheduler is None or len(chunks) > 0 or attempt == LLM_MAX_RETRIES:
+            return None
+        return self.scheduler.retry_delay(error, attempt)
+
+    def _estimate_tokens(self, messages: List[tuple[str, str]]) -> int:
+        """Prompt tokens of the messages and expected completion tokens."""
+        if self.scheduler is None:
+            return 0
+        return (
+            sum(count_tokens(content, self.model_name) for _, content in messages)
+            + EXPECTED_COMPLETION_TOKENS
+        )
+
+    def _build_messages(self, inputs: dict[str, str]) -> List[tuple[str, str]]:
+        if len(set(self.prompt_inputs) - set(list(inputs.keys()))) > 0:
+            raise ValueError(f"Input dict should contain {self.prompt_inputs} keys")
+        formatted_prompt = self.prompt.format(**inputs)
+
+        return [
+            (
+                "system",
+                self.instructions,
+            ),
+            (
+                "user",
+                formatted_prompt,
+            ),
+        ]
+
+    def _record_call(
+        self,
+        method: str,
+        start: float,
+        messages: List[tuple[str, str]],
+        result: str,
+        usage_metadata: dict | None,
+    ) -> None:
+        """Record the latency and the tokens of a call to the chat model.
+
+        The tokens reported by the model are used, else counted with tiktoken.
+        """
+        if not metrics.enabled:
+            return
+        metrics.observe(
+            "llm_duration_seconds",
+            time.perf_counter() - start,
+            role=self.name,
+            method=method,
+        )
+        if usage_metadata:
+            prompt_tokens = usage_metadata["input_tokens"]
+            completion_tokens = usage_metadata["output_tokens"]
+        else:
+            prompt_tokens = sum(
+                count_tokens(content, self.model_name) for _, content in messages
+            )
+            completion_tokens = count_tokens(result, self.model_name)
+        metrics.observe("llm_prompt_tokens", prompt_tokens, role=self.name)
+        metrics.observe("llm_completion_tokens", completion_tokens, role=self.name)
+
+    def _get_cache_key(self, messages: List[tuple[str, str]]) -> str | None:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(
+            self.model_name, self.instructions, messages[-1][1], self.format_json
+        )
+
 
 # Load model configs
 with open("backend/chat_models/system_instructions.yml", "r", encoding="utf-8") as f:
     model_configs = yaml.safe_load(f)
 
+
+# Roles only called in the background, behind the chat traffic
+ROLE_PRIORITIES = {
+    "multi_modal_summarizer": Priority.INGESTION,
+}
+
+
+def load_llm(config_name: str) -> LLM:
+    """Instantiate the chat model of a role defined in the config."""
+    return LLM(
+        **model_configs[config_name],
+        name=config_name,
+        cache=response_cache,
+        priority=ROLE_PRIORITIES.get(config_name, Priority.INTERACTIVE),
+        scheduler=llm_scheduler,
+    )
+
+
 # Instantiate chat models from config
-rag_model = LLM(**model_configs["retrieval_augmented_generator"])
-summarizer = LLM(**model_configs["multi_modal_summarizer"])
+rag_model = load_llm("retrieval_augmented_generator")
+summarizer = load_llm("multi_modal_summarizer")
 
-rewriter = LLM(**model_configs["question_rewriter"])
+rewriter = load_llm("question_rewriter")
 
-retrieval_grader = LLM(**model_configs["retrieval_grader"])
-hallucination_grader = LLM(**model_configs["hallucination_grader"])
-answer_grader = LLM(**model_configs["answer_grader"])
-router = LLM(**model_configs["router"])
+retrieval_grader = load_llm("retrieval_grader")
+batch_retrieval_grader = load_llm("batch_retrieval_grader")
+hallucination_grader = load_llm("hallucination_grader")
+answer_grader = load_llm("answer_grader")
+generation_grader = load_llm("generation_grader")
+explained_generation_grader = load_llm("generation_grader_with_explanation")
+router = load_llm("router")
@@ -0,0 +1,170 @@
+"""
+Persistent exact-match cache of LLM responses.
+
+Every role runs at temperature 0, so a response only depends on the model, the
+instructions, the formatted prompt and the JSON mode.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+RESPONSE_CACHE_PATH = "database/llm_response_cache.sqlite"
+RESPONSE_CACHE_MAX_ENTRIES = 50_000
+# Share of the capacity kept when evicting, so that evictions are grouped
+RESPONSE_CACHE_EVICTION_RATIO = 0.9
+# Number of cache hits whose access time is buffered before being written
+RESPONSE_CACHE_ACCESS_BATCH_SIZE = 100
+
+
+class ResponseCache:
+    """
+    A size-bounded SQLite store of LLM responses, evicting the least recently
+    used entries first, with hit/miss counters per LLM role.
+
+    As in `EmbeddingCache`, reads do not write: the access times of the hits are
+    buffered and written in batches. The number of entries is tracked in memory,
+    so the table is only counted, and trimmed below its capacity, once it may be
+    full.
+    """
+
+    def __init__(
+        self,
+        path: str = RESPONSE_CACHE_PATH,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Open (or create) the cache.
+
+        Args:
+            path (str): Path of the SQLite file, ":memory:" for a transient cache.
+            max_entries (int): Number of responses kept before evicting.
+        """
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_access "
+                "ON responses (last_access)"
+            )
+            # Upper bound of the number of entries, replaced rows count as new
+            self._nb_entries = self._connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+        self._pending_accesses: dict[str, float] = {}
+        self._hits = defaultdict(int)
+        self._misses = defaultdict(int)
+
+    @staticmethod
+    def make_key(
+        model: str, instructions: str, formatted_prompt: str, format_json: bool
+    ) -> str:
+        """Hash the inputs of an LLM call into a cache key.
+
+        Returns:
+            str: The hex digest identifying the response.
+        """
+        payload = json.dumps([model, instructions, formatted_prompt, format_json])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str, role: str) -> str | None:
+        """Look up a response.
+
+        Args:
+            key (str): Cache key built with `make_key`.
+            role (str): The LLM role, for the statistics.
+
+        Returns:
+            str | None: The cached raw response, None on a miss.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._misses[role] += 1
+                return None
+            self._hits[role] += 1
+            self._pending_accesses[key] = time.time()
+            if len(self._pending_accesses) >= RESPONSE_CACHE_ACCESS_BATCH_SIZE:
+                with self._connection:
+                    self._flush_accesses()
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """Store a response, then evict if it may be over capacity.
+
+        Args:
+            key (str): Cache key built with `make_key`.
+            response (str): The raw response.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, last_access) "
+                "VALUES (?, ?, ?)",
+                (key, response, time.time()),
+            )
+            self._nb_entries += 1
+            if self._nb_entries > self._max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Other processes may share the file, so the bound is checked for real
+        self._nb_entries = self._connection.execute(
+            "SELECT COUNT(*) FROM responses"
+        ).fetchone()[0]
+        if self._nb_entries <= self._max_entries:
+            return
+        # Recent hits must not be evicted
+        self._flush_accesses()
+        nb_kept = int(self._max_entries * RESPONSE_CACHE_EVICTION_RATIO)
+        self._connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_access DESC "
+            "LIMIT -1 OFFSET ?)",
+            (nb_kept,),
+        )
+        self._nb_entries = nb_kept
+
+    def _flush_accesses(self) -> None:
+        if len(self._pending_accesses) > 0:
+            self._connection.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(now, key) for key, now in self._pending_accesses.items()],
+            )
+            self._pending_accesses = {}
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Hit/miss counters of each LLM role since the cache was opened.
+
+        Returns:
+            dict[str, dict[str, float]]: hits, misses and hit_rate by role.
+        """
+        with self._lock:
+            return {
+                role: {
+                    "hits": self._hits[role],
+                    "misses": self._misses[role],
+                    "hit_rate": self._hits[role]
+                    / (self._hits[role] + self._misses[role]),
+                }
+                for role in sorted(set(self._hits) | set(self._misses))
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            with self._connection:
+                self._flush_accesses()
+            self._connection.close()
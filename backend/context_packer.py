@@ -0,0 +1,145 @@
+"""
+Assembly of the context sent to the chat models.
+
+Documents are ordered by score, passages already seen in a previous document
+are dropped, and the context is cut to the token budget of the model, so that
+prompt size stays bounded whatever the number and size of the documents.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import List
+
+from langchain_core.documents import Document
+
+from backend.chat_models.llms import CHAT_MODEL_NAME
+from backend.utils import count_tokens, truncate_to_tokens
+
+# Tokens of context given to each model, leaving room for instructions and answer
+MODEL_CONTEXT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 3000,
+    "gpt-4o-mini": 6000,
+    "gpt-4o": 6000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+# Overrides the budget of every model
+CONTEXT_TOKEN_BUDGET = os.getenv("CONTEXT_TOKEN_BUDGET")
+
+DOCUMENT_SEPARATOR = "\n\n"
+
+
+@dataclass
+class PackedContext:
+    """A context ready to be sent to a chat model."""
+
+    text: str
+    documents: List[Document]  # Documents in the context, possibly shortened
+    nb_tokens: int
+    nb_duplicate_passages: int  # Passages dropped as already in the context
+    truncated: bool  # Whether passages were cut to fit in the budget
+
+
+def get_context_token_budget(model_name: str = CHAT_MODEL_NAME) -> int:
+    """Tokens of context given to a model.
+
+    Args:
+        model_name (str): The chat model name.
+
+    Returns:
+        int: The token budget of the context.
+    """
+    if CONTEXT_TOKEN_BUDGET is not None:
+        return int(CONTEXT_TOKEN_BUDGET)
+    return MODEL_CONTEXT_TOKEN_BUDGETS.get(model_name, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+def pack_context(
+    documents: List[Document],
+    model_name: str = CHAT_MODEL_NAME,
+    token_budget: int | None = None,
+) -> PackedContext:
+    """Build the context of a prompt from documents, within a token budget.
+
+    Documents are ordered by decreasing "rerank_score" when they all have one,
+    else kept in retrieval order. Each document is split in passages (lines);
+    a passage already in the context is dropped, and the context is cut
+    where it reaches the budget.
+
+    Args:
+        documents (List[Document]): The documents, best first.
+        model_name (str): The chat model receiving the context.
+        token_budget (int | None): Maximum number of tokens of the context.
+            Defaults to the budget of the model.
+
+    Returns:
+        PackedContext: The context and the documents it contains.
+    """
+    if token_budget is None:
+        token_budget = get_context_token_budget(model_name)
+    if len(documents) > 0 and all(
+        "rerank_score" in document.metadata for document in documents
+    ):
+        documents = sorted(
+            documents,
+            key=lambda document: document.metadata["rerank_score"],
+            reverse=True,
+        )
+
+    separator_tokens = count_tokens(DOCUMENT_SEPARATOR, model_name)
+    remaining_tokens = token_budget
+    seen_passages = set()
+    packed_documents = []
+    nb_duplicate_passages = 0
+    truncated = False
+    for document in documents:
+        if remaining_tokens <= 0:
+            truncated = True
+            break
+        passages = []
+        for passage in document.page_content.split("\n"):
+            key = _normalize_passage(passage)
+            if key in seen_passages:
+                nb_duplicate_passages += 1
+                continue
+            passage_tokens = count_tokens(passage, model_name) + 1  # With line break
+            if passage_tokens > remaining_tokens:
+                passages.append(
+                    truncate_to_tokens(passage, remaining_tokens, model_name)
+                )
+                remaining_tokens = 0
+                truncated = True
+                break
+            if key:
+                seen_passages.add(key)
+            passages.append(passage)
+            remaining_tokens -= passage_tokens
+        if any(passage.strip() for passage in passages):
+            packed_documents.append(
+                Document(
+                    page_content="\n".join(passages),
+                    metadata=document.metadata,
+                    id=document.id,
+                )
+            )
+            remaining_tokens -= separator_tokens
+
+    text = DOCUMENT_SEPARATOR.join(
+        document.page_content for document in packed_documents
+    )
+    nb_tokens = count_tokens(text, model_name)
+    print(
+        f"---CONTEXT: {nb_tokens}/{token_budget} TOKENS FROM "
+        f"{len(packed_documents)}/{len(documents)} DOCUMENTS---"
+    )
+    return PackedContext(
+        text=text,
+        documents=packed_documents,
+        nb_tokens=nb_tokens,
+        nb_duplicate_passages=nb_duplicate_passages,
+        truncated=truncated,
+    )
+
+
+def _normalize_passage(passage: str) -> str:
+    return re.sub(r"\s+", " ", passage).strip().lower()
@@ -0,0 +1,251 @@
+"""
+Persistent, content-addressed cache of embeddings.
+
+Entries are keyed by a hash of (model, dimension, text), so the same page or
+question is only ever embedded once per model, across re-ingestions and
+sessions.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from backend.metrics import metrics
+
+EMBEDDING_CACHE_PATH = "database/embedding_cache.sqlite"
+EMBEDDING_CACHE_MAX_ENTRIES = 200_000
+# Share of the capacity kept when evicting, so that evictions are grouped
+EMBEDDING_CACHE_EVICTION_RATIO = 0.9
+# Number of cache hits whose access time is buffered before being written
+EMBEDDING_CACHE_ACCESS_BATCH_SIZE = 1000
+
+# SQLite limits the number of host parameters of a single statement
+_SQLITE_BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    """
+    A size-bounded SQLite store of embedding vectors, evicting the least
+    recently used entries first.
+
+    Reads do not write: the access times of the hits are buffered and written
+    in batches. The number of entries is tracked in memory, so the table is only
+    counted, and trimmed below its capacity, once it may be full.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Open (or create) the cache.
+
+        Args:
+            path (str): Path of the SQLite file, ":memory:" for a transient cache.
+            max_entries (int): Number of vectors kept before evicting.
+        """
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+                "ON embeddings (last_access)"
+            )
+            # Upper bound of the number of entries, replaced rows count as new
+            self._nb_entries = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+        self._pending_accesses: dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, dimension: int | None, text: str) -> str:
+        """Hash the embedding inputs into a cache key.
+
+        Args:
+            model (str): The embedding model name.
+            dimension (int | None): The embedding dimension.
+            text (str): The embedded text.
+
+        Returns:
+            str: The hex digest identifying the embedding.
+        """
+        return hashlib.sha256(f"{model}\0{dimension}\0{text}".encode()).hexdigest()
+
+    def get_many(self, keys: List[str]) -> dict[str, List[float]]:
+        """Look up several embeddings at once.
+
+        Args:
+            keys (List[str]): Cache keys built with `make_key`.
+
+        Returns:
+            dict[str, List[float]]: The cached vectors, missing keys are absent.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique_keys), _SQLITE_BATCH_SIZE):
+                batch = unique_keys[i : i + _SQLITE_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = array("f", vector).tolist()
+            now = time.time()
+            self._pending_accesses.update((key, now) for key in found)
+            if len(self._pending_accesses) >= EMBEDDING_CACHE_ACCESS_BATCH_SIZE:
+                with self._connection:
+                    self._flush_accesses()
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put_many(self, vectors: dict[str, List[float]]) -> None:
+        """Store several embeddings at once, then evict if it may be over capacity.
+
+        Args:
+            vectors (dict[str, List[float]]): The vectors to store, by cache key.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) "
+                "VALUES (?, ?, ?)",
+                [
+                    (key, array("f", vector).tobytes(), now)
+                    for key, vector in vectors.items()
+                ],
+            )
+            self._nb_entries += len(vectors)
+            if self._nb_entries > self._max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Other processes may share the file, so the bound is checked for real
+        self._nb_entries = self._connection.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()[0]
+        if self._nb_entries <= self._max_entries:
+            return
+        # Recent hits must not be evicted
+        self._flush_accesses()
+        nb_kept = int(self._max_entries * EMBEDDING_CACHE_EVICTION_RATIO)
+        self._connection.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            "SELECT key FROM embeddings ORDER BY last_access DESC "
+            "LIMIT -1 OFFSET ?)",
+            (nb_kept,),
+        )
+        self._nb_entries = nb_kept
+
+    def _flush_accesses(self) -> None:
+        if len(self._pending_accesses) > 0:
+            self._connection.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(now, key) for key, now in self._pending_accesses.items()],
+            )
+            self._pending_accesses = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
+
+    def stats(self) -> dict[str, float]:
+        """Hit/miss counters since the cache was opened.
+
+        Returns:
+            dict[str, float]: hits, misses, hit_rate and number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            with self._connection:
+                self._flush_accesses()
+            self._connection.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends the texts missing from the cache to the
+    underlying model, in a single batched call.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache: EmbeddingCache,
+        model: str,
+        dimension: int | None = None,
+    ):
+        """
+        Args:
+            embeddings (Embeddings): The embedding model to cache.
+            cache (EmbeddingCache): Where vectors are stored.
+            model (str): The embedding model name, part of the cache key.
+            dimension (int | None): The embedding dimension, part of the cache key.
+        """
+        self._embeddings = embeddings
+        self._cache = cache
+        self._model = model
+        self._dimension = dimension
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [
+            self._cache.make_key(self._model, self._dimension, text) for text in texts
+        ]
+        vectors = self._cache.get_many(keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if len(missing) > 0:
+            metrics.observe("embedding_batch_size", len(missing), operation="documents")
+            with metrics.time("embedding_duration_seconds", operation="documents"):
+                new_vectors = dict(
+                    zip(
+                        missing.keys(),
+                        self._embeddings.embed_documents(list(missing.values())),
+                    )
+                )
+            self._cache.put_many(new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._cache.make_key(self._model, self._dimension, text)
+        vector = self._cache.get_many([key]).get(key)
+        if vector is None:
+            with metrics.time("embedding_duration_seconds", operation="query"):
+                vector = self._embeddings.embed_query(text)
+            self._cache.put_many({key: vector})
+        return vector
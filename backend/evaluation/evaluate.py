@@ -1,20 +1,138 @@
+"""
+Evaluate the RAG pipeline on the test set with every metric.
+
+The answer and contexts of each question are generated once, and cached on
+disk by student model, then every metric scores the same runs:
+- "langsmith" runs a single LangSmith experiment on the dataset, with all the
+  metrics as its evaluators
+- "local" reads the JSONL test set and scores the runs metric by metric, with
+  concurrent judge calls, without LangSmith
+
+Usage:
+    python -m backend.evaluation.evaluate --mode langsmith
+    python -m backend.evaluation.evaluate --mode local --output scores.json
+"""
+
+import argparse
+import json
+import statistics
+from pathlib import Path
+from typing import List
+
 from langsmith import evaluate
 
 from backend.chat_models.llms import rag_model
-from backend.evaluation.evaluator import RagEvaluator
-from backend.vectorstore import MultiModalVectorstore
+from backend.evaluation.evaluator import (
+    EVALUATION_MAX_CONCURRENCY,
+    METRIC_PROMPTS,
+    RagEvaluator,
+)
+from backend.evaluation.run_cache import RUN_CACHE_DIRECTORY, RunCache
+from backend.vectorstore import get_vectorstore
 
-if __name__ == "__main__":
-    rag_evaluator = RagEvaluator(student_llm=rag_model, db=MultiModalVectorstore())
+LANGSMITH_DATASET_NAME = "OXFAM_dataset"
+DATASET_PATH = Path("backend/evaluation/datasets/OXFAM_dataset.jsonl")
 
-    evaluation_inputs = {
-        "answer_accuracy": rag_evaluator.answer_accuracy_evaluator,
+
+def load_examples(dataset_path: Path) -> List[dict[str, str]]:
+    """Read the question and reference answer of each example of the test set."""
+    examples = []
+    with open(dataset_path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                example = json.loads(line)
+                examples.append(
+                    {
+                        "question": example["question"],
+                        "answer": example["reference_answer"],
+                    }
+                )
+    return examples
+
+
+def evaluate_with_langsmith(rag_evaluator: RagEvaluator, metric_keys: List[str]):
+    evaluators = {
+        "answer_v_reference_score": rag_evaluator.answer_accuracy_evaluator,
+        "answer_hallucination_score": rag_evaluator.answer_hallucination_evaluator,
+        "answer_helpfulness_score": rag_evaluator.answer_helpfulness_evaluator,
+        "document_relevance": rag_evaluator.document_relevancy_evaluator,
     }
-    for metric_id, metric_evaluator in evaluation_inputs.items():
-        evaluate(
-            rag_evaluator.run,
-            data="OXFAM_dataset",
-            evaluators=[metric_evaluator],
-            experiment_prefix=metric_id,
-            metadata={"version": "test"},
+    evaluate(
+        rag_evaluator.cached_run,
+        data=LANGSMITH_DATASET_NAME,
+        evaluators=[evaluators[metric_key] for metric_key in metric_keys],
+        experiment_prefix="rag",
+        metadata={"version": "test", "metrics": metric_keys},
+        max_concurrency=EVALUATION_MAX_CONCURRENCY,
+    )
+
+
+def evaluate_locally(
+    rag_evaluator: RagEvaluator, dataset_path: Path, metric_keys: List[str]
+) -> dict:
+    """Generate the runs of the test set, then score them with every metric.
+
+    Returns:
+        dict: The mean of each metric, over the examples the judge scored, and
+        the score of each example.
+    """
+    examples = load_examples(dataset_path)
+    runs = rag_evaluator.generate_runs([example["question"] for example in examples])
+    scores = rag_evaluator.score_runs(examples, runs, metric_keys)
+    summary = {}
+    for metric_key, metric_scores in scores.items():
+        scored = [float(score) for score in metric_scores if score is not None]
+        summary[metric_key] = {
+            "mean": statistics.mean(scored) if scored else None,
+            "scored": len(scored),
+            "failed": len(metric_scores) - len(scored),
+        }
+        mean = "n/a" if not scored else f"{summary[metric_key]['mean']:.3f}"
+        print(
+            f"{metric_key:<28} mean={mean}  scored={len(scored)}/{len(metric_scores)}"
         )
+    return {
+        "summary": summary,
+        "examples": [
+            {
+                "question": example["question"],
+                "reference_answer": example["answer"],
+                "answer": run["answer"],
+                "contexts": run["contexts"],
+                "scores": {key: scores[key][index] for key in scores},
+            }
+            for index, (example, run) in enumerate(zip(examples, runs))
+        ],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mode", choices=["langsmith", "local"], default="langsmith")
+    parser.add_argument("--dataset", type=Path, default=DATASET_PATH)
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        choices=list(METRIC_PROMPTS),
+        default=list(METRIC_PROMPTS),
+    )
+    parser.add_argument(
+        "--refresh", action="store_true", help="Generate the cached runs again"
+    )
+    parser.add_argument("--output", help="Write the local scores to this JSON file")
+    args = parser.parse_args()
+
+    run_cache = RunCache(Path(RUN_CACHE_DIRECTORY) / f"{rag_model.name}.jsonl")
+    if args.refresh:
+        run_cache.clear()
+    rag_evaluator = RagEvaluator(
+        student_llm=rag_model, db=get_vectorstore(), run_cache=run_cache
+    )
+
+    if args.mode == "langsmith":
+        evaluate_with_langsmith(rag_evaluator, args.metrics)
+    else:
+        result = evaluate_locally(rag_evaluator, args.dataset, args.metrics)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,351 @@
+"""
+Evaluate the retrieval offline against the test set of `generate_test_set.py`.
+
+The chunks of the stored vectorstore are re-embedded with a local model into a
+temporary collection, then each question of the test set is retrieved with
+`MultiModalVectorstore.retrieve_documents`. A retrieved document is relevant
+when it contains a passage of the reference context of the question. Reports
+recall@k, hit rate and MRR, by question type, and the query latency
+percentiles, for every k and retrieval mode asked, without any network call.
+With `--sparse-max-df`, the hybrid mode is also evaluated with the BM25 pruning
+of the common terms, to compare its recall with exact BM25. The context budget
+of the page expansion is counted with tiktoken if its BPE file is in
+`TIKTOKEN_CACHE_DIR`, else approximated (see `backend.utils`).
+
+Usage:
+    python -m backend.evaluation.evaluate_retrieval --k 1 3 5 10 --modes hybrid dense
+    python -m backend.evaluation.evaluate_retrieval --embedding-model paraphrase-multilingual-MiniLM-L12-v2
+    python -m backend.evaluation.evaluate_retrieval --modes hybrid --sparse-max-df 0.25 0.5
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterator, List
+
+# The OpenAI clients are built at import, but never called
+os.environ.setdefault("OPENAI_API_KEY", "evaluation")
+
+import chromadb
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import backend.sparse_index as sparse_index
+import backend.vectorstore as vectorstore
+from backend.benchmarks.fakes import FakeEmbeddings
+from backend.metadata import normalize
+from backend.vectorstore import COLLECTION_NAME, VECTORSTORE_PATH, MultiModalVectorstore
+
+DATASET_PATH = Path("backend/evaluation/datasets/OXFAM_dataset.jsonl")
+# Share of the word trigrams of a reference passage a document must contain
+RELEVANCE_THRESHOLD = 0.5
+# Passages of a reference context, as formatted by giskard
+_REFERENCE_PASSAGE_PATTERN = re.compile(r"^Document [^:\n]+: ?", re.M)
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """A sentence-transformers model, run on CPU."""
+
+    def __init__(self, model_name: str):
+        # Optional dependency, only needed to evaluate with a real local model
+        from sentence_transformers import SentenceTransformer
+
+        self._model = SentenceTransformer(model_name, device="cpu")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._model.encode(
+            texts, normalize_embeddings=True, show_progress_bar=False
+        ).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def load_test_set(dataset_path: Path) -> List[dict]:
+    """Read the questions and their reference passages.
+
+    Args:
+        dataset_path (Path): The JSONL test set saved by `generate_test_set.py`.
+
+    Returns:
+        List[dict]: The question, question_type and reference passages of each
+        example having a reference context.
+    """
+    examples = []
+    with open(dataset_path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            example = json.loads(line)
+            passages = [
+                passage.strip()
+                for passage in _REFERENCE_PASSAGE_PATTERN.split(
+                    example.get("reference_context") or ""
+                )
+                if passage.strip()
+            ]
+            if len(passages) == 0:
+                continue
+            examples.append(
+                {
+                    "question": example["question"],
+                    "question_type": (example.get("metadata") or {}).get(
+                        "question_type", "unknown"
+                    ),
+                    "passages": passages,
+                }
+            )
+    return examples
+
+
+def _get_trigrams(text: str) -> set[tuple[str, ...]]:
+    words = normalize(text).split()
+    if len(words) < 3:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i : i + 3]) for i in range(len(words) - 2)}
+
+
+def is_relevant(document: Document, passage_trigrams: set[tuple[str, ...]]) -> bool:
+    """Whether a document contains a reference passage, whatever its chunking."""
+    if len(passage_trigrams) == 0:
+        return False
+    document_trigrams = _get_trigrams(document.page_content)
+    return (
+        len(passage_trigrams & document_trigrams) / len(passage_trigrams)
+        >= RELEVANCE_THRESHOLD
+    )
+
+
+def iter_stored_pages(vectorstore_path: str) -> Iterator[List[Document]]:
+    """Read the chunks of the stored vectorstore, page by page, without embedding.
+
+    Args:
+        vectorstore_path (str): Directory of the persistent Chroma collection.
+
+    Yields:
+        List[Document]: All the chunks of a page, in order.
+    """
+    client = chromadb.PersistentClient(path=vectorstore_path)
+    stored = client.get_collection(COLLECTION_NAME).get(
+        include=["documents", "metadatas"]
+    )
+    pages = defaultdict(list)
+    for vector_id, content, metadata in zip(
+        stored["ids"], stored["documents"], stored["metadatas"]
+    ):
+        metadata = dict(metadata)
+        metadata["page_number"] = MultiModalVectorstore._get_page_number(
+            vector_id, metadata
+        )
+        # Pages stored before chunking are a single chunk
+        metadata.setdefault("chunk_index", 0)
+        metadata.setdefault("nb_chunks", 1)
+        if not metadata.get("document_id"):
+            metadata["document_id"] = MultiModalVectorstore._get_document_id(
+                metadata["filename"], metadata["page_number"]
+            )
+        pages[(metadata["filename"], metadata["page_number"])].append(
+            Document(
+                page_content=content or "",
+                metadata=metadata,
+                id=MultiModalVectorstore._get_chunk_id(
+                    metadata["document_id"], metadata["chunk_index"]
+                ),
+            )
+        )
+    for page in sorted(pages):
+        yield sorted(pages[page], key=lambda chunk: chunk.metadata["chunk_index"])
+
+
+def build_local_vectorstore(
+    source_path: str, embeddings: Embeddings, path: str, batch_size: int = 64
+) -> int:
+    """Copy the stored chunks into a collection embedded with a local model.
+
+    Returns:
+        int: The number of pages copied.
+    """
+    db = MultiModalVectorstore(embeddings, path)
+    nb_pages = 0
+    batch = []
+    for page_chunks in iter_stored_pages(source_path):
+        batch.extend(page_chunks)
+        nb_pages += 1
+        if nb_pages % batch_size == 0:
+            db.add_pdf_pages_to_vectorstore(batch)
+            batch = []
+    db.add_pdf_pages_to_vectorstore(batch)
+    db.close()
+    return nb_pages
+
+
+def percentiles(values: List[float]) -> dict[str, float]:
+    if len(values) < 2:
+        return {"p50": values[0], "p95": values[0], "p99": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def evaluate(
+    db: MultiModalVectorstore, examples: List[dict], k: int, expand: bool
+) -> dict:
+    """Retrieve every question and score the documents against its passages.
+
+    Args:
+        db (MultiModalVectorstore): The vectorstore to query.
+        examples (List[dict]): The examples of `load_test_set`.
+        k (int): Number of chunks retrieved.
+        expand (bool): Expand the chunks to pages, as the graph does.
+
+    Returns:
+        dict: recall@k (share of the passages found), hit rate (share of the
+        questions with a relevant document), MRR, by question type and overall,
+        and the latency percentiles of the retrieval and of its stages, in ms.
+    """
+    scores_by_type = defaultdict(lambda: {"recall": [], "hit": [], "reciprocal": []})
+    latencies = defaultdict(list)
+    for example in examples:
+        documents, timings = db.retrieve_documents_with_timings(
+            example["question"], k=k, expand=expand
+        )
+        for stage, duration in timings.items():
+            latencies[stage].append(duration)
+
+        passages_trigrams = [_get_trigrams(passage) for passage in example["passages"]]
+        found = [
+            any(is_relevant(document, trigrams) for document in documents)
+            for trigrams in passages_trigrams
+        ]
+        first_rank = next(
+            (
+                rank
+                for rank, document in enumerate(documents, start=1)
+                if any(
+                    is_relevant(document, trigrams) for trigrams in passages_trigrams
+                )
+            ),
+            None,
+        )
+        for question_type in (example["question_type"], "all"):
+            scores = scores_by_type[question_type]
+            scores["recall"].append(sum(found) / len(found))
+            scores["hit"].append(float(any(found)))
+            scores["reciprocal"].append(1 / first_rank if first_rank else 0.0)
+
+    return {
+        "quality": {
+            question_type: {
+                "questions": len(scores["recall"]),
+                "recall": statistics.mean(scores["recall"]),
+                "hit_rate": statistics.mean(scores["hit"]),
+                "mrr": statistics.mean(scores["reciprocal"]),
+            }
+            for question_type, scores in sorted(scores_by_type.items())
+        },
+        "latency_ms": {
+            stage: percentiles(durations) for stage, durations in latencies.items()
+        },
+    }
+
+
+def report(mode: str, k: int, result: dict) -> None:
+    overall = result["quality"]["all"]
+    latency = result["latency_ms"]["total"]
+    sparse_max_df = result.get("sparse_max_df")
+    bm25 = "exact" if sparse_max_df is None else f"df<={sparse_max_df:g}"
+    print(
+        f"mode={mode:<6} bm25={bm25:<8} k={k:<3} recall@k={overall['recall']:.3f}  "
+        f"hit@k={overall['hit_rate']:.3f}  MRR={overall['mrr']:.3f}  "
+        f"latency p50={latency['p50']:7.2f} ms  p95={latency['p95']:7.2f} ms  "
+        f"p99={latency['p99']:7.2f} ms"
+    )
+    for question_type, quality in result["quality"].items():
+        if question_type != "all":
+            print(
+                f"    {question_type:<24} n={quality['questions']:<4} "
+                f"recall@k={quality['recall']:.3f}  MRR={quality['mrr']:.3f}"
+            )
+
+
+def main(args: argparse.Namespace) -> List[dict]:
+    examples = load_test_set(args.dataset)
+    embeddings = (
+        SentenceTransformerEmbeddings(args.embedding_model)
+        if args.embedding_model
+        else FakeEmbeddings()
+    )
+    vectorstore.RETRIEVAL_METADATA_FILTER = not args.no_filter
+
+    results = []
+    with (
+        tempfile.TemporaryDirectory() as path,
+        open(os.devnull, "w") as devnull,
+        # The retrieval progress prints are not what is measured
+        contextlib.redirect_stdout(sys.stdout if args.verbose else devnull),
+    ):
+        start = time.perf_counter()
+        nb_pages = build_local_vectorstore(args.vectorstore_path, embeddings, path)
+        indexing_duration = time.perf_counter() - start
+        db = MultiModalVectorstore(embeddings, path)
+        for mode in args.modes:
+            vectorstore.RETRIEVAL_MODE = mode
+            # Only the hybrid mode uses BM25, exact first
+            ratios = [None] + (args.sparse_max_df if mode == "hybrid" else [])
+            for ratio in ratios:
+                sparse_index.SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO = ratio
+                for k in args.k:
+                    result = evaluate(db, examples, k, expand=not args.no_expand)
+                    results.append(
+                        {"mode": mode, "sparse_max_df": ratio, "k": k, **result}
+                    )
+        db.close()
+
+    print(
+        f"{len(examples)} questions, {nb_pages} pages indexed locally "
+        f"in {indexing_duration:.1f}s"
+    )
+    for result in results:
+        report(result["mode"], result["k"], result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--dataset", type=Path, default=DATASET_PATH)
+    parser.add_argument("--vectorstore-path", default=VECTORSTORE_PATH)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5, 10])
+    parser.add_argument(
+        "--modes", nargs="+", choices=["hybrid", "dense"], default=["hybrid", "dense"]
+    )
+    parser.add_argument(
+        "--embedding-model",
+        help="A sentence-transformers model, else hashed bag-of-words embeddings",
+    )
+    parser.add_argument(
+        "--no-expand", action="store_true", help="Score the chunks, not their pages"
+    )
+    parser.add_argument(
+        "--no-filter", action="store_true", help="Disable the metadata filter"
+    )
+    parser.add_argument(
+        "--sparse-max-df",
+        type=float,
+        nargs="+",
+        default=[],
+        help="Also evaluate the hybrid mode with BM25 skipping the terms found in "
+        "more than these shares of the chunks",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Keep retrieval prints")
+    main(parser.parse_args())
@@ -1,4 +1,6 @@
-import time
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Any
 
 from langchain import hub
@@ -7,9 +9,30 @@ from langchain_ollama import ChatOllama
 from langchain_openai import ChatOpenAI
 from langsmith import traceable
 
-from backend.chat_models.llms import LLM
-from backend.utils import format_documents
-from backend.vectorstore import MultiModalVectorstore
+import backend.reranker as reranker
+import backend.sparse_index as sparse_index
+import backend.vectorstore as vectorstore
+from backend.chat_models.llms import EXPECTED_COMPLETION_TOKENS, LLM
+from backend.context_packer import get_context_token_budget, pack_context
+from backend.evaluation.run_cache import RunCache
+from backend.rate_limiter import Priority, RateLimiter
+from backend.vectorstore import MultiModalVectorstore, get_vectorstore
+
+# Budget of the student LLM calls, below the limits of the OpenAI account
+EVALUATION_REQUESTS_PER_MINUTE = float(os.getenv("EVALUATION_REQUESTS_PER_MINUTE", 60))
+EVALUATION_TOKENS_PER_MINUTE = float(os.getenv("EVALUATION_TOKENS_PER_MINUTE", 60000))
+# Examples evaluated at the same time, the rate limiter decides when they are sent
+EVALUATION_MAX_CONCURRENCY = int(os.getenv("EVALUATION_MAX_CONCURRENCY", 8))
+# Judge calls sent at the same time to the local evaluator LLM
+JUDGE_MAX_CONCURRENCY = int(os.getenv("JUDGE_MAX_CONCURRENCY", 4))
+
+# Hub prompt of each metric, by key of its score
+METRIC_PROMPTS = {
+    "answer_v_reference_score": "langchain-ai/rag-answer-vs-reference",
+    "answer_hallucination_score": "langchain-ai/rag-answer-hallucination",
+    "answer_helpfulness_score": "langchain-ai/rag-answer-helpfulness",
+    "document_relevance": "langchain-ai/rag-document-relevance",
+}
 
 
 class RagEvaluator:
@@ -19,19 +42,40 @@ class RagEvaluator:
     the quality of the RAG process using predefined metrics.
     """
 
-    def __init__(self, student_llm: LLM, db: MultiModalVectorstore):
+    def __init__(
+        self,
+        student_llm: LLM,
+        db: MultiModalVectorstore | None = None,
+        rate_limiter: RateLimiter | None = None,
+        run_cache: RunCache | None = None,
+    ):
         """
         Initialize the RAG evaluator.
 
         Args:
             student_llm (LLM): The LLM used by the student model.
-            db (MultiModalVectorstore): The vector store for document retrieval.
+            db (MultiModalVectorstore | None): The vector store for document retrieval.
+                Defaults to the process-wide vectorstore.
+            rate_limiter (RateLimiter | None): Budget of the student LLM calls,
+                shared by the examples evaluated concurrently. Defaults to
+                `EVALUATION_REQUESTS_PER_MINUTE` and `EVALUATION_TOKENS_PER_MINUTE`.
+            run_cache (RunCache | None): Stored runs of the student LLM, reused
+                instead of generating the answers again. Defaults to no cache.
         """
         self._student_llm = student_llm
-        self._db = db
+        self._db = db or get_vectorstore()
+        self._rate_limiter = rate_limiter or RateLimiter(
+            EVALUATION_REQUESTS_PER_MINUTE,
+            EVALUATION_TOKENS_PER_MINUTE,
+            name="evaluation",
+        )
+        self._run_cache = run_cache
         self._evaluator_llm = ChatOllama(
             model="llama3.2:3b-instruct-fp16", temperature=0
         )
+        # Hub prompts of the metrics, pulled once instead of once per example
+        self._metric_prompts: dict[str, Any] = {}
+        self._metric_prompts_lock = threading.Lock()
 
     @traceable()
     def retrieve_docs(self, question: str) -> List[Document]:
@@ -60,12 +104,18 @@ class RagEvaluator:
         Returns:
             dict[str, Any]: Contains the generated answer and the context.
         """
-        response = self._student_llm.invoke(
-            inputs={"context": format_documents(documents), "question": question}
+        packed_context = pack_context(documents, self._student_llm.model_name)
+        inputs = {"context": packed_context.text, "question": question}
+        # The evaluation budget is on top of the limiter shared by every role,
+        # which serves the evaluation calls behind the chat ones and retries them
+        self._rate_limiter.acquire(
+            self._student_llm.count_prompt_tokens(inputs) + EXPECTED_COMPLETION_TOKENS
         )
+        response = self._student_llm.invoke(inputs=inputs, priority=Priority.EVALUATION)
         return {
             "answer": response,
-            "contexts": [doc.page_content for doc in documents],
+            "contexts": [doc.page_content for doc in packed_context.documents],
+            "context_tokens": packed_context.nb_tokens,
         }
 
     @traceable()
@@ -86,6 +136,9 @@ class RagEvaluator:
         """
         Generate an answer and include the retrieved context.
 
+        Safe to call from several threads: the student LLM calls wait for the
+        rate limiter, and are retried when rate limited.
+
         Args:
             example (dict): Input example containing the question.
 
@@ -93,9 +146,125 @@ class RagEvaluator:
             dict[str, Any]: The generated answer and associated contexts.
         """
         response = self.get_student_answer(example["question"])
-        time.sleep(10)  # Delay each generation to avoid rate limits of OpenAI
         return {"answer": response["answer"], "contexts": response["contexts"]}
 
+    def cached_run(self, example: dict) -> dict[str, Any]:
+        """
+        Get the run of an example from the run cache, generating it on a miss.
+
+        Args:
+            example (dict): Input example containing the question.
+
+        Returns:
+            dict[str, Any]: The generated answer and associated contexts.
+        """
+        if self._run_cache is None:
+            return self.run(example)
+        key = RunCache.get_key(self.get_run_fingerprint(), example["question"])
+        run = self._run_cache.get(key)
+        if run is None:
+            run = self.run(example)
+            self._run_cache.put(key, run)
+        return run
+
+    def get_run_fingerprint(self) -> dict[str, Any]:
+        """
+        Everything a run depends on besides its question.
+
+        Returns:
+            dict[str, Any]: The student model, instructions and prompt, the
+            retrieval, reranking and context settings, and the hash of the
+            stored corpus (pages, their content and their chunks).
+        """
+        return {
+            "model_name": self._student_llm.model_name,
+            "instructions": self._student_llm.instructions,
+            "prompt": self._student_llm.prompt,
+            "retrieval_mode": vectorstore.RETRIEVAL_MODE,
+            "retrieval_k": vectorstore.RETRIEVAL_K,
+            "hybrid_fetch_k": vectorstore.HYBRID_FETCH_K,
+            "rrf_k": vectorstore.RRF_K,
+            "sparse_max_document_frequency_ratio": (
+                sparse_index.SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO
+            ),
+            "metadata_filter": vectorstore.RETRIEVAL_METADATA_FILTER,
+            "retrieval_context_tokens": vectorstore.RETRIEVAL_CONTEXT_TOKENS,
+            "embedding_model": vectorstore.EMBEDDING_MODEL_NAME,
+            "rerank": [
+                reranker.RERANK,
+                reranker.RERANK_MODEL_NAME,
+                reranker.RERANK_TOP_N,
+            ],
+            "context_token_budget": get_context_token_budget(
+                self._student_llm.model_name
+            ),
+            "corpus": self._db.manifest.get_fingerprint(),
+        }
+
+    def generate_runs(self, questions: List[str]) -> List[dict[str, Any]]:
+        """
+        Generate the run of every question once, concurrently, reusing the
+        cached runs.
+
+        Args:
+            questions (List[str]): The questions of the test set.
+
+        Returns:
+            List[dict[str, Any]]: The run of each question, in order.
+        """
+        with ThreadPoolExecutor(max_workers=EVALUATION_MAX_CONCURRENCY) as executor:
+            return list(
+                executor.map(
+                    lambda question: self.cached_run({"question": question}),
+                    questions,
+                )
+            )
+
+    def get_metric_prompt(self, metric_key: str) -> Any:
+        """
+        Get the hub prompt of a metric, pulled on first use.
+
+        Args:
+            metric_key (str): The key of the metric score, see `METRIC_PROMPTS`.
+
+        Returns:
+            Any: The prompt of the metric.
+        """
+        with self._metric_prompts_lock:
+            if metric_key not in self._metric_prompts:
+                self._metric_prompts[metric_key] = hub.pull(METRIC_PROMPTS[metric_key])
+            return self._metric_prompts[metric_key]
+
+    @staticmethod
+    def get_metric_inputs(
+        metric_key: str, question: str, reference_answer: str, run: dict[str, Any]
+    ) -> dict[str, Any]:
+        """
+        Build the inputs of a metric prompt.
+
+        Args:
+            metric_key (str): The key of the metric score, see `METRIC_PROMPTS`.
+            question (str): The question of the example.
+            reference_answer (str): The reference answer of the example.
+            run (dict[str, Any]): The answer and contexts of the student.
+
+        Returns:
+            dict[str, Any]: The inputs of the metric prompt.
+        """
+        if metric_key == "answer_v_reference_score":
+            return {
+                "question": question,
+                "correct_answer": reference_answer,
+                "student_answer": run["answer"],
+            }
+        if metric_key == "answer_hallucination_score":
+            return {"documents": run["contexts"], "student_answer": run["answer"]}
+        if metric_key == "answer_helpfulness_score":
+            return {"question": question, "student_answer": run["answer"]}
+        if metric_key == "document_relevance":
+            return {"question": question, "documents": run["contexts"]}
+        raise ValueError(f"Unknown metric: {metric_key}")
+
     def evaluate(self, metric: Any, inputs: dict[str, str]) -> Any:
         """
         Evaluate the generated answer using the specified metric.
@@ -111,6 +280,74 @@ class RagEvaluator:
         score = evaluator.invoke(input=inputs)
         return score["Score"]
 
+    def evaluate_batch(self, metric: Any, inputs: List[dict[str, Any]]) -> List[Any]:
+        """
+        Evaluate several generated answers with the same metric, sending up to
+        `JUDGE_MAX_CONCURRENCY` judge calls at a time.
+
+        Args:
+            metric (Any): The evaluation metric.
+            inputs (List[dict[str, Any]]): Inputs required by the metric, by answer.
+
+        Returns:
+            List[Any]: The evaluation score of each answer, None when the judge
+            call failed.
+        """
+        evaluator = metric | self._evaluator_llm
+        scores = evaluator.batch(
+            inputs,
+            config={"max_concurrency": JUDGE_MAX_CONCURRENCY},
+            return_exceptions=True,
+        )
+        return [
+            None if isinstance(score, Exception) else score["Score"] for score in scores
+        ]
+
+    def score_runs(
+        self,
+        examples: List[dict[str, str]],
+        runs: List[dict[str, Any]],
+        metric_keys: List[str] | None = None,
+    ) -> dict[str, List[Any]]:
+        """
+        Score the runs of the examples with every metric.
+
+        Args:
+            examples (List[dict[str, str]]): The question and reference answer
+                of each example.
+            runs (List[dict[str, Any]]): The run of each example, in order.
+            metric_keys (List[str] | None): The metrics to score. Defaults to
+                every metric of `METRIC_PROMPTS`.
+
+        Returns:
+            dict[str, List[Any]]: By metric key, the score of each example.
+        """
+        scores = {}
+        for metric_key in metric_keys or list(METRIC_PROMPTS):
+            print(f"---SCORE {metric_key.upper()}---")
+            scores[metric_key] = self.evaluate_batch(
+                self.get_metric_prompt(metric_key),
+                [
+                    self.get_metric_inputs(
+                        metric_key, example["question"], example["answer"], run
+                    )
+                    for example, run in zip(examples, runs)
+                ],
+            )
+        return scores
+
+    def _evaluate_example(self, metric_key: str, run, example) -> dict:
+        score = self.evaluate(
+            metric=self.get_metric_prompt(metric_key),
+            inputs=self.get_metric_inputs(
+                metric_key,
+                example.inputs["question"],
+                example.outputs["answer"],
+                run.outputs,
+            ),
+        )
+        return {"key": metric_key, "score": score}
+
     # Individual evaluation methods
     def answer_accuracy_evaluator(self, run, example) -> dict:
         """
@@ -123,15 +360,7 @@ class RagEvaluator:
         Returns:
             dict: Evaluation result with the accuracy score.
         """
-        score = self.evaluate(
-            metric=hub.pull("langchain-ai/rag-answer-vs-reference"),
-            inputs={
-                "question": example.inputs["question"],
-                "correct_answer": example.outputs["answer"],
-                "student_answer": run.outputs["answer"],
-            },
-        )
-        return {"key": "answer_v_reference_score", "score": score}
+        return self._evaluate_example("answer_v_reference_score", run, example)
 
     def answer_hallucination_evaluator(self, run, example) -> dict:
         """
@@ -144,14 +373,7 @@ class RagEvaluator:
         Returns:
             dict: Evaluation result with the hallucination score.
         """
-        score = self.evaluate(
-            metric=hub.pull("langchain-ai/rag-answer-hallucination"),
-            inputs={
-                "documents": run.outputs["contexts"],
-                "student_answer": run.outputs["answer"],
-            },
-        )
-        return {"key": "answer_hallucination_score", "score": score}
+        return self._evaluate_example("answer_hallucination_score", run, example)
 
     def answer_helpfulness_evaluator(self, run, example) -> dict:
         """
@@ -164,14 +386,7 @@ class RagEvaluator:
         Returns:
             dict: Evaluation result with the helpfulness score.
         """
-        score = self.evaluate(
-            metric=hub.pull("langchain-ai/rag-answer-helpfulness"),
-            inputs={
-                "question": example.inputs["question"],
-                "student_answer": run.outputs["answer"],
-            },
-        )
-        return {"key": "answer_helpfulness_score", "score": score}
+        return self._evaluate_example("answer_helpfulness_score", run, example)
 
     def document_relevancy_evaluator(self, run, example) -> dict:
         """
@@ -184,11 +399,4 @@ class RagEvaluator:
         Returns:
             dict: Evaluation result with the document relevancy score.
         """
-        score = self.evaluate(
-            metric=hub.pull("langchain-ai/rag-document-relevance"),
-            inputs={
-                "question": example.inputs["question"],
-                "documents": run.outputs["contexts"],
-            },
-        )
-        return {"key": "document_relevance", "score": score}
+        return self._evaluate_example("document_relevance", run, example)
@@ -11,7 +11,7 @@ from giskard.rag.question_generators import (
 )
 from langsmith import Client
 
-from backend.vectorstore import MultiModalVectorstore
+from backend.vectorstore import get_vectorstore
 
 load_dotenv()
 
@@ -22,7 +22,7 @@ llm.set_embedding_model("text-embedding-3-small")
 TEST_SET_FILENAME = "OXFAM_dataset"
 
 if __name__ == "__main__":
-    db = MultiModalVectorstore()
+    db = get_vectorstore()
 
     # Load your datasets and initialize the KnowledgeBase
     knowledge_base_df = pd.DataFrame(
@@ -0,0 +1,78 @@
+"""
+Persistent cache of the runs of the student model on the test set.
+
+A run (the generated answer and its contexts) is generated once and every
+metric is scored on the stored run. A run is keyed by its question and by a
+fingerprint of everything else it depends on (see
+`RagEvaluator.get_run_fingerprint`): the student model and prompt, the
+retrieval and context settings, and the stored corpus. Changing any of them
+generates the runs again instead of scoring stale answers. Runs are appended
+to a JSON lines file as soon as they are generated, so an interrupted
+evaluation resumes where it stopped.
+"""
+
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Any
+
+RUN_CACHE_DIRECTORY = "database/evaluation_runs"
+
+
+class RunCache:
+    """Runs of a student model, by question, stored as JSON lines."""
+
+    def __init__(self, path: str | Path):
+        """
+        Open (or create) the cache, loading the runs already stored.
+
+        Args:
+            path (str | Path): Path of the JSON lines file.
+        """
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._runs: dict[str, dict[str, Any]] = {}
+        if self._path.exists():
+            with open(self._path, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._runs[entry.pop("key")] = entry
+
+    @staticmethod
+    def get_key(fingerprint: dict[str, Any], question: str) -> str:
+        """
+        Key of the run of a question.
+
+        Args:
+            fingerprint (dict[str, Any]): JSON-serializable settings and
+                corpus hash the run depends on.
+            question (str): The question.
+
+        Returns:
+            str: The key of the run.
+        """
+        payload = json.dumps([fingerprint, question], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        with self._lock:
+            return self._runs.get(key)
+
+    def put(self, key: str, run: dict[str, Any]) -> None:
+        """Store a run, replacing the previous run of the same key."""
+        with self._lock:
+            self._runs[key] = run
+            with open(self._path, "a", encoding="utf-8") as file:
+                file.write(json.dumps({"key": key, **run}, ensure_ascii=False) + "\n")
+
+    def clear(self) -> None:
+        """Forget every run, to generate them again."""
+        with self._lock:
+            self._runs = {}
+            self._path.unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._runs)
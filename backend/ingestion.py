@@ -0,0 +1,294 @@
+"""
+Pipelined PDF ingestion.
+
+Pages flow through three stages that overlap in time:
+(1) `partition_pdf` runs in a process pool (CPU bound)
+(2) Table summaries run in a bounded thread pool (network bound)
+(3) Finished pages are written to the vectorstore in batches
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, List
+
+from langchain_core.documents import Document
+from pypdf import PdfReader, PdfWriter
+
+from backend.manifest import hash_content
+from backend.vectorstore import MultiModalVectorstore, partition_pdf_page
+
+PARTITION_WORKERS = int(os.getenv("INGESTION_PARTITION_WORKERS", os.cpu_count() or 1))
+SUMMARY_WORKERS = int(os.getenv("INGESTION_SUMMARY_WORKERS", 4))
+WRITE_BATCH_SIZE = int(os.getenv("INGESTION_WRITE_BATCH_SIZE", 16))
+
+
+@dataclass
+class PageResult:
+    """Outcome of the ingestion of a single page."""
+
+    pdf_filename: str
+    page_number: int
+    error: Exception | None = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class IngestionReport:
+    """Outcome of the ingestion of a PDF file."""
+
+    pdf_filename: str
+    total_pages: int
+    processed_pages: int  # Partitioned and summarized
+    reused_pages: int  # Copied from identical stored pages
+    page_results: List[PageResult]
+    duration: float
+
+    @property
+    def failed_pages(self) -> List[PageResult]:
+        return [result for result in self.page_results if not result.succeeded]
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.processed_pages / self.duration if self.duration > 0 else 0.0
+
+
+def split_pdf_pages(pdf_reader: PdfReader, page_numbers: List[int]) -> List[bytes]:
+    """Write each requested page of a PDF as a standalone single-page PDF.
+
+    Args:
+        pdf_reader (PdfReader): The opened PDF file.
+        page_numbers (List[int]): The pages to extract.
+
+    Returns:
+        List[bytes]: The single-page PDFs, in the order of `page_numbers`.
+    """
+    pdf_pages = []
+    for page_number in page_numbers:
+        writer = PdfWriter()
+        writer.add_page(pdf_reader.pages[page_number])
+        pdf_bytes = BytesIO()
+        writer.write(pdf_bytes)
+        pdf_pages.append(pdf_bytes.getvalue())
+    return pdf_pages
+
+
+class IngestionPipeline:
+    """
+    Ingest the pages of a PDF file into a vectorstore, overlapping the
+    partitioning, table summarization and vectorstore write stages.
+    """
+
+    def __init__(
+        self,
+        db: MultiModalVectorstore,
+        partition_workers: int = PARTITION_WORKERS,
+        summary_workers: int = SUMMARY_WORKERS,
+        write_batch_size: int = WRITE_BATCH_SIZE,
+    ):
+        """
+        Initialize the ingestion pipeline.
+
+        Args:
+            db (MultiModalVectorstore): The vectorstore to write pages to.
+            partition_workers (int): Number of processes partitioning pages.
+            summary_workers (int): Number of threads summarizing tables.
+            write_batch_size (int): Number of pages per vectorstore write.
+        """
+        self._db = db
+        self._partition_workers = max(1, partition_workers)
+        self._summary_workers = max(1, summary_workers)
+        self._write_batch_size = max(1, write_batch_size)
+
+    def ingest(
+        self,
+        pdf_filepath: Path,
+        on_page_done: Callable[[PageResult], None] | None = None,
+    ) -> IngestionReport:
+        """
+        Ingest the pages of a PDF file that are not stored yet or changed.
+
+        Pages are identified by content hash: unchanged pages are skipped, pages
+        already stored under another file or page number are copied without
+        being partitioned and summarized again, and pages beyond the end of a
+        shorter new version of the file are deleted. Pages stored before hashes
+        were recorded can not be compared, so they are processed again.
+
+        A failing page is reported and does not stop the other pages.
+
+        Args:
+            pdf_filepath (Path): Path to the PDF file.
+            on_page_done (Callable[[PageResult], None] | None): Called from the
+                calling thread each time a page is stored, skipped or failed.
+
+        Returns:
+            IngestionReport: The outcome of every page.
+        """
+        start = time.perf_counter()
+        pdf_filename = pdf_filepath.name
+        pdf_content = pdf_filepath.read_bytes()
+        file_hash = hash_content(pdf_content)
+        pdf_reader = PdfReader(BytesIO(pdf_content))
+        total_pages = len(pdf_reader.pages)
+
+        page_results = []
+
+        def report(result: PageResult) -> None:
+            page_results.append(result)
+            if result.error is not None:
+                print(f"FAILED {pdf_filename}: PAGE #{result.page_number + 1}")
+                print(f"---ERROR: {result.error!r}---")
+            if on_page_done is not None:
+                on_page_done(result)
+
+        manifest = self._db.manifest
+        manifest.set_page_count(pdf_filename, total_pages)
+        stored_page_hashes = manifest.get_page_hashes(pdf_filename)
+        self._db.delete_pages_from_vectorstore(
+            pdf_filename,
+            [
+                page_number
+                for page_number in stored_page_hashes
+                if page_number >= total_pages
+            ],
+        )
+
+        pages_to_process, pages_to_copy = [], []
+        if (
+            manifest.get_file_hash(pdf_filename) == file_hash
+            and len(stored_page_hashes) == total_pages
+            and None not in stored_page_hashes.values()
+        ):
+            # Unchanged file, no need to look at its pages
+            for page_number in range(total_pages):
+                report(PageResult(pdf_filename, page_number))
+            pdf_pages, page_hashes = [], []
+        else:
+            pdf_pages = split_pdf_pages(pdf_reader, list(range(total_pages)))
+            page_hashes = [hash_content(pdf_page) for pdf_page in pdf_pages]
+            for page_number, page_hash in enumerate(page_hashes):
+                # A page stored without hash may differ, it is stored again
+                if stored_page_hashes.get(page_number) == page_hash:
+                    report(PageResult(pdf_filename, page_number))
+                elif manifest.find_page(page_hash) is not None:
+                    pages_to_copy.append(page_number)
+                else:
+                    pages_to_process.append(page_number)
+
+        # Chunks of each page waiting to be written
+        pending_pages: List[List[Document]] = []
+
+        def flush() -> None:
+            if len(pending_pages) == 0:
+                return
+            batch = list(pending_pages)
+            pending_pages.clear()
+            try:
+                self._db.add_pdf_pages_to_vectorstore(
+                    [chunk for page_chunks in batch for chunk in page_chunks]
+                )
+                errors = [None] * len(batch)
+            except Exception as e:
+                errors = [e] * len(batch)
+            for page_chunks, error in zip(batch, errors):
+                report(
+                    PageResult(
+                        pdf_filename, page_chunks[0].metadata["page_number"], error
+                    )
+                )
+
+        for page_number in pages_to_copy:
+            source = manifest.find_page(page_hashes[page_number])
+            page_chunks = (
+                self._db.copy_stored_page(*source, pdf_filename, page_number)
+                if source is not None
+                else None
+            )
+            if page_chunks is None:
+                # The identical page was deleted meanwhile
+                pages_to_process.append(page_number)
+                continue
+            print(
+                f"REUSING {source[0]}: PAGE #{source[1] + 1} AS PAGE #{page_number + 1}"
+            )
+            for chunk in page_chunks:
+                chunk.metadata["page_hash"] = page_hashes[page_number]
+            pending_pages.append(page_chunks)
+            if len(pending_pages) >= self._write_batch_size:
+                flush()
+
+        if len(pages_to_process) > 0:
+            # Spawned workers, as forking a process running Streamlit, Chroma
+            # and SQLite threads can deadlock on locks held by those threads
+            with ProcessPoolExecutor(
+                max_workers=self._partition_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as partition_pool, ThreadPoolExecutor(
+                max_workers=self._summary_workers
+            ) as summary_pool:
+                running: dict[Future, tuple[str, int]] = {
+                    partition_pool.submit(partition_pdf_page, pdf_pages[page_number]): (
+                        "partition",
+                        page_number,
+                    )
+                    for page_number in pages_to_process
+                }
+
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage, page_number = running.pop(future)
+                        if future.exception() is not None:
+                            report(
+                                PageResult(
+                                    pdf_filename, page_number, future.exception()
+                                )
+                            )
+                        elif stage == "partition":
+                            print(f"PROCESSING {pdf_filename}: PAGE #{page_number + 1}")
+                            summary_future = summary_pool.submit(
+                                self._db.build_page_chunks,
+                                future.result(),
+                                pdf_filename,
+                                page_number,
+                                page_hashes[page_number],
+                            )
+                            running[summary_future] = ("summary", page_number)
+                        else:
+                            pending_pages.append(future.result())
+                            if len(pending_pages) >= self._write_batch_size:
+                                flush()
+        flush()
+
+        if all(result.succeeded for result in page_results):
+            manifest.set_file_hash(pdf_filename, file_hash)
+
+        page_results.sort(key=lambda result: result.page_number)
+        # Failed pages were neither processed nor reused
+        failed_page_numbers = {
+            result.page_number for result in page_results if not result.succeeded
+        }
+        processed_page_numbers = set(pages_to_process) - failed_page_numbers
+        return IngestionReport(
+            pdf_filename=pdf_filename,
+            total_pages=total_pages,
+            processed_pages=len(processed_page_numbers),
+            reused_pages=len(
+                set(pages_to_copy) - set(pages_to_process) - failed_page_numbers
+            ),
+            page_results=page_results,
+            duration=time.perf_counter() - start,
+        )
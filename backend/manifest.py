@@ -0,0 +1,299 @@
+"""
+Ingestion manifest: which pages of which files are stored in the vectorstore.
+
+Kept in memory and mirrored to a JSON file next to the Chroma collection, so
+that the ingestion status of every file is known without querying Chroma.
+Each file records the content hash of the whole file and of each stored page,
+so that re-ingestion only processes the pages that changed, the number of
+chunks (vectors) stored for each page, and the number of pages of the file.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, List
+
+MANIFEST_FILENAME = "ingestion_manifest.json"
+
+
+def hash_content(content: bytes) -> str:
+    """Content hash used to identify files and pages."""
+    return hashlib.sha256(content).hexdigest()
+
+
+class IngestionManifest:
+    """The content hash of each file and of each of its stored pages."""
+
+    def __init__(self, path: Path):
+        """
+        Load the manifest from disk, empty if it does not exist yet.
+
+        Args:
+            path (Path): Path of the JSON file.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._file_hashes: dict[str, str | None] = {}
+        # Page hash (None if unknown) of each stored page number, by filename
+        self._page_hashes: dict[str, dict[int, str | None]] = {}
+        # Number of stored chunks of each stored page number, by filename
+        self._chunk_counts: dict[str, dict[int, int]] = {}
+        # Number of pages of each file, as read at its last ingestion
+        self._page_counts: dict[str, int] = {}
+        # Stored (filename, page number) of each known page hash
+        self._pages_by_hash: dict[str, tuple[str, int]] = {}
+        # Modification time of the file when last read or written by this process
+        self._disk_mtime_ns = self._get_disk_mtime_ns()
+        if self._path.exists():
+            try:
+                with self._path.open("r", encoding="utf-8") as f:
+                    files = json.load(f)["files"]
+                for filename, file_info in files.items():
+                    self._file_hashes[filename] = file_info.get("file_hash")
+                    if file_info.get("nb_pages") is not None:
+                        self._page_counts[filename] = int(file_info["nb_pages"])
+                    if len(file_info["pages"]) == 0:
+                        continue
+                    self._set_pages(
+                        filename,
+                        {
+                            int(page_number): page_hash
+                            for page_number, page_hash in file_info["pages"].items()
+                        },
+                        {
+                            # Pages stored before chunking were a single vector
+                            int(page_number): file_info.get("chunks", {}).get(
+                                page_number, 1
+                            )
+                            for page_number in file_info["pages"]
+                        },
+                    )
+            except (ValueError, KeyError, TypeError, AttributeError):
+                print(f"---INVALID MANIFEST {self._path}, IGNORED---")
+                self._reset()
+
+    def is_modified_on_disk(self) -> bool:
+        """Whether another process rewrote the file since it was loaded."""
+        with self._lock:
+            return self._get_disk_mtime_ns() != self._disk_mtime_ns
+
+    def __len__(self) -> int:
+        """Total number of stored pages."""
+        with self._lock:
+            return sum(len(pages) for pages in self._page_hashes.values())
+
+    def get_nb_chunks(self) -> int:
+        """Total number of stored chunks, i.e. of vectors in the collection."""
+        with self._lock:
+            return sum(sum(pages.values()) for pages in self._chunk_counts.values())
+
+    def get_stored_pages(
+        self, pdf_filenames: List[str] | None = None
+    ) -> dict[str, set[int]]:
+        """Stored page numbers of each file.
+
+        Args:
+            pdf_filenames (List[str] | None): Files to look up, all files if None.
+
+        Returns:
+            dict[str, set[int]]: Page numbers by filename, empty for unknown files.
+        """
+        with self._lock:
+            if pdf_filenames is None:
+                pdf_filenames = list(self._page_hashes)
+            return {
+                filename: set(self._page_hashes.get(filename, ()))
+                for filename in pdf_filenames
+            }
+
+    def get_fingerprint(self) -> str:
+        """Hash of the stored corpus: every page, its content hash and its
+        number of chunks. Changes whenever a page is added, removed or stored
+        again differently."""
+        with self._lock:
+            corpus = {
+                filename: [
+                    [page_number, page_hash, self._chunk_counts[filename][page_number]]
+                    for page_number, page_hash in sorted(pages.items())
+                ]
+                for filename, pages in sorted(self._page_hashes.items())
+            }
+        return hash_content(json.dumps(corpus).encode("utf-8"))
+
+    def get_ingestion_status(
+        self, pdf_filenames: List[str] | None = None
+    ) -> dict[str, tuple[int, int | None]]:
+        """Number of stored pages and of pages of each file, in a single read.
+
+        Args:
+            pdf_filenames (List[str] | None): Files to look up, all files if None.
+
+        Returns:
+            dict[str, tuple[int, int | None]]: By filename, the number of stored
+            pages and the number of pages of the file, None if unknown.
+        """
+        with self._lock:
+            if pdf_filenames is None:
+                pdf_filenames = list(self._page_hashes.keys() | self._page_counts)
+            return {
+                filename: (
+                    len(self._page_hashes.get(filename, ())),
+                    self._page_counts.get(filename),
+                )
+                for filename in pdf_filenames
+            }
+
+    def set_page_count(self, pdf_filename: str, nb_pages: int) -> None:
+        """Record the number of pages of a file."""
+        with self._lock:
+            if self._page_counts.get(pdf_filename) != nb_pages:
+                self._page_counts[pdf_filename] = nb_pages
+                self._save()
+
+    def get_page_hashes(self, pdf_filename: str) -> dict[int, str | None]:
+        """Content hash of each stored page of a file, None when unknown."""
+        with self._lock:
+            return dict(self._page_hashes.get(pdf_filename, {}))
+
+    def get_file_hash(self, pdf_filename: str) -> str | None:
+        with self._lock:
+            return self._file_hashes.get(pdf_filename)
+
+    def set_file_hash(self, pdf_filename: str, file_hash: str) -> None:
+        """Record the hash of a file once all its pages are stored."""
+        with self._lock:
+            self._file_hashes[pdf_filename] = file_hash
+            self._save()
+
+    def find_page(self, page_hash: str) -> tuple[str, int] | None:
+        """Find a stored page with the given content, in any file.
+
+        Returns:
+            tuple[str, int] | None: (filename, page number) of the page, if any.
+        """
+        with self._lock:
+            return self._pages_by_hash.get(page_hash)
+
+    def is_page_stored(self, pdf_filename: str, page_number: int) -> bool:
+        with self._lock:
+            return page_number in self._page_hashes.get(pdf_filename, ())
+
+    def add_pages(self, pages: Iterable[tuple[str, int, str | None, int]]) -> None:
+        """Record stored pages. The file hash is reset until `set_file_hash`.
+
+        Args:
+            pages (Iterable[tuple[str, int, str | None, int]]): (filename, page
+                number, page hash, number of chunks) tuples.
+        """
+        with self._lock:
+            for filename, page_number, page_hash, nb_chunks in pages:
+                self._remove_page(filename, page_number)
+                self._add_page(filename, page_number, page_hash, nb_chunks)
+            self._save()
+
+    def remove_pages(self, pdf_filename: str, page_numbers: Iterable[int]) -> None:
+        with self._lock:
+            for page_number in page_numbers:
+                self._remove_page(pdf_filename, page_number)
+            self._save()
+
+    def remove_file(self, pdf_filename: str) -> None:
+        with self._lock:
+            for page_number in list(self._page_hashes.get(pdf_filename, ())):
+                self._remove_page(pdf_filename, page_number)
+            self._page_hashes.pop(pdf_filename, None)
+            self._chunk_counts.pop(pdf_filename, None)
+            self._file_hashes.pop(pdf_filename, None)
+            self._page_counts.pop(pdf_filename, None)
+            self._save()
+
+    def rebuild(self, pages: Iterable[tuple[str, int, str | None, int]]) -> None:
+        """Replace the manifest content, e.g. from the vectorstore metadata.
+
+        Args:
+            pages (Iterable[tuple[str, int, str | None, int]]): (filename, page
+                number, page hash, number of chunks) tuples.
+        """
+        with self._lock:
+            # The page counts are not in the vectorstore, they are kept
+            page_counts = self._page_counts
+            self._reset()
+            for filename, page_number, page_hash, nb_chunks in pages:
+                self._add_page(filename, page_number, page_hash, nb_chunks)
+            self._page_counts = {
+                filename: nb_pages
+                for filename, nb_pages in page_counts.items()
+                if filename in self._page_hashes
+            }
+            self._save()
+
+    def _reset(self) -> None:
+        self._file_hashes, self._page_hashes, self._pages_by_hash = {}, {}, {}
+        self._chunk_counts, self._page_counts = {}, {}
+
+    def _set_pages(
+        self,
+        pdf_filename: str,
+        page_hashes: dict[int, str | None],
+        chunk_counts: dict[int, int],
+    ):
+        self._page_hashes[pdf_filename] = page_hashes
+        self._chunk_counts[pdf_filename] = chunk_counts
+        for page_number, page_hash in page_hashes.items():
+            if page_hash is not None:
+                self._pages_by_hash[page_hash] = (pdf_filename, page_number)
+
+    def _add_page(
+        self, pdf_filename: str, page_number: int, page_hash: str | None, nb_chunks: int
+    ) -> None:
+        self._page_hashes.setdefault(pdf_filename, {})[page_number] = page_hash
+        self._chunk_counts.setdefault(pdf_filename, {})[page_number] = nb_chunks
+        self._file_hashes[pdf_filename] = None
+        if page_hash is not None:
+            self._pages_by_hash[page_hash] = (pdf_filename, page_number)
+
+    def _remove_page(self, pdf_filename: str, page_number: int) -> None:
+        self._chunk_counts.get(pdf_filename, {}).pop(page_number, None)
+        page_hash = self._page_hashes.get(pdf_filename, {}).pop(page_number, None)
+        if self._pages_by_hash.get(page_hash) == (pdf_filename, page_number):
+            del self._pages_by_hash[page_hash]
+
+    def _save(self) -> None:
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "files": {
+                        filename: {
+                            "file_hash": self._file_hashes.get(filename),
+                            "nb_pages": self._page_counts.get(filename),
+                            "pages": {
+                                str(page_number): page_hash
+                                for page_number, page_hash in sorted(
+                                    self._page_hashes.get(filename, {}).items()
+                                )
+                            },
+                            "chunks": {
+                                str(page_number): nb_chunks
+                                for page_number, nb_chunks in sorted(
+                                    self._chunk_counts.get(filename, {}).items()
+                                )
+                            },
+                        }
+                        # Files counted but without stored pages are kept too
+                        for filename in self._page_hashes.keys() | self._page_counts
+                    }
+                },
+                f,
+            )
+        os.replace(tmp_path, self._path)
+        self._disk_mtime_ns = self._get_disk_mtime_ns()
+
+    def _get_disk_mtime_ns(self) -> int | None:
+        try:
+            return self._path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
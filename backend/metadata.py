@@ -0,0 +1,101 @@
+"""
+Structured metadata of the stored reports and query-side filters on it.
+
+The company and report year of a page come from its file name (e.g.
+"TotalEnergies_URD_2023.pdf"), so that they can be matched against the
+questions mentioning them.
+"""
+
+import re
+import unicodedata
+from pathlib import Path
+from typing import Iterable, List
+
+UNKNOWN_REPORT_YEAR = 0
+
+_YEAR_PATTERN = re.compile(r"(?<!\d)(20\d{2}|19\d{2})(?!\d)")
+
+# Words of report file names that do not belong to the company name
+_REPORT_WORDS = frozenset(
+    "rapport rapports annuel annuels annual report reports integre integrated "
+    "financier financial document documents enregistrement universel urd deu "
+    "dev ddr registration universal exercice fy rse dpef esg final vf fr en".split()
+)
+
+
+def normalize(text: str) -> str:
+    """Lowercase ASCII words of a text, separated by single spaces."""
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def extract_file_metadata(pdf_filename: str) -> dict[str, str | int]:
+    """Company and report year of a report, from its file name.
+
+    Args:
+        pdf_filename (str): The name of the PDF file.
+
+    Returns:
+        dict[str, str | int]: `company` (normalized, empty if unknown) and
+        `report_year` (UNKNOWN_REPORT_YEAR if unknown).
+    """
+    stem = Path(pdf_filename).stem
+    years = _YEAR_PATTERN.findall(stem)
+    words = [
+        word
+        for word in normalize(_YEAR_PATTERN.sub(" ", stem)).split()
+        if word not in _REPORT_WORDS and not word.isdigit()
+    ]
+    return {
+        "company": " ".join(words),
+        "report_year": int(years[-1]) if years else UNKNOWN_REPORT_YEAR,
+    }
+
+
+def extract_query_filter(
+    question: str, companies: Iterable[str], report_years: Iterable[int]
+) -> dict | None:
+    """Build a Chroma `where` clause from the companies and years a question names.
+
+    Only the companies and years of stored reports are looked for. Pages of
+    reports with an unknown year are kept by year filters.
+
+    Args:
+        question (str): The user question.
+        companies (Iterable[str]): Normalized companies of the stored reports.
+        report_years (Iterable[int]): Years of the stored reports.
+
+    Returns:
+        dict | None: The `where` clause, None if the question names none.
+    """
+    normalized_question = f" {normalize(question)} "
+    named_companies = sorted(
+        company
+        for company in set(companies)
+        if company and f" {company} " in normalized_question
+    )
+    question_years = {int(year) for year in _YEAR_PATTERN.findall(question)}
+    named_years = sorted(question_years & set(report_years))
+
+    conditions: List[dict] = []
+    if named_companies:
+        conditions.append({"company": {"$in": named_companies}})
+    if named_years:
+        conditions.append({"report_year": {"$in": named_years + [UNKNOWN_REPORT_YEAR]}})
+
+    if len(conditions) == 0:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def matches_filter(metadata: dict, where: dict | None) -> bool:
+    """Evaluate a `where` clause built by `extract_query_filter` on metadata."""
+    if where is None:
+        return True
+    if "$and" in where:
+        return all(matches_filter(metadata, condition) for condition in where["$and"])
+    return all(
+        metadata.get(key) in condition["$in"] for key, condition in where.items()
+    )
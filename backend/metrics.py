@@ -0,0 +1,313 @@
+"""
+In-process metrics of the chat graph.
+
+Durations and token counts are aggregated into histograms as they are
+recorded: recording is a lock and a bisect, and nothing is formatted or
+written until the metrics are exported, in the Prometheus text format or as
+JSON. Gauges hold the last value set.
+
+Recorded metrics:
+    node_duration_seconds{node}               Wall time of each graph node
+    llm_duration_seconds{role,method}         Latency of each chat model call
+    llm_prompt_tokens{role}                   Prompt tokens of each call
+    llm_completion_tokens{role}               Completion tokens of each call
+    retrieval_stage_duration_seconds{stage}   Filter, dense, sparse, fusion,
+                                              expansion and total retrieval
+    embedding_duration_seconds{operation}     Embedding model calls (cache misses)
+    embedding_batch_size{operation}           Texts sent per embedding call
+    rate_limiter_wait_seconds{limiter,priority}
+                                              Wait for the rate limiter budgets
+    rate_limiter_retry_backoff_seconds{limiter,reason}
+                                              Backoff before each retried call
+    rate_limiter_queue_depth{limiter,priority}
+                                              Calls waiting for the budgets (gauge)
+"""
+
+import asyncio
+import functools
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Sequence
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true") == "true"
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+METRIC_BUCKETS = {
+    "node_duration_seconds": DURATION_BUCKETS,
+    "llm_duration_seconds": DURATION_BUCKETS,
+    "llm_prompt_tokens": TOKEN_BUCKETS,
+    "llm_completion_tokens": TOKEN_BUCKETS,
+    "retrieval_stage_duration_seconds": DURATION_BUCKETS,
+    "embedding_duration_seconds": DURATION_BUCKETS,
+    "embedding_batch_size": SIZE_BUCKETS,
+    "rate_limiter_wait_seconds": DURATION_BUCKETS,
+    "rate_limiter_retry_backoff_seconds": DURATION_BUCKETS,
+}
+
+# Label names and values of a series, in a hashable form
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum."""
+
+    def __init__(self, buckets: Sequence[float], keep_samples: bool = False):
+        """
+        Args:
+            buckets (Sequence[float]): Sorted upper bounds of the buckets, an
+                overflow bucket is added after the last one.
+            keep_samples (bool): Also keep every observation, for exact quantiles.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples: List[float] | None = [] if keep_samples else None
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.samples is not None:
+            self.samples.append(value)
+
+    def quantile(self, q: float) -> float:
+        """Compute a quantile from the kept observations, else estimate it by
+        linear interpolation within its bucket.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The quantile. Estimated as the last bound if it falls in the
+            overflow bucket.
+        """
+        if self.count == 0:
+            return math.nan
+        if self.samples is not None:
+            samples = sorted(self.samples)
+            position = q * (len(samples) - 1)
+            lower = math.floor(position)
+            upper = min(lower + 1, len(samples) - 1)
+            return samples[lower] + (samples[upper] - samples[lower]) * (
+                position - lower
+            )
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count > 0 and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """Histograms and gauges by metric name and labels, safe to record from any
+    thread."""
+
+    def __init__(self, enabled: bool = METRICS_ENABLED, keep_samples: bool = False):
+        """
+        Args:
+            enabled (bool): Record the observations, else drop them.
+            keep_samples (bool): Keep every observation of the series created
+                from now on, for exact quantiles. Memory grows with the number
+                of observations, so it is meant for benchmarks.
+        """
+        self.enabled = enabled
+        self.keep_samples = keep_samples
+        self._histograms: dict[str, dict[Labels, Histogram]] = {}
+        self._gauges: dict[str, dict[Labels, float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Record an observation.
+
+        Args:
+            name (str): The metric name, see `METRIC_BUCKETS` for its buckets.
+            value (float): The observed value.
+            **labels (str): The labels of the series.
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(
+                    METRIC_BUCKETS.get(name, DURATION_BUCKETS), self.keep_samples
+                )
+            histogram.observe(value)
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set the current value of a gauge.
+
+        Args:
+            name (str): The metric name.
+            value (float): The current value.
+            **labels (str): The labels of the series.
+        """
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """Record the duration of a block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
+            self._gauges = {}
+
+    def to_json(self) -> dict:
+        """Summarize every series.
+
+        Returns:
+            dict: By metric name, a list of series with their labels, and
+            either their count, sum, mean and p50/p95/p99 (estimated unless the
+            samples are kept), or the value of a gauge.
+        """
+        with self._lock:
+            summary = {
+                name: [
+                    {
+                        "labels": dict(labels),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count,
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                        "p99": histogram.quantile(0.99),
+                    }
+                    for labels, histogram in sorted(series.items())
+                ]
+                for name, series in sorted(self._histograms.items())
+            }
+            for name, series in sorted(self._gauges.items()):
+                summary[name] = [
+                    {"labels": dict(labels), "value": value}
+                    for labels, value in sorted(series.items())
+                ]
+            return dict(sorted(summary.items()))
+
+    def to_prometheus(self) -> str:
+        """Export every series in the Prometheus text exposition format.
+
+        Returns:
+            str: The histograms, with their cumulative buckets, sum and count,
+            and the gauges.
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(
+                        [*histogram.buckets, math.inf], histogram.counts
+                    ):
+                        cumulative += count
+                        bucket_labels = _format_labels(
+                            (*labels, ("le", _format_bound(bound)))
+                        )
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(
+                        f"{name}_count{_format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Write the JSON summary of the metrics to a file."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+def _format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
+
+
+def timed_node(name: str) -> Callable[[Callable], Callable]:
+    """Record the wall time of a graph node, sync or async.
+
+    The signature of the node is kept, so that the graph still passes it the
+    config when it asks for one.
+
+    Args:
+        name (str): The node name, the "node" label of the series.
+
+    Returns:
+        Callable[[Callable], Callable]: The decorator.
+    """
+
+    def decorator(node: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(node):
+
+            @functools.wraps(node)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.time("node_duration_seconds", node=name):
+                    return await node(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(node)
+        def wrapper(*args, **kwargs):
+            with metrics.time("node_duration_seconds", node=name):
+                return node(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
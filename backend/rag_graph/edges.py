@@ -1,8 +1,30 @@
 """Each edge routes between nodes in the graph."""
 
-from backend.chat_models.llms import router, hallucination_grader, answer_grader
+import os
+from typing import List
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig
+
+from backend.chat_models.llms import (
+    LLM,
+    router,
+    hallucination_grader,
+    answer_grader,
+    generation_grader,
+    explained_generation_grader,
+)
+from backend.context_packer import pack_context
 from backend.rag_graph.state import State
 
+# Grading of the generation: "sequential" (hallucination then answer grader) or
+# "combined" (both verdicts from a single call)
+GENERATION_GRADING_MODE = os.getenv("GENERATION_GRADING_MODE", "sequential")
+# Ask the combined grader to explain its verdicts
+GENERATION_GRADING_EXPLANATIONS = (
+    os.getenv("GENERATION_GRADING_EXPLANATIONS", "false") == "true"
+)
+
 
 def route_question(state: State):
     """
@@ -46,25 +68,52 @@ def decide_to_generate(state: State):
         return "generate"
 
 
-def grade_generation_v_documents_and_question(state: State):
+def decide_speculative_route(state: State):
+    """
+    Continue from the speculative routing node with the branch it kept
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        str: "retrieved", "web_searched" or "websearch" (not fetched yet)
+    """
+    return state["route"]
+
+
+def grade_generation_v_documents_and_question(
+    state: State, config: RunnableConfig | None = None
+):
     """
     Determines whether the generation is grounded in the document and answers question
 
+    The two verdicts come from two grader calls in sequence, or from a single
+    call when `generation_grading_mode` is "combined" (`config["configurable"]`)
+
     Args:
         state (dict): The current graph state
+        config (RunnableConfig | None): The graph config
 
     Returns:
         str: Decision for next node to call
     """
-
-    print("---CHECK HALLUCINATIONS---")
     question = state["question"]
     documents = state["documents"]
     generation = state["generation"]
     max_retries = state.get("max_retries", 3)  # Default to 3 if not provided
 
+    if _get_generation_grading_mode(config) == "combined":
+        print("---GRADE GENERATION vs DOCUMENTS AND QUESTION---")
+        grader = _get_combined_generation_grader(config)
+        result = grader.invoke(
+            inputs=get_combined_grading_inputs(question, documents, generation)
+        )
+        return _decide_on_combined_grades(result, state["loop_step"], max_retries)
+
+    print("---CHECK HALLUCINATIONS---")
+
     result = hallucination_grader.invoke(
-        inputs={"documents": documents, "generation": generation}
+        inputs=get_hallucination_grading_inputs(documents, generation)
     )
     print(f"---EXPLANATION: {result['explanation']}---")
 
@@ -78,19 +127,141 @@ def grade_generation_v_documents_and_question(state: State):
         answer_grader_result = answer_grader.invoke(
             inputs={"question": question, "generation": generation}
         )
-        grade = answer_grader_result["binary_score"]
-        if grade == "yes":
-            print("---DECISION: GENERATION ADDRESSES QUESTION---")
-            return "useful"
-        elif state["loop_step"] <= max_retries:
-            print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
-            return "not useful"
-        else:
-            print("---DECISION: MAX RETRIES REACHED---")
-            return "max retries"
-    elif state["loop_step"] <= max_retries:
+        return _decide_on_answer_grade(
+            answer_grader_result["binary_score"], state["loop_step"], max_retries
+        )
+    return _decide_on_ungrounded_generation(state["loop_step"], max_retries)
+
+
+def _get_generation_grading_mode(config: RunnableConfig | None) -> str:
+    configurable = (config or {}).get("configurable") or {}
+    return configurable.get("generation_grading_mode", GENERATION_GRADING_MODE)
+
+
+def _get_combined_generation_grader(config: RunnableConfig | None) -> LLM:
+    configurable = (config or {}).get("configurable") or {}
+    with_explanation = configurable.get(
+        "generation_grading_explanations", GENERATION_GRADING_EXPLANATIONS
+    )
+    return explained_generation_grader if with_explanation else generation_grader
+
+
+def get_combined_grading_inputs(
+    question: str, documents: List[Document], generation: str
+) -> dict[str, str]:
+    """Prompt inputs of the combined generation grader, the documents packed
+    in its context window."""
+    packed_context = pack_context(documents, generation_grader.model_name)
+    return {
+        "documents": packed_context.text,
+        "question": question,
+        "generation": generation,
+    }
+
+
+def _decide_on_combined_grades(result: dict, loop_step: int, max_retries: int) -> str:
+    if "explanation" in result:
+        print(f"---EXPLANATION: {result['explanation']}---")
+    if result.get("grounded") == "yes":
+        print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
+        return _decide_on_answer_grade(
+            result.get("answers_question"), loop_step, max_retries
+        )
+    return _decide_on_ungrounded_generation(loop_step, max_retries)
+
+
+def get_hallucination_grading_inputs(
+    documents: List[Document], generation: str
+) -> dict[str, str]:
+    """Prompt inputs of the hallucination grader, the documents packed in its
+    context window."""
+    packed_context = pack_context(documents, hallucination_grader.model_name)
+    return {"documents": packed_context.text, "generation": generation}
+
+
+def _decide_on_answer_grade(grade: str, loop_step: int, max_retries: int) -> str:
+    if grade == "yes":
+        print("---DECISION: GENERATION ADDRESSES QUESTION---")
+        return "useful"
+    elif loop_step <= max_retries:
+        print("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
+        return "not useful"
+    else:
+        print("---DECISION: MAX RETRIES REACHED---")
+        return "max retries"
+
+
+def _decide_on_ungrounded_generation(loop_step: int, max_retries: int) -> str:
+    if loop_step <= max_retries:
         print("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
         return "not supported"
     else:
         print("---DECISION: MAX RETRIES REACHED---")
         return "max retries"
+
+
+# ASYNC EDGES
+# Same edges for the graph run with `ainvoke` / `astream`, awaiting the LLM calls
+
+
+async def aroute_question(state: State):
+    """
+    Route question to web search or RAG, see `route_question`
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        str: Next node to call
+    """
+
+    print("---ROUTE QUESTION---")
+    result = await router.ainvoke(inputs={"question": state["question"]})
+    print(f"RESULT: {result}")
+    return result["relevant"]
+
+
+async def agrade_generation_v_documents_and_question(
+    state: State, config: RunnableConfig | None = None
+):
+    """
+    Determines whether the generation is grounded in the document and answers
+    question, see `grade_generation_v_documents_and_question`
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig | None): The graph config
+
+    Returns:
+        str: Decision for next node to call
+    """
+    question = state["question"]
+    documents = state["documents"]
+    generation = state["generation"]
+    max_retries = state.get("max_retries", 3)  # Default to 3 if not provided
+
+    if _get_generation_grading_mode(config) == "combined":
+        print("---GRADE GENERATION vs DOCUMENTS AND QUESTION---")
+        grader = _get_combined_generation_grader(config)
+        result = await grader.ainvoke(
+            inputs=get_combined_grading_inputs(question, documents, generation)
+        )
+        return _decide_on_combined_grades(result, state["loop_step"], max_retries)
+
+    print("---CHECK HALLUCINATIONS---")
+
+    result = await hallucination_grader.ainvoke(
+        inputs=get_hallucination_grading_inputs(documents, generation)
+    )
+    print(f"---EXPLANATION: {result['explanation']}---")
+
+    if result["binary_score"] == "yes":
+        print("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
+        print("---GRADE GENERATION vs QUESTION---")
+        answer_grader_result = await answer_grader.ainvoke(
+            inputs={"question": question, "generation": generation}
+        )
+        return _decide_on_answer_grade(
+            answer_grader_result["binary_score"], state["loop_step"], max_retries
+        )
+    return _decide_on_ungrounded_generation(state["loop_step"], max_retries)
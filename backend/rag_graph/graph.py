@@ -5,80 +5,167 @@ from backend.rag_graph.edges import (
     route_question,
     decide_to_generate,
     grade_generation_v_documents_and_question,
+    aroute_question,
+    agrade_generation_v_documents_and_question,
+    decide_speculative_route,
 )
 from backend.rag_graph.state import State
+from backend.reranker import RERANK
 from backend.rag_graph.nodes import (
     web_search,
     retrieve,
     grade_documents,
     generate,
+    rerank,
     rewrite,
     generate_question_not_relevant,
-    # generate_question_not_relevant,
+    aweb_search,
+    aretrieve,
+    agrade_documents,
+    agenerate,
+    arerank,
+    arewrite,
+    route_and_retrieve,
+    aroute_and_retrieve,
+    SPECULATIVE_ROUTING,
 )
 
-workflow = StateGraph(State)
 
-# Define the nodes
-workflow.add_node("websearch", web_search)  # web search
-workflow.add_node("retrieve", retrieve)  # retrieve
-workflow.add_node("grade_documents", grade_documents)  # grade documents
-workflow.add_node("generate", generate)  # generate
+def build_workflow(
+    asynchronous: bool = False, speculative_routing: bool = SPECULATIVE_ROUTING
+) -> StateGraph:
+    """
+    Build the full graph: routing, grading of the documents and of the answer
+
+    With speculative routing, the routing call and the retrieval run in the
+    same entry node instead of one after the other
+
+    Args:
+        asynchronous (bool): Use the async nodes and edges, for a graph run with
+            `ainvoke` / `astream`
+        speculative_routing (bool): Route and retrieve in the same entry node,
+            `SPECULATIVE_ROUTING` by default
+
+    Returns:
+        StateGraph: The graph, to be compiled
+    """
+    workflow = StateGraph(State)
+
+    # Define the nodes
+    workflow.add_node("websearch", aweb_search if asynchronous else web_search)
+    workflow.add_node("retrieve", aretrieve if asynchronous else retrieve)
+    workflow.add_node(
+        "grade_documents", agrade_documents if asynchronous else grade_documents
+    )
+    workflow.add_node("generate", agenerate if asynchronous else generate)
+    if RERANK:
+        workflow.add_node("rerank", arerank if asynchronous else rerank)
+
+    # Build graph
+    if speculative_routing:
+        workflow.add_node(
+            "route_and_retrieve",
+            aroute_and_retrieve if asynchronous else route_and_retrieve,
+        )
+        workflow.set_entry_point("route_and_retrieve")
+        workflow.add_conditional_edges(
+            "route_and_retrieve",
+            decide_speculative_route,
+            {
+                "retrieved": "rerank" if RERANK else "grade_documents",
+                "web_searched": "generate",
+                "websearch": "websearch",
+            },
+        )
+    else:
+        workflow.set_conditional_entry_point(
+            aroute_question if asynchronous else route_question,
+            {
+                "websearch": "websearch",
+                "vectorstore": "retrieve",
+            },
+        )
+    workflow.add_edge("websearch", "generate")
+    if RERANK:
+        workflow.add_edge("retrieve", "rerank")
+        workflow.add_edge("rerank", "grade_documents")
+    else:
+        workflow.add_edge("retrieve", "grade_documents")
+    workflow.add_conditional_edges(
+        "grade_documents",
+        decide_to_generate,
+        {
+            "websearch": "websearch",
+            "generate": "generate",
+        },
+    )
+    workflow.add_conditional_edges(
+        "generate",
+        (
+            agrade_generation_v_documents_and_question
+            if asynchronous
+            else grade_generation_v_documents_and_question
+        ),
+        {
+            "not supported": "generate",
+            "useful": END,
+            "not useful": "websearch",
+            "max retries": END,
+        },
+    )
+    return workflow
 
-# Build graph
-workflow.set_conditional_entry_point(
-    route_question,
-    {
-        "websearch": "websearch",
-        "vectorstore": "retrieve",
-    },
-)
-workflow.add_edge("websearch", "generate")
-workflow.add_edge("retrieve", "grade_documents")
-workflow.add_conditional_edges(
-    "grade_documents",
-    decide_to_generate,
-    {
-        "websearch": "websearch",
-        "generate": "generate",
-    },
-)
-workflow.add_conditional_edges(
-    "generate",
-    grade_generation_v_documents_and_question,
-    {
-        "not supported": "generate",
-        "useful": END,
-        "not useful": "websearch",
-        "max retries": END,
-    },
-)
 
 # SIMPLE GRAPH
 
-simple_workflow = StateGraph(State)
 
-# simple_workflow.set_entry_point("retrieve")
+def build_simple_workflow(asynchronous: bool = False) -> StateGraph:
+    """
+    Build the simple graph: retrieve, rewrite the question and generate
+
+    Args:
+        asynchronous (bool): Use the async nodes, for a graph run with
+            `ainvoke` / `astream`
+
+    Returns:
+        StateGraph: The graph, to be compiled
+    """
+    simple_workflow = StateGraph(State)
+
+    # simple_workflow.set_entry_point("retrieve")
+
+    simple_workflow.add_node("retrieve", aretrieve if asynchronous else retrieve)
+    simple_workflow.add_node("rewrite", arewrite if asynchronous else rewrite)
+    simple_workflow.add_node("generate", agenerate if asynchronous else generate)
+    simple_workflow.add_node("question_not_relevant", generate_question_not_relevant)
+    if RERANK:
+        simple_workflow.add_node("rerank", arerank if asynchronous else rerank)
+
+    # Build graph
+    # simple_workflow.set_conditional_entry_point(
+    #     route_question,
+    #     {
+    #         "yes": "retrieve",
+    #         "no": "question_not_relevant",
+    #     },
+    # )
+    simple_workflow.set_entry_point("retrieve")
 
-simple_workflow.add_node("retrieve", retrieve)
-simple_workflow.add_node("rewrite", rewrite)
-simple_workflow.add_node("generate", generate)
-simple_workflow.add_node("question_not_relevant", generate_question_not_relevant)
+    if RERANK:
+        simple_workflow.add_edge("retrieve", "rerank")
+        simple_workflow.add_edge("rerank", "rewrite")
+    else:
+        simple_workflow.add_edge("retrieve", "rewrite")
+    simple_workflow.add_edge("rewrite", "generate")
+    simple_workflow.add_edge("generate", END)
+    simple_workflow.add_edge("question_not_relevant", END)
+    return simple_workflow
 
-# Build graph
-# simple_workflow.set_conditional_entry_point(
-#     route_question,
-#     {
-#         "yes": "retrieve",
-#         "no": "question_not_relevant",
-#     },
-# )
-simple_workflow.set_entry_point("retrieve")
 
-simple_workflow.add_edge("retrieve", "rewrite")
-simple_workflow.add_edge("rewrite", "generate")
-simple_workflow.add_edge("generate", END)
-simple_workflow.add_edge("question_not_relevant", END)
+workflow = build_workflow()
+simple_workflow = build_simple_workflow()
 
 # Compile
 graph = simple_workflow.compile()
+# Same graph with async nodes, to serve many questions from one event loop
+async_graph = build_simple_workflow(asynchronous=True).compile()
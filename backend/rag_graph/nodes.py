@@ -5,21 +5,66 @@ Each node in our graph is simply a function that:
 (3) Write the modified state to the state schema (dict)
 """
 
+import asyncio
+import os
+from typing import List
+
 from langchain.schema import Document
 from langchain_community.tools.tavily_search import TavilySearchResults
-
-from backend.chat_models.llms import rag_model, retrieval_grader, rewriter
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from langgraph.config import get_stream_writer
+
+from backend.chat_models.llms import (
+    batch_retrieval_grader,
+    rag_model,
+    retrieval_grader,
+    rewriter,
+    router,
+)
+from backend.context_packer import get_context_token_budget, pack_context
+from backend.metrics import timed_node
 from backend.rag_graph.state import State
-from backend.utils import format_documents
-from backend.vectorstore import MultiModalVectorstore
+from backend.reranker import RERANK, RERANK_TOP_N, Reranker, get_reranker
+from backend.vectorstore import RETRIEVAL_K, MultiModalVectorstore, get_vectorstore
+
+# Grading of retrieved documents: "concurrent" (one call per document) or "batch"
+GRADING_MODE = os.getenv("GRADING_MODE", "concurrent")
+GRADING_MAX_CONCURRENCY = int(os.getenv("GRADING_MAX_CONCURRENCY", 4))
+# Start the retrieval (and optionally the web search) along with the routing call
+# of the full graph, discarding the branch the router does not pick
+SPECULATIVE_ROUTING = os.getenv("SPECULATIVE_ROUTING", "false") == "true"
+SPECULATIVE_WEB_SEARCH = os.getenv("SPECULATIVE_WEB_SEARCH", "false") == "true"
+# Source ID of the document holding the web search results
+WEB_SEARCH_DOCUMENT_ID = "web"
+
+
+def _get_db(config: RunnableConfig | None) -> MultiModalVectorstore:
+    """
+    Vectorstore injected through `config["configurable"]["vectorstore"]`,
+    or the process-wide one when none is given
+
+    Args:
+        config (RunnableConfig | None): The runnable config of the graph
+
+    Returns:
+        MultiModalVectorstore: The vectorstore to query
+    """
+    db = ((config or {}).get("configurable") or {}).get("vectorstore")
+    return db or get_vectorstore()
 
 
-def retrieve(state: State):
+@timed_node("retrieve")
+def retrieve(state: State, config: RunnableConfig):
     """
     Retrieve documents from vectorstore
 
+    When reranking is enabled, the `rerank_top_n` (`config["configurable"]`)
+    best chunks are retrieved as is, to be reranked and expanded by `rerank`
+
     Args:
         state (dict): The current graph state
+        config (RunnableConfig): The graph config, may hold the vectorstore to use
 
     Returns:
         state (dict): New key added to state, documents, that contains retrieved documents
@@ -27,13 +72,46 @@ def retrieve(state: State):
     print("---RETRIEVE---")
     question = state["question"]
 
-    # Open Database
-    db = MultiModalVectorstore()
+    # Shared database handle
+    db = _get_db(config)
     # Write retrieved documents to documents key in state
-    documents = db.retrieve_documents(question)
+    documents = db.retrieve_documents(question, **_get_retrieval_kwargs(config))
     return {"documents": documents}
 
 
+def _get_retrieval_kwargs(config: RunnableConfig) -> dict:
+    """Retrieval arguments: chunks to be reranked, or pages when not reranking"""
+    if not RERANK:
+        return {}
+    configurable = config.get("configurable") or {}
+    return {"k": configurable.get("rerank_top_n", RERANK_TOP_N), "expand": False}
+
+
+@timed_node("rerank")
+def rerank(state: State, config: RunnableConfig):
+    """
+    Rerank the retrieved chunks, keep the best ones and expand them to pages
+
+    The reranker can be injected through `config["configurable"]["reranker"]`
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig): The graph config
+
+    Returns:
+        state (dict): Updates documents key with the best reranked documents
+    """
+    print("---RERANK---")
+    question = state["question"]
+    documents = state["documents"]
+    configurable = config.get("configurable") or {}
+    reranker: Reranker = configurable.get("reranker") or get_reranker()
+
+    best_chunks = reranker.rerank(question, documents, k=RETRIEVAL_K)
+    return {"documents": _get_db(config).expand_chunks(best_chunks)}
+
+
+@timed_node("rewrite")
 def rewrite(state: State):
     """
     Transform the query to produce a better question.
@@ -53,10 +131,16 @@ def rewrite(state: State):
     return {"question": new_question}
 
 
+@timed_node("generate")
 def generate(state: State):
     """
     Generate answer using RAG on retrieved documents
 
+    Tokens are emitted on the "custom" stream mode of the graph as they arrive,
+    as {"token": str, "loop_step": int, "kind": str} chunks, where kind is
+    "model" for the generated tokens and "decoration" for the restated question
+    and the sources around them
+
     Args:
         state (dict): The current graph state
 
@@ -67,23 +151,55 @@ def generate(state: State):
     question = state["question"]
     documents = state["documents"]
     loop_step = state.get("loop_step", 0)
+    stream_writer = get_stream_writer()
+
+    def emit(token: str, kind: str = "model") -> None:
+        stream_writer({"token": token, "loop_step": loop_step + 1, "kind": kind})
+
+    rewritten_question = get_rewritten_question_text(question)
+    emit(rewritten_question + "\n\n", kind="decoration")
+
+    # RAG generation, on a context bounded by the token budget of the model
+    packed_context = pack_context(documents, rag_model.model_name)
+    sources = _get_source_ids(packed_context.documents)
+    context = get_sources_text(sources)
+    tokens = []
+    for token in rag_model.stream(
+        {"context": packed_context.text, "question": question}
+    ):
+        tokens.append(token)
+        emit(token)
+    generation = "".join(tokens)
+    emit("\n\n" + context, kind="decoration")
 
-    rewritten_question = "Si je comprend bien votre question est :\n " + question
-
-    context = (
-        "Pour répondre a cette question je me suis aidé des documents :\n- "
-        + ",\n- ".join([doc.metadata["document_id"] for doc in documents])
-    )
-    # RAG generation
-    generation = rag_model.invoke(
-        {"context": format_documents(documents), "question": question}
-    )
     return {
         "generation": rewritten_question + "\n\n" + generation + "\n\n" + context,
+        "answer": generation,
+        "sources": sources,
         "loop_step": loop_step + 1,
+        "context_tokens": packed_context.nb_tokens,
     }
 
 
+def get_rewritten_question_text(question: str) -> str:
+    """The question restated before the answer."""
+    return "Si je comprend bien votre question est :\n " + question
+
+
+def get_sources_text(sources: List[str]) -> str:
+    """The source IDs listed after the answer."""
+    return "Pour répondre a cette question je me suis aidé des documents :\n- " + (
+        ",\n- ".join(sources)
+    )
+
+
+def _get_source_ids(documents: List[Document]) -> List[str]:
+    return [
+        doc.metadata.get("document_id", WEB_SEARCH_DOCUMENT_ID) for doc in documents
+    ]
+
+
+@timed_node("question_not_relevant")
 def generate_question_not_relevant(state: State):
     """
     Generate answer using RAG on retrieved documents
@@ -103,13 +219,19 @@ def generate_question_not_relevant(state: State):
     }
 
 
-def grade_documents(state: State):
+@timed_node("grade_documents")
+def grade_documents(state: State, config: RunnableConfig):
     """
     Determines whether the retrieved documents are relevant to the question
     If any document is not relevant, we will set a flag to run web search
 
+    Documents are graded concurrently, at most `grading_max_concurrency` at a time,
+    or all together in a single call when `grading_mode` is "batch". Both can be
+    set in `config["configurable"]`.
+
     Args:
         state (dict): The current graph state
+        config (RunnableConfig): The graph config
 
     Returns:
         state (dict): Filtered out irrelevant documents and updated web_search state
@@ -118,14 +240,32 @@ def grade_documents(state: State):
     print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state["question"]
     documents = state["documents"]
+    configurable = config.get("configurable") or {}
+    grading_mode = configurable.get("grading_mode", GRADING_MODE)
+
+    # Score each doc, grades are in the order of documents
+    grades = None
+    if grading_mode == "batch":
+        grades = _grade_documents_in_batch(question, documents)
+    if grades is None:
+        grades = _grade_documents_concurrently(
+            question,
+            documents,
+            configurable.get("grading_max_concurrency", GRADING_MAX_CONCURRENCY),
+        )
+    return _filter_graded_documents(documents, grades)
+
+
+def _filter_graded_documents(documents: List[Document], grades: List[str]) -> dict:
+    """
+    Keep the relevant documents, flagging a web search if any is not relevant
 
-    # Score each doc
+    Returns:
+        dict: The documents and web_search keys of the state
+    """
     filtered_documents = []
     web_search = "No"
-    for document in documents:
-        grade = retrieval_grader.invoke(
-            inputs={"document": document, "question": question}
-        )["binary_score"]
+    for document, grade in zip(documents, grades):
         # Document relevant
         if grade.lower() == "yes":
             print("---GRADE: DOCUMENT RELEVANT---")
@@ -140,6 +280,77 @@ def grade_documents(state: State):
     return {"documents": filtered_documents, "web_search": web_search}
 
 
+def _grade_documents_concurrently(
+    question: str, documents: List[Document], max_concurrency: int
+) -> List[str]:
+    """
+    Grade each document with its own grader call, running up to
+    `max_concurrency` calls at a time
+
+    Returns:
+        List[str]: The binary score of each document, in the order of documents
+    """
+    if len(documents) == 0:
+        return []
+
+    def grade(document: Document) -> str:
+        return retrieval_grader.invoke(inputs=_get_grading_inputs(question, document))[
+            "binary_score"
+        ]
+
+    max_workers = max(1, min(max_concurrency, len(documents)))
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(grade, documents))
+
+
+def _get_grading_inputs(question: str, document: Document) -> dict[str, str]:
+    packed_context = pack_context([document], retrieval_grader.model_name)
+    return {"document": packed_context.text, "question": question}
+
+
+def _grade_documents_in_batch(
+    question: str, documents: List[Document]
+) -> List[str] | None:
+    """
+    Grade all documents in a single structured-JSON grader call
+
+    Returns:
+        List[str] | None: The binary score of each document, in the order of
+        documents, or None when the grader did not return one score per document
+    """
+    if len(documents) == 0:
+        return []
+
+    result = batch_retrieval_grader.invoke(
+        inputs=_get_batch_grading_inputs(question, documents)
+    )
+    return _get_batch_grades(result, documents)
+
+
+def _get_batch_grading_inputs(
+    question: str, documents: List[Document]
+) -> dict[str, str]:
+    # Each document gets its share of the budget, keeping one grade per document
+    token_budget = get_context_token_budget(batch_retrieval_grader.model_name) // len(
+        documents
+    )
+    numbered_documents = "\n\n".join(
+        f"Document {i + 1} :\n"
+        + pack_context([document], batch_retrieval_grader.model_name, token_budget).text
+        for i, document in enumerate(documents)
+    )
+    return {"documents": numbered_documents, "question": question}
+
+
+def _get_batch_grades(result: dict, documents: List[Document]) -> List[str] | None:
+    grades = result.get("binary_scores")
+    if not isinstance(grades, list) or len(grades) != len(documents):
+        print("---BATCH GRADING FAILED, GRADE EACH DOCUMENT---")
+        return None
+    return [str(grade) for grade in grades]
+
+
+@timed_node("websearch")
 def web_search(state: State):
     """
     Web search based on the question
@@ -156,9 +367,304 @@ def web_search(state: State):
     documents = state.get("documents", [])
 
     # Web search
+    documents.append(_search_web(question))
+    return {"documents": documents}
+
+
+def _search_web(question: str) -> Document:
     web_search_tool = TavilySearchResults(k=3)
     web_searched_documents = web_search_tool.invoke({"query": question})
+    return _get_web_document(web_searched_documents)
+
+
+async def _asearch_web(question: str) -> Document:
+    web_search_tool = TavilySearchResults(k=3)
+    web_searched_documents = await web_search_tool.ainvoke({"query": question})
+    return _get_web_document(web_searched_documents)
+
+
+def _get_web_document(web_searched_documents: List[dict]) -> Document:
     web_results = "\n".join([doc["content"] for doc in web_searched_documents])
-    web_results = Document(page_content=web_results)
-    documents.append(web_results)
+    return Document(
+        page_content=web_results, metadata={"document_id": WEB_SEARCH_DOCUMENT_ID}
+    )
+
+
+@timed_node("route_and_retrieve")
+def route_and_retrieve(state: State, config: RunnableConfig):
+    """
+    Route the question while speculatively retrieving documents
+
+    The retrieval, and the web search if `speculative_web_search`
+    (`config["configurable"]`), run while the router is called. The results
+    of the branch the router does not pick are discarded.
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig): The graph config, may hold the vectorstore to use
+
+    Returns:
+        state (dict): The route taken and the documents already fetched for it
+    """
+    print("---ROUTE QUESTION AND RETRIEVE---")
+    question = state["question"]
+    configurable = config.get("configurable") or {}
+    db = _get_db(config)
+
+    executor = ContextThreadPoolExecutor(max_workers=2)
+    try:
+        retrieval = executor.submit(
+            db.retrieve_documents, question, **_get_retrieval_kwargs(config)
+        )
+        speculative_web_search = (
+            executor.submit(_search_web, question)
+            if configurable.get("speculative_web_search", SPECULATIVE_WEB_SEARCH)
+            else None
+        )
+        route = router.invoke(inputs={"question": question})["relevant"]
+        print(f"RESULT: {route}")
+
+        if route == "websearch":
+            retrieval.cancel()
+            if speculative_web_search is None:
+                return {"documents": [], "route": "websearch"}
+            return {
+                "documents": [speculative_web_search.result()],
+                "route": "web_searched",
+            }
+        if speculative_web_search is not None:
+            speculative_web_search.cancel()
+        return {"documents": retrieval.result(), "route": "retrieved"}
+    finally:
+        # Do not wait for the discarded branch
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ASYNC NODES
+# Same nodes for the graph run with `ainvoke` / `astream`, where many questions
+# share one event loop: LLM calls are awaited, and the blocking vectorstore and
+# reranker calls run in worker threads.
+
+
+@timed_node("retrieve")
+async def aretrieve(state: State, config: RunnableConfig):
+    """
+    Retrieve documents from vectorstore, see `retrieve`
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig): The graph config, may hold the vectorstore to use
+
+    Returns:
+        state (dict): New key added to state, documents, that contains retrieved documents
+    """
+    print("---RETRIEVE---")
+    question = state["question"]
+
+    db = _get_db(config)
+    documents = await db.aretrieve_documents(question, **_get_retrieval_kwargs(config))
+    return {"documents": documents}
+
+
+@timed_node("rerank")
+async def arerank(state: State, config: RunnableConfig):
+    """
+    Rerank the retrieved chunks, see `rerank`
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig): The graph config
+
+    Returns:
+        state (dict): Updates documents key with the best reranked documents
+    """
+    print("---RERANK---")
+    question = state["question"]
+    documents = state["documents"]
+    configurable = config.get("configurable") or {}
+    reranker: Reranker = configurable.get("reranker") or get_reranker()
+
+    best_chunks = await asyncio.to_thread(
+        reranker.rerank, question, documents, RETRIEVAL_K
+    )
+    documents = await asyncio.to_thread(_get_db(config).expand_chunks, best_chunks)
+    return {"documents": documents}
+
+
+@timed_node("rewrite")
+async def arewrite(state: State):
+    """
+    Transform the query to produce a better question, see `rewrite`
+
+    Args:
+        state (messages): The current state
+
+    Returns:
+        dict: The updated state with re-phrased question
+    """
+    print("---REWRITE QUERY---")
+    question = state["question"]
+
+    new_question = await rewriter.ainvoke(inputs={"question": question})
+    return {"question": new_question}
+
+
+@timed_node("generate")
+async def agenerate(state: State):
+    """
+    Generate answer using RAG on retrieved documents, see `generate`
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): New key added to state, generation, that contains LLM generation
+    """
+    print("---GENERATE---")
+    question = state["question"]
+    documents = state["documents"]
+    loop_step = state.get("loop_step", 0)
+    stream_writer = get_stream_writer()
+
+    def emit(token: str, kind: str = "model") -> None:
+        stream_writer({"token": token, "loop_step": loop_step + 1, "kind": kind})
+
+    rewritten_question = get_rewritten_question_text(question)
+    emit(rewritten_question + "\n\n", kind="decoration")
+
+    packed_context = pack_context(documents, rag_model.model_name)
+    sources = _get_source_ids(packed_context.documents)
+    context = get_sources_text(sources)
+    tokens = []
+    async for token in rag_model.astream(
+        {"context": packed_context.text, "question": question}
+    ):
+        tokens.append(token)
+        emit(token)
+    generation = "".join(tokens)
+    emit("\n\n" + context, kind="decoration")
+
+    return {
+        "generation": rewritten_question + "\n\n" + generation + "\n\n" + context,
+        "answer": generation,
+        "sources": sources,
+        "loop_step": loop_step + 1,
+        "context_tokens": packed_context.nb_tokens,
+    }
+
+
+@timed_node("grade_documents")
+async def agrade_documents(state: State, config: RunnableConfig):
+    """
+    Determines whether the retrieved documents are relevant to the question,
+    see `grade_documents`
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig): The graph config
+
+    Returns:
+        state (dict): Filtered out irrelevant documents and updated web_search state
+    """
+    print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
+    question = state["question"]
+    documents = state["documents"]
+    configurable = config.get("configurable") or {}
+    grading_mode = configurable.get("grading_mode", GRADING_MODE)
+
+    grades = None
+    if grading_mode == "batch" and len(documents) > 0:
+        result = await batch_retrieval_grader.ainvoke(
+            inputs=_get_batch_grading_inputs(question, documents)
+        )
+        grades = _get_batch_grades(result, documents)
+    if grades is None:
+        semaphore = asyncio.Semaphore(
+            max(
+                1,
+                configurable.get("grading_max_concurrency", GRADING_MAX_CONCURRENCY),
+            )
+        )
+
+        async def grade(document: Document) -> str:
+            async with semaphore:
+                result = await retrieval_grader.ainvoke(
+                    inputs=_get_grading_inputs(question, document)
+                )
+            return result["binary_score"]
+
+        grades = await asyncio.gather(*(grade(document) for document in documents))
+    return _filter_graded_documents(documents, grades)
+
+
+@timed_node("websearch")
+async def aweb_search(state: State):
+    """
+    Web search based on the question, see `web_search`
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): Appended web results to documents
+    """
+    print("---WEB SEARCH---")
+    question = state["question"]
+    documents = state.get("documents", [])
+
+    documents.append(await _asearch_web(question))
     return {"documents": documents}
+
+
+@timed_node("route_and_retrieve")
+async def aroute_and_retrieve(state: State, config: RunnableConfig):
+    """
+    Route the question while speculatively retrieving documents, see
+    `route_and_retrieve`. The branch the router does not pick is cancelled.
+
+    Args:
+        state (dict): The current graph state
+        config (RunnableConfig): The graph config, may hold the vectorstore to use
+
+    Returns:
+        state (dict): The route taken and the documents already fetched for it
+    """
+    print("---ROUTE QUESTION AND RETRIEVE---")
+    question = state["question"]
+    configurable = config.get("configurable") or {}
+    db = _get_db(config)
+
+    retrieval = asyncio.create_task(
+        db.aretrieve_documents(question, **_get_retrieval_kwargs(config))
+    )
+    speculative_web_search = (
+        asyncio.create_task(_asearch_web(question))
+        if configurable.get("speculative_web_search", SPECULATIVE_WEB_SEARCH)
+        else None
+    )
+    try:
+        route = (await router.ainvoke(inputs={"question": question}))["relevant"]
+        print(f"RESULT: {route}")
+
+        if route == "websearch":
+            _discard(retrieval)
+            if speculative_web_search is None:
+                return {"documents": [], "route": "websearch"}
+            return {
+                "documents": [await speculative_web_search],
+                "route": "web_searched",
+            }
+        if speculative_web_search is not None:
+            _discard(speculative_web_search)
+        return {"documents": await retrieval, "route": "retrieved"}
+    except BaseException:
+        for task in (retrieval, speculative_web_search):
+            if task is not None:
+                _discard(task)
+        raise
+
+
+def _discard(task: asyncio.Task) -> None:
+    """Cancel a speculative task, ignoring its outcome"""
+    task.cancel()
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
@@ -17,8 +17,13 @@ class State(TypedDict):
     """
 
     question: str  # User question
-    generation: str  # LLM generation
+    generation: str  # LLM generation, with the restated question and the sources
+    answer: str  # The answer of the model alone, without the restated question
+    sources: List[str]  # Source IDs of the documents of the last generation
     max_retries: int  # Max number of retries for answer generation
     answers: int  # Number of answers generated
     loop_step: Annotated[int, operator.add]
     documents: List[Document]  # List of retrieved documents
+    web_search: str  # "Yes" if a retrieved document was graded not relevant
+    context_tokens: int  # Tokens of the context of the last generation
+    route: str  # Next step chosen by the speculative routing node
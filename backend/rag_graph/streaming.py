@@ -0,0 +1,146 @@
+"""Helpers to stream the generated tokens and the states of a compiled graph."""
+
+import asyncio
+import time
+from typing import Any, AsyncIterator, Iterator, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph.state import CompiledStateGraph
+
+from backend.answer_cache import CachedAnswer, SemanticAnswerCache
+from backend.rag_graph.nodes import get_rewritten_question_text, get_sources_text
+
+
+def is_model_token(chunk: dict) -> bool:
+    """Whether a "custom" chunk holds tokens generated by the model."""
+    return chunk.get("kind", "model") == "model"
+
+
+def _replay_cached_answer(
+    inputs: dict, cached: CachedAnswer
+) -> Iterator[Tuple[str, Any]]:
+    """The chunks and final state of a cached answer, around which the question
+    of this user is restated."""
+    rewritten_question = get_rewritten_question_text(inputs["question"])
+    context = get_sources_text(cached.sources)
+    yield "custom", {
+        "token": rewritten_question + "\n\n",
+        "loop_step": 0,
+        "kind": "decoration",
+    }
+    yield "custom", {"token": cached.answer, "loop_step": 0, "kind": "cached"}
+    yield "custom", {"token": "\n\n" + context, "loop_step": 0, "kind": "decoration"}
+    yield "values", {
+        **inputs,
+        "generation": rewritten_question + "\n\n" + cached.answer + "\n\n" + context,
+        "answer": cached.answer,
+        "sources": cached.sources,
+        "documents": [],
+    }
+
+
+def stream_generation(
+    graph: CompiledStateGraph,
+    inputs: dict,
+    config: RunnableConfig | None = None,
+    answer_cache: SemanticAnswerCache | None = None,
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Stream a graph run, reporting the time to the first token generated by the
+    model, the restated question written before it is not counted.
+
+    When an answer cache is given, a cached answer to a similar question is
+    returned without running the graph, and new answers are cached.
+
+    Args:
+        graph (CompiledStateGraph): The compiled graph to run.
+        inputs (dict): The graph inputs.
+        config (RunnableConfig | None): The graph config.
+        answer_cache (SemanticAnswerCache | None): The answer cache to use.
+
+    Yields:
+        Tuple[str, Any]: ("custom", {"token": str, "loop_step": int, "kind":
+        str}) for each generated token, of kind "model", "decoration" (restated
+        question and sources) or "cached" (a whole cached answer), and
+        ("values", state) for each new graph state.
+    """
+    start = time.perf_counter()
+    if answer_cache is not None:
+        cached = answer_cache.lookup(inputs["question"])
+        if cached is not None:
+            yield from _replay_cached_answer(inputs, cached)
+            print(f"---TIME TO FULL ANSWER: {time.perf_counter() - start:.3f}s---")
+            return
+
+    first_token = True
+    state = {}
+    for mode, chunk in graph.stream(inputs, config, stream_mode=["custom", "values"]):
+        if mode == "custom" and first_token and is_model_token(chunk):
+            first_token = False
+            print(f"---TIME TO FIRST TOKEN: {time.perf_counter() - start:.3f}s---")
+        elif mode == "values":
+            state = chunk
+        yield mode, chunk
+    print(f"---TIME TO FULL ANSWER: {time.perf_counter() - start:.3f}s---")
+
+    if answer_cache is not None and "answer" in state:
+        answer_cache.store(
+            inputs["question"],
+            state["answer"],
+            state["sources"],
+            state.get("documents", []),
+        )
+
+
+async def astream_generation(
+    graph: CompiledStateGraph,
+    inputs: dict,
+    config: RunnableConfig | None = None,
+    answer_cache: SemanticAnswerCache | None = None,
+    stream_updates: bool = False,
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Asynchronously stream a graph run, see `stream_generation`.
+
+    Args:
+        graph (CompiledStateGraph): The compiled graph to run, e.g. `async_graph`.
+        inputs (dict): The graph inputs.
+        config (RunnableConfig | None): The graph config.
+        answer_cache (SemanticAnswerCache | None): The answer cache to use.
+        stream_updates (bool): Also yield the update of each finished node.
+
+    Yields:
+        Tuple[str, Any]: ("custom", {"token": str, "loop_step": int, "kind":
+        str}) for each generated token, ("values", state) for each new graph state and, if
+        `stream_updates`, ("updates", {node name: update}) for each node run.
+    """
+    start = time.perf_counter()
+    if answer_cache is not None:
+        # The lookup embeds the question with a blocking call
+        cached = await asyncio.to_thread(answer_cache.lookup, inputs["question"])
+        if cached is not None:
+            for mode, chunk in _replay_cached_answer(inputs, cached):
+                yield mode, chunk
+            print(f"---TIME TO FULL ANSWER: {time.perf_counter() - start:.3f}s---")
+            return
+
+    first_token = True
+    state = {}
+    stream_mode = ["custom", "values"] + (["updates"] if stream_updates else [])
+    async for mode, chunk in graph.astream(inputs, config, stream_mode=stream_mode):
+        if mode == "custom" and first_token and is_model_token(chunk):
+            first_token = False
+            print(f"---TIME TO FIRST TOKEN: {time.perf_counter() - start:.3f}s---")
+        elif mode == "values":
+            state = chunk
+        yield mode, chunk
+    print(f"---TIME TO FULL ANSWER: {time.perf_counter() - start:.3f}s---")
+
+    if answer_cache is not None and "answer" in state:
+        await asyncio.to_thread(
+            answer_cache.store,
+            inputs["question"],
+            state["answer"],
+            state["sources"],
+            state.get("documents", []),
+        )
@@ -0,0 +1,419 @@
+"""
+Client-side rate limiting of the calls to the OpenAI API.
+
+A `RateLimiter` holds a requests/min and a tokens/min budget, both refilled
+continuously, and shared by every thread and task calling through it: a call
+waits until both budgets can pay for it instead of sleeping a fixed time.
+Waiting calls are served by priority class, then in arrival order, and the
+background classes leave a share of the budgets to the interactive one. When
+the provider still answers 429, all the calls pause for the time it asks (or an
+exponential backoff) and the rates are halved, then recover step by step on
+each success. Connection errors and 5xx are retried after a jittered
+exponential backoff of the failed call only.
+
+`llm_scheduler` is the limiter shared by every chat model role of the process.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from enum import IntEnum
+from typing import Awaitable, Callable, TypeVar
+
+import openai
+
+from backend.metrics import metrics
+
+T = TypeVar("T")
+
+# Limits of the OpenAI account, shared by every chat model role
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", 3500))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", 160000))
+# Share of the budgets the background classes can not use, kept for chat traffic
+LLM_INTERACTIVE_RESERVE = float(os.getenv("LLM_INTERACTIVE_RESERVE", 0.2))
+
+# Seconds of traffic that can be sent at once after an idle period
+BURST_SECONDS = 10.0
+# Backoff of the first retry without Retry-After, doubled on each consecutive one
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# Longest sleep of a call waiting behind another one before checking its turn
+POLL_INTERVAL = 0.01
+
+
+class Priority(IntEnum):
+    """Priority classes of the calls, the lowest value is served first."""
+
+    INTERACTIVE = 0
+    INGESTION = 1
+    EVALUATION = 2
+
+
+class TokenBucket:
+    """A budget refilled continuously at a fixed rate, up to its capacity."""
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = BURST_SECONDS):
+        """
+        Args:
+            rate_per_minute (float): Units added to the budget per minute.
+            burst_seconds (float): Seconds of refill the budget can hold.
+        """
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self._available = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float, rate_factor: float = 1.0) -> None:
+        self._available = min(
+            self.capacity,
+            self._available + (now - self._updated) * self.rate * rate_factor,
+        )
+        self._updated = now
+
+    def time_until(
+        self, amount: float, rate_factor: float = 1.0, reserve: float = 0.0
+    ) -> float:
+        """Seconds until `amount` is available, 0 if it is already.
+
+        Args:
+            amount (float): The units needed, capped to the capacity.
+            rate_factor (float): Share of the rate currently allowed.
+            reserve (float): Share of the capacity that must remain available
+                after taking `amount`.
+        """
+        needed = min(amount + reserve * self.capacity, self.capacity)
+        return max(0.0, (needed - self._available) / (self.rate * rate_factor))
+
+    def consume(self, amount: float) -> None:
+        self._available -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min budgets shared by threads and tasks, served by
+    priority and backing off on 429.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        min_rate_factor: float = 0.1,
+        recovery_step: float = 0.05,
+        interactive_reserve: float = 0.0,
+        name: str = "default",
+    ):
+        """
+        Initialize the limiter.
+
+        Args:
+            requests_per_minute (float): Requests allowed per minute.
+            tokens_per_minute (float): Prompt and completion tokens allowed per minute.
+            min_rate_factor (float): Lowest share of the rates kept after 429s.
+            recovery_step (float): Share of the rates recovered on each success.
+            interactive_reserve (float): Share of the budgets only the
+                interactive class can use.
+            name (str): The "limiter" label of its metrics.
+        """
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._min_rate_factor = min_rate_factor
+        self._recovery_step = recovery_step
+        self._interactive_reserve = interactive_reserve
+        self.name = name
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        # Heap of the waiting calls, by priority then arrival
+        self._waiting: list[tuple[int, int]] = []
+        self._arrivals = itertools.count()
+        self.rate_factor = 1.0
+        self._paused_until = 0.0
+        self._consecutive_rate_limits = 0
+        self.nb_rate_limited = 0
+        self.waited = 0.0  # Seconds spent waiting for the budget, by all callers
+
+    def acquire(
+        self, tokens: int = 0, priority: Priority = Priority.INTERACTIVE
+    ) -> None:
+        """Wait until a request of `tokens` tokens fits in the budgets, and take it.
+
+        Args:
+            tokens (int): Estimated prompt and completion tokens of the request.
+            priority (Priority): Class of the request, served before the
+                waiting requests of lower classes.
+        """
+        start = time.monotonic()
+        ticket = self._enqueue(priority)
+        try:
+            with self._condition:
+                while (wait := self._try_take(ticket, tokens)) > 0:
+                    self._condition.wait(wait)
+        finally:
+            self._dequeue(ticket)
+        self._record_wait(priority, start)
+
+    async def aacquire(
+        self, tokens: int = 0, priority: Priority = Priority.INTERACTIVE
+    ) -> None:
+        """Wait, without blocking the event loop, until a request of `tokens`
+        tokens fits in the budgets, and take it.
+
+        Args:
+            tokens (int): Estimated prompt and completion tokens of the request.
+            priority (Priority): Class of the request, served before the
+                waiting requests of lower classes.
+        """
+        start = time.monotonic()
+        ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_take(ticket, tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            self._dequeue(ticket)
+        self._record_wait(priority, start)
+
+    def queue_depth(self) -> int:
+        """Number of requests waiting for the budgets."""
+        with self._lock:
+            return len(self._waiting)
+
+    def _enqueue(self, priority: Priority) -> tuple[int, int]:
+        with self._lock:
+            ticket = (int(priority), next(self._arrivals))
+            heapq.heappush(self._waiting, ticket)
+            self._record_depth(priority)
+        return ticket
+
+    def _dequeue(self, ticket: tuple[int, int]) -> None:
+        """Remove a request from the queue, taken or given up."""
+        with self._condition:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._record_depth(Priority(ticket[0]))
+                self._condition.notify_all()
+
+    def _try_take(self, ticket: tuple[int, int], tokens: int) -> float:
+        """Take the budgets of a request if it is first in line and they can
+        pay for it. Called with the lock held.
+
+        Returns:
+            float: 0 if the budgets were taken, else the seconds to wait
+            before trying again.
+        """
+        now = time.monotonic()
+        self._requests.refill(now, self.rate_factor)
+        self._tokens.refill(now, self.rate_factor)
+        reserve = self._interactive_reserve if ticket[0] > Priority.INTERACTIVE else 0.0
+        wait = max(
+            self._paused_until - now,
+            self._requests.time_until(1, self.rate_factor, reserve),
+            self._tokens.time_until(tokens, self.rate_factor, reserve),
+        )
+        if self._waiting[0] != ticket:
+            return max(wait, POLL_INTERVAL)
+        if wait > 0:
+            return wait
+        self._requests.consume(1)
+        self._tokens.consume(tokens)
+        return 0.0
+
+    def _record_wait(self, priority: Priority, start: float) -> None:
+        waited = time.monotonic() - start
+        with self._lock:
+            self.waited += waited
+        metrics.observe(
+            "rate_limiter_wait_seconds",
+            waited,
+            limiter=self.name,
+            priority=priority.name.lower(),
+        )
+
+    def _record_depth(self, priority: Priority) -> None:
+        """Record the number of requests of a class waiting. Called with the
+        lock held."""
+        metrics.set(
+            "rate_limiter_queue_depth",
+            sum(1 for waiting, _ in self._waiting if waiting == priority),
+            limiter=self.name,
+            priority=priority.name.lower(),
+        )
+
+    def on_success(self) -> None:
+        """Recover part of the rates after a successful request."""
+        with self._lock:
+            self._consecutive_rate_limits = 0
+            self.rate_factor = min(1.0, self.rate_factor + self._recovery_step)
+
+    def on_rate_limited(self, retry_after: float | None = None) -> float:
+        """Pause every request and halve the rates after a 429.
+
+        Args:
+            retry_after (float | None): Seconds to wait asked by the provider.
+
+        Returns:
+            float: Seconds until requests are sent again.
+        """
+        with self._lock:
+            self.nb_rate_limited += 1
+            self._consecutive_rate_limits += 1
+            self.rate_factor = max(self._min_rate_factor, self.rate_factor / 2)
+            if retry_after is None:
+                backoff = min(
+                    MAX_BACKOFF, BASE_BACKOFF * 2 ** (self._consecutive_rate_limits - 1)
+                )
+                # Jitter, so that the paused threads do not all retry at once
+                retry_after = backoff * random.uniform(0.5, 1.0)
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + retry_after)
+            return self._paused_until - now
+
+    def retry_delay(self, error: Exception, attempt: int) -> float | None:
+        """Apply the retry policy to a failed request.
+
+        A 429 pauses every request, which `acquire` waits for. A transient
+        error only delays the retry of the failed request.
+
+        Args:
+            error (Exception): The error of the request.
+            attempt (int): Number of the failed attempt, from 0.
+
+        Returns:
+            float | None: Seconds to sleep before acquiring the budgets again,
+            None if the error can not be retried.
+        """
+        if is_rate_limit_error(error):
+            pause = self.on_rate_limited(get_retry_after(error))
+            metrics.observe(
+                "rate_limiter_retry_backoff_seconds",
+                pause,
+                limiter=self.name,
+                reason="rate_limited",
+            )
+            print(f"---RATE LIMITED, RETRY IN {pause:.1f}s---")
+            return 0.0
+        if is_transient_error(error):
+            backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2**attempt)
+            delay = backoff * random.uniform(0.5, 1.0)
+            metrics.observe(
+                "rate_limiter_retry_backoff_seconds",
+                delay,
+                limiter=self.name,
+                reason="transient",
+            )
+            print(f"---LLM ERROR, RETRY IN {delay:.1f}s---")
+            return delay
+        return None
+
+    def call(
+        self,
+        request: Callable[[], T],
+        tokens: int = 0,
+        max_retries: int = 5,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> T:
+        """Send a request within the budgets, retrying it on 429 and transient
+        errors.
+
+        Args:
+            request (Callable[[], T]): Sends the request.
+            tokens (int): Estimated prompt and completion tokens of the request.
+            max_retries (int): Retries before giving up.
+            priority (Priority): Class of the request.
+
+        Returns:
+            T: The result of the request.
+
+        Raises:
+            Exception: The error of the request, or the last one once out of retries.
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                result = request()
+            except Exception as e:
+                delay = self.retry_delay(e, attempt) if attempt < max_retries else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.on_success()
+            return result
+
+    async def acall(
+        self,
+        request: Callable[[], Awaitable[T]],
+        tokens: int = 0,
+        max_retries: int = 5,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> T:
+        """Asynchronously send a request within the budgets, retrying it on 429
+        and transient errors.
+
+        Args:
+            request (Callable[[], Awaitable[T]]): Sends the request.
+            tokens (int): Estimated prompt and completion tokens of the request.
+            max_retries (int): Retries before giving up.
+            priority (Priority): Class of the request.
+
+        Returns:
+            T: The result of the request.
+
+        Raises:
+            Exception: The error of the request, or the last one once out of retries.
+        """
+        for attempt in range(max_retries + 1):
+            await self.aacquire(tokens, priority)
+            try:
+                result = await request()
+            except Exception as e:
+                delay = self.retry_delay(e, attempt) if attempt < max_retries else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.on_success()
+            return result
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Whether an error is a 429 of the provider."""
+    return (
+        isinstance(error, openai.RateLimitError)
+        or getattr(error, "status_code", None) == 429
+    )
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether an error is a timeout, a connection error or a 5xx of the provider."""
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and status_code >= 500
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Seconds to wait asked by the provider in the Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Process-wide limiter of the chat model calls
+llm_scheduler = RateLimiter(
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    interactive_reserve=LLM_INTERACTIVE_RESERVE,
+    name="llm",
+)
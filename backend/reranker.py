@@ -0,0 +1,147 @@
+"""
+Reranking of retrieved chunks.
+
+The vectorstore over-fetches candidate chunks, which are rescored against the
+question by a local CPU cross-encoder in a single batched forward pass, and
+only the best ones are kept. Scoring past the timeout falls back to the
+retrieval order, so that reranking never delays an answer by more than that.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, List, Sequence
+
+from langchain_core.documents import Document
+
+RERANK = os.getenv("RERANK", "false") == "true"
+RERANK_MODEL_NAME = os.getenv(
+    "RERANK_MODEL_NAME", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+)
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", 20))  # Candidates fetched and rescored
+RERANK_TIMEOUT = float(os.getenv("RERANK_TIMEOUT", 2.0))  # In seconds
+
+# Relevance score of each text for a query, higher is better
+Scorer = Callable[[str, List[str]], Sequence[float]]
+
+
+class CrossEncoderScorer:
+    """A sentence-transformers cross-encoder, run on CPU."""
+
+    def __init__(self, model_name: str = RERANK_MODEL_NAME, max_length: int = 512):
+        """
+        Load the cross-encoder.
+
+        Args:
+            model_name (str): The Hugging Face model name.
+            max_length (int): Number of tokens of each (query, text) pair kept.
+        """
+        # Optional dependency, only needed when reranking is enabled
+        from sentence_transformers import CrossEncoder
+
+        self._model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def __call__(self, query: str, texts: List[str]) -> Sequence[float]:
+        return self._model.predict(
+            [(query, text) for text in texts],
+            batch_size=max(1, len(texts)),
+            show_progress_bar=False,
+        ).tolist()
+
+
+class Reranker:
+    """Keep the chunks that a scorer finds the most relevant to a query."""
+
+    def __init__(
+        self,
+        scorer: Scorer | None = None,
+        timeout: float = RERANK_TIMEOUT,
+    ):
+        """
+        Initialize the reranker.
+
+        Args:
+            scorer (Scorer | None): Scores (query, texts) pairs. Defaults to a
+                `CrossEncoderScorer`, loaded on first use.
+            timeout (float): Seconds to wait for the scores before keeping the
+                retrieval order.
+        """
+        self._scorer = scorer
+        self._scorer_lock = threading.Lock()
+        self._timeout = timeout
+        # A single worker: concurrent forward passes would compete for the CPU
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+    def rerank(self, query: str, documents: List[Document], k: int) -> List[Document]:
+        """Rescore documents against a query and keep the k best.
+
+        Args:
+            query (str): The search query.
+            documents (List[Document]): The candidates, in retrieval order.
+            k (int): Number of documents to keep.
+
+        Returns:
+            List[Document]: The k best documents, best first, with their score in
+            the "rerank_score" metadata. The first k candidates if scoring
+            failed or timed out.
+        """
+        if len(documents) <= 1:
+            return documents[:k]
+
+        future = self._executor.submit(
+            self._score, query, [document.page_content for document in documents]
+        )
+        try:
+            scores = future.result(timeout=self._timeout)
+        except FutureTimeoutError:
+            # Drop the scoring if it has not started yet
+            future.cancel()
+            print("---RERANK TIMEOUT, KEEP RETRIEVAL ORDER---")
+            return documents[:k]
+        except Exception as e:
+            print(f"---RERANK FAILED: {e!r}, KEEP RETRIEVAL ORDER---")
+            return documents[:k]
+
+        ranking = sorted(
+            range(len(documents)), key=lambda index: scores[index], reverse=True
+        )
+        reranked_documents = []
+        for index in ranking[:k]:
+            document = documents[index]
+            reranked_documents.append(
+                Document(
+                    page_content=document.page_content,
+                    metadata={
+                        **document.metadata,
+                        "rerank_score": float(scores[index]),
+                    },
+                    id=document.id,
+                )
+            )
+        return reranked_documents
+
+    def _score(self, query: str, texts: List[str]) -> Sequence[float]:
+        with self._scorer_lock:
+            if self._scorer is None:
+                print(f"---LOAD RERANKER {RERANK_MODEL_NAME}---")
+                self._scorer = CrossEncoderScorer()
+        return self._scorer(query, texts)
+
+
+_shared_reranker: Reranker | None = None
+_shared_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> Reranker:
+    """Return the process-wide reranker, created on first use.
+
+    Returns:
+        Reranker: The shared reranker, scoring with the default cross-encoder.
+    """
+    global _shared_reranker
+    if _shared_reranker is None:
+        with _shared_reranker_lock:
+            if _shared_reranker is None:
+                _shared_reranker = Reranker()
+    return _shared_reranker
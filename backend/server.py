@@ -0,0 +1,318 @@
+"""
+Headless HTTP service for the RAG graph.
+
+Endpoints:
+    GET  /health  Liveness and load of the worker
+    GET  /metrics Latency and token histograms of the worker, in the Prometheus
+                  text format (or JSON with ?format=json)
+    POST /invoke  {"question": str} -> the generation and its sources, as JSON
+    POST /stream  {"question": str} -> server-sent events: "node" when a node
+                  finishes, "token" for each generated token, then "done" with
+                  the same payload as /invoke (or "error")
+
+Each worker answers at most `SERVER_MAX_CONCURRENCY` questions at a time and
+queues at most `SERVER_MAX_QUEUE` more; beyond that, requests are rejected with
+a 503 so that a load balancer can send them to another worker.
+
+Each worker keeps its own manifest, BM25 index and answer cache in memory, and
+reloads them every `SERVER_RELOAD_INTERVAL` seconds if another process (the
+ingestion page, another worker) modified the vectorstore. The reload swaps them
+without failing the requests in flight, see `backend.benchmarks.server_reload`.
+
+Usage:
+    python -m backend.server --port 8000 --workers 2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List
+
+from langchain_core.documents import Document
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from backend.answer_cache import get_answer_cache
+from backend.metrics import metrics
+from backend.rag_graph.graph import async_graph
+from backend.rag_graph.streaming import astream_generation
+from backend.vectorstore import close_vectorstore, get_vectorstore
+
+SERVER_MAX_CONCURRENCY = int(os.getenv("SERVER_MAX_CONCURRENCY", 8))
+SERVER_MAX_QUEUE = int(os.getenv("SERVER_MAX_QUEUE", 32))
+SERVER_REQUEST_TIMEOUT = float(os.getenv("SERVER_REQUEST_TIMEOUT", 120))  # Seconds
+SERVER_ANSWER_CACHE = os.getenv("SERVER_ANSWER_CACHE", "true") == "true"
+# Seconds between two checks for changes of the vectorstore by other processes
+SERVER_RELOAD_INTERVAL = float(os.getenv("SERVER_RELOAD_INTERVAL", 5))
+
+
+class ServerBusy(Exception):
+    """Raised when both the running and the queued requests are at their limit."""
+
+
+class ConcurrencyLimiter:
+    """Bound the questions running at once and the questions waiting for a slot."""
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        """
+        Initialize the limiter.
+
+        Args:
+            max_concurrency (int): Number of questions answered at the same time.
+            max_queue (int): Number of questions waiting for a slot.
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.running = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def acquire(self) -> "Lease":
+        """Wait for a slot.
+
+        Returns:
+            Lease: The slot, to be released once the question is answered.
+
+        Raises:
+            ServerBusy: If the queue is full.
+        """
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            raise ServerBusy()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return Lease(self)
+
+    def _release(self) -> None:
+        self.running -= 1
+        self._semaphore.release()
+
+
+class Lease:
+    """A slot of the limiter. Releasing it more than once has no effect."""
+
+    def __init__(self, limiter: ConcurrencyLimiter):
+        self._limiter = limiter
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter._release()
+
+
+limiter = ConcurrencyLimiter(SERVER_MAX_CONCURRENCY, SERVER_MAX_QUEUE)
+
+
+def _get_inputs(payload: Any) -> dict:
+    """Graph inputs from a request payload.
+
+    Raises:
+        ValueError: If the payload has no question or invalid max_retries.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("The request body should be a JSON object")
+    question = payload.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("The request body should contain a non-empty 'question'")
+    return {"question": question, "max_retries": int(payload.get("max_retries", 3))}
+
+
+def _get_config() -> dict:
+    return {"configurable": {"vectorstore": get_vectorstore()}}
+
+
+def _format_sources(documents: List[Document]) -> List[dict]:
+    return [
+        {
+            key: document.metadata[key]
+            for key in ("document_id", "filename", "page_number")
+            if key in document.metadata
+        }
+        for document in documents
+    ]
+
+
+def _format_answer(state: dict, start: float) -> dict:
+    return {
+        "generation": state.get("generation"),
+        "sources": _format_sources(state.get("documents", [])),
+        "context_tokens": state.get("context_tokens"),
+        "duration": time.perf_counter() - start,
+    }
+
+
+def _busy_response() -> JSONResponse:
+    return JSONResponse(
+        {"error": "Too many requests in flight, retry later"},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+def _run(inputs: dict) -> AsyncIterator[tuple[str, Any]]:
+    return astream_generation(
+        async_graph,
+        inputs,
+        _get_config(),
+        answer_cache=get_answer_cache() if SERVER_ANSWER_CACHE else None,
+        stream_updates=True,
+    )
+
+
+async def _answer(inputs: dict) -> dict:
+    """Run the graph and return its final state."""
+    state = {}
+    async for mode, chunk in _run(inputs):
+        if mode == "values":
+            state = chunk
+    return state
+
+
+async def health(request: Request) -> JSONResponse:
+    """Liveness and load of the worker."""
+    return JSONResponse(
+        {
+            "status": "ok",
+            "running": limiter.running,
+            "waiting": limiter.waiting,
+            "max_concurrency": limiter.max_concurrency,
+            "max_queue": limiter.max_queue,
+            "stored_pages": len(get_vectorstore().manifest),
+        }
+    )
+
+
+async def metrics_endpoint(request: Request) -> PlainTextResponse | JSONResponse:
+    """Latency and token histograms of the worker."""
+    if request.query_params.get("format") == "json":
+        return JSONResponse(metrics.to_json())
+    return PlainTextResponse(
+        metrics.to_prometheus(), media_type="text/plain; version=0.0.4"
+    )
+
+
+async def invoke(request: Request) -> JSONResponse:
+    """Answer a question and return the generation with its sources."""
+    try:
+        inputs = _get_inputs(await request.json())
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        lease = await limiter.acquire()
+    except ServerBusy:
+        return _busy_response()
+
+    start = time.perf_counter()
+    try:
+        state = await asyncio.wait_for(_answer(inputs), timeout=SERVER_REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        return JSONResponse({"error": "The request timed out"}, status_code=504)
+    finally:
+        lease.release()
+    return JSONResponse(_format_answer(state, start))
+
+
+def _format_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream(request: Request) -> StreamingResponse | JSONResponse:
+    """Answer a question, streaming the node progress and the tokens as SSE."""
+    try:
+        inputs = _get_inputs(await request.json())
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        lease = await limiter.acquire()
+    except ServerBusy:
+        return _busy_response()
+
+    async def events() -> AsyncIterator[str]:
+        start = time.perf_counter()
+        state = {}
+        try:
+            # Events are produced as the client reads them: a slow client slows
+            # its own graph run down instead of buffering tokens in memory
+            async with asyncio.timeout(SERVER_REQUEST_TIMEOUT):
+                async for mode, chunk in _run(inputs):
+                    if mode == "custom":
+                        yield _format_event("token", chunk)
+                    elif mode == "updates":
+                        for node in chunk:
+                            yield _format_event("node", {"node": node})
+                    elif mode == "values":
+                        state = chunk
+            yield _format_event("done", _format_answer(state, start))
+        except TimeoutError:
+            yield _format_event("error", {"error": "The request timed out"})
+        except Exception as e:
+            print(f"---STREAM FAILED: {e!r}---")
+            yield _format_event("error", {"error": "The answer generation failed"})
+        finally:
+            lease.release()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Releases the slot if the client left before the stream started
+        background=BackgroundTask(lease.release),
+    )
+
+
+async def reload_on_change(interval: float) -> None:
+    """Reload the shared vectorstore whenever another process modifies it."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(get_vectorstore().reload_if_modified)
+        except Exception as e:
+            print(f"---VECTORSTORE RELOAD FAILED: {e!r}---")
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    # Open the shared vectorstore before accepting requests
+    await asyncio.to_thread(get_vectorstore)
+    if SERVER_ANSWER_CACHE:
+        # Registered now, so that the first reload already invalidates it
+        get_answer_cache()
+    reloader = asyncio.create_task(reload_on_change(SERVER_RELOAD_INTERVAL))
+    yield
+    reloader.cancel()
+    close_vectorstore()
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/invoke", invoke, methods=["POST"]),
+        Route("/stream", stream, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    uvicorn.run(
+        "backend.server:app", host=args.host, port=args.port, workers=args.workers
+    )
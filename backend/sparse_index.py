@@ -0,0 +1,281 @@
+"""
+In-memory BM25 index of the stored pages, persisted next to the Chroma
+collection, used for the lexical side of hybrid retrieval (company names,
+tickers, figures).
+"""
+
+import math
+import os
+import pickle
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+import numpy as np
+
+SPARSE_INDEX_FILENAME = "bm25_index.pkl"
+SPARSE_INDEX_SAVE_INTERVAL = 30  # In seconds
+
+# Opt-in pruning: terms found in more than this share of the pages are the
+# costliest to score and are skipped, at the cost of an approximate ranking.
+# Unset, every query term is scored (exact BM25)
+SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO = (
+    float(os.environ["SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO"])
+    if os.getenv("SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO")
+    else None
+)
+
+STOPWORDS = frozenset(
+    "a à au aux avec ce ces dans de des du elle en et eux il je la le les leur lui "
+    "ma mais me même mes moi mon ne nos notre nous on ou où par pas pour qu que qui "
+    "sa se ses son sur ta te tes toi ton tu un une vos votre vous c d j l m n s t "
+    "y est sont été être quel quelle quels quelles the of and to in for is on".split()
+)
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens of a text, without stopwords."""
+    return [
+        token
+        for token in _TOKEN_PATTERN.findall(text.lower())
+        if token not in STOPWORDS
+    ]
+
+
+class BM25Index:
+    """
+    An inverted index scoring documents with Okapi BM25.
+
+    Only the postings of the query terms are visited. They are scored as numpy
+    arrays, cached per term until a document containing the term changes.
+    """
+
+    def __init__(self, path: Path | None = None, k1: float = 1.5, b: float = 0.75):
+        """
+        Load the index from disk, empty if it does not exist yet.
+
+        Args:
+            path (Path | None): Path of the pickle file, None to keep it in memory.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalization.
+        """
+        self._path = path
+        self._k1 = k1
+        self._b = b
+        self._lock = threading.RLock()
+        self._reset()
+        self._dirty = False
+        self._last_save = time.monotonic()
+        if self._path is not None and self._path.exists():
+            try:
+                with self._path.open("rb") as f:
+                    self._postings, self._document_ids, self._lengths = pickle.load(f)
+                self._index_documents()
+            except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+                print(f"---INVALID SPARSE INDEX {self._path}, IGNORED---")
+                self._reset()
+
+    def _reset(self) -> None:
+        # Documents are numbered, positions of removed documents are reused
+        self._document_ids: List[str | None] = []
+        self._lengths = np.zeros(0, dtype=np.float32)
+        # Term frequency of each document number containing the term
+        self._postings: dict[str, dict[int, int]] = {}
+        self._index_documents()
+
+    def _index_documents(self) -> None:
+        self._document_numbers = {
+            document_id: number
+            for number, document_id in enumerate(self._document_ids)
+            if document_id is not None
+        }
+        self._free_numbers = [
+            number
+            for number, document_id in enumerate(self._document_ids)
+            if document_id is None
+        ]
+        self._document_terms: dict[int, List[str]] = {}
+        for term, term_postings in self._postings.items():
+            for number in term_postings:
+                self._document_terms.setdefault(number, []).append(term)
+        self._total_length = float(self._lengths.sum())
+        # (document numbers, term frequencies) arrays of each term
+        self._term_arrays: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._document_numbers)
+
+    def add_documents(self, documents: Iterable[tuple[str, str]]) -> None:
+        """Index (or re-index) documents.
+
+        Args:
+            documents (Iterable[tuple[str, str]]): (document ID, text) pairs.
+        """
+        with self._lock:
+            for document_id, text in documents:
+                self._remove(document_id)
+                number = self._allocate(document_id)
+                term_frequencies = Counter(tokenize(text))
+                for term, frequency in term_frequencies.items():
+                    self._postings.setdefault(term, {})[number] = frequency
+                    self._term_arrays.pop(term, None)
+                self._document_terms[number] = list(term_frequencies)
+                length = sum(term_frequencies.values())
+                self._lengths[number] = length
+                self._total_length += length
+            self._mark_dirty()
+
+    def delete_documents(self, document_ids: Iterable[str]) -> None:
+        with self._lock:
+            for document_id in document_ids:
+                self._remove(document_id)
+            self._mark_dirty()
+
+    def rebuild(self, documents: Iterable[tuple[str, str]]) -> None:
+        """Replace the index content, e.g. from the documents of the vectorstore."""
+        with self._lock:
+            self._reset()
+            self.add_documents(documents)
+
+    def search(
+        self, query: str, k: int, accept: Callable[[str], bool] | None = None
+    ) -> List[tuple[str, float]]:
+        """Return the k best documents for a query.
+
+        Args:
+            query (str): The search query.
+            k (int): Number of documents to return.
+            accept (Callable[[str], bool] | None): Keeps only the document IDs
+                for which it returns True, e.g. to filter by metadata.
+
+        Returns:
+            List[tuple[str, float]]: (document ID, BM25 score), best first.
+        """
+        with self._lock:
+            nb_documents = len(self._document_numbers)
+            if nb_documents == 0 or k <= 0:
+                return []
+
+            terms = [term for term in set(tokenize(query)) if term in self._postings]
+            if SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO is not None:
+                selective_terms = [
+                    term
+                    for term in terms
+                    if len(self._postings[term])
+                    <= SPARSE_MAX_DOCUMENT_FREQUENCY_RATIO * nb_documents
+                ]
+                # Keep common terms when they are all the query has
+                terms = selective_terms or terms
+            if len(terms) == 0:
+                return []
+
+            average_length = max(self._total_length / nb_documents, 1.0)
+            length_norms = self._k1 * (
+                1 - self._b + self._b * self._lengths / average_length
+            )
+            scores = np.zeros(len(self._document_ids), dtype=np.float32)
+            for term in terms:
+                numbers, frequencies = self._get_term_arrays(term)
+                idf = math.log(
+                    1 + (nb_documents - len(numbers) + 0.5) / (len(numbers) + 0.5)
+                )
+                scores[numbers] += idf * (
+                    frequencies * (self._k1 + 1) / (frequencies + length_norms[numbers])
+                )
+
+            candidates = np.flatnonzero(scores)
+            if accept is None:
+                k = min(k, len(candidates))
+                if k == 0:
+                    return []
+                best = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+                best = best[np.argsort(-scores[best])]
+            else:
+                best = []
+                for number in candidates[np.argsort(-scores[candidates])]:
+                    if len(best) == k:
+                        break
+                    if accept(self._document_ids[number]):
+                        best.append(number)
+            return [
+                (self._document_ids[number], float(scores[number])) for number in best
+            ]
+
+    def save(self, force: bool = True) -> None:
+        """Write the index to disk if it changed.
+
+        Args:
+            force (bool): Save now, otherwise only once the save interval elapsed.
+        """
+        with self._lock:
+            if self._path is None or not self._dirty:
+                return
+            if (
+                not force
+                and time.monotonic() - self._last_save < SPARSE_INDEX_SAVE_INTERVAL
+            ):
+                return
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._path.with_suffix(".tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump(
+                    (self._postings, self._document_ids, self._lengths),
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmp_path, self._path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def _get_term_arrays(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        if term not in self._term_arrays:
+            term_postings = self._postings[term]
+            self._term_arrays[term] = (
+                np.fromiter(
+                    term_postings.keys(), dtype=np.int64, count=len(term_postings)
+                ),
+                np.fromiter(
+                    term_postings.values(), dtype=np.float32, count=len(term_postings)
+                ),
+            )
+        return self._term_arrays[term]
+
+    def _mark_dirty(self) -> None:
+        # Saving rewrites the whole index, so writes are grouped in time
+        self._dirty = True
+        self.save(force=False)
+
+    def _allocate(self, document_id: str) -> int:
+        if self._free_numbers:
+            number = self._free_numbers.pop()
+            self._document_ids[number] = document_id
+        else:
+            number = len(self._document_ids)
+            self._document_ids.append(document_id)
+            if number >= len(self._lengths):
+                self._lengths = np.concatenate(
+                    [self._lengths, np.zeros(max(1024, number), dtype=np.float32)]
+                )
+        self._document_numbers[document_id] = number
+        return number
+
+    def _remove(self, document_id: str) -> None:
+        number = self._document_numbers.pop(document_id, None)
+        if number is None:
+            return
+        for term in self._document_terms.pop(number, ()):
+            term_postings = self._postings[term]
+            del term_postings[number]
+            self._term_arrays.pop(term, None)
+            if len(term_postings) == 0:
+                del self._postings[term]
+        self._total_length -= float(self._lengths[number])
+        self._lengths[number] = 0
+        self._document_ids[number] = None
+        self._free_numbers.append(number)
@@ -1,7 +1,69 @@
+import re
+from functools import lru_cache
 from typing import List
 
-from langchain_core.documents import Document
+import tiktoken
 
+# Encoding used for models unknown to tiktoken, e.g. the local Ollama models
+DEFAULT_TOKEN_ENCODING = "cl100k_base"
 
-def format_documents(documents: List[Document]) -> str:
-    return "\n\n".join(doc.page_content for doc in documents)
+
+class ApproximateEncoding:
+    """
+    Stand-in for a tiktoken encoding when its BPE file cannot be loaded, e.g.
+    without network access: a token is a run of up to 4 characters, with its
+    leading spaces, which is the usual size of an OpenAI token.
+    """
+
+    _TOKEN_PATTERN = re.compile(r"\s*\S{1,4}|\s+")
+
+    def encode(self, text: str, disallowed_special=()) -> List[str]:
+        return self._TOKEN_PATTERN.findall(text)
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+@lru_cache(maxsize=None)
+def _get_token_encoding(model_name: str) -> tiktoken.Encoding | ApproximateEncoding:
+    """Tokenizer of a model. tiktoken downloads the BPE file on first use, and
+    caches it in `TIKTOKEN_CACHE_DIR` (set it to a directory holding the file to
+    run offline). If it cannot be loaded, tokens are approximated."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_TOKEN_ENCODING)
+    except (OSError, ValueError) as e:
+        print(f"---TOKENIZER OF {model_name} UNAVAILABLE, APPROXIMATED: {e!r}---")
+        return ApproximateEncoding()
+
+
+def count_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
+    """Count the tokens of a text for a chat model.
+
+    Args:
+        text (str): The text to count.
+        model_name (str): The model whose tokenizer is used.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return len(_get_token_encoding(model_name).encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(
+    text: str, max_tokens: int, model_name: str = "gpt-3.5-turbo"
+) -> str:
+    """Keep the beginning of a text that fits in a number of tokens.
+
+    Args:
+        text (str): The text to truncate.
+        max_tokens (int): Maximum number of tokens kept.
+        model_name (str): The model whose tokenizer is used.
+
+    Returns:
+        str: The truncated text.
+    """
+    encoding = _get_token_encoding(model_name)
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
@@ -1,14 +1,31 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
 from pathlib import Path
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Tuple
 
+import chromadb
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
-from unstructured.documents.elements import Element
 from unstructured.partition.pdf import partition_pdf
 
 from backend.chat_models.llms import summarizer
+from backend.embedding_cache import CachedEmbeddings, EmbeddingCache
+from backend.manifest import MANIFEST_FILENAME, IngestionManifest
+from backend.metadata import (
+    extract_file_metadata,
+    extract_query_filter,
+    matches_filter,
+)
+from backend.metrics import metrics
+from backend.sparse_index import SPARSE_INDEX_FILENAME, BM25Index
+from backend.utils import count_tokens
 
 # Constants for directory paths and embedding model
 DOCUMENTS_PATH = Path("database/documents")
@@ -17,6 +34,95 @@ OUTPUT_IMAGES_PATH = "database/output_images"
 
 EMBEDDING_MODEL_NAME = "text-embedding-3-small"
 EMBEDDING_DIMENSION = 768
+COLLECTION_NAME = "Oxfam-collection"
+
+# Retrieval: "hybrid" fuses dense and BM25 results, "dense" only uses Chroma
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+RETRIEVAL_K = 3
+HYBRID_FETCH_K = 10  # Candidates fetched by each side of the hybrid retrieval
+RRF_K = 60  # Reciprocal rank fusion constant
+# Restrict the search to the companies and years named in the question
+RETRIEVAL_METADATA_FILTER = os.getenv("RETRIEVAL_METADATA_FILTER", "true") == "true"
+# Small-to-big retrieval: chunks are matched, then expanded to their whole page
+# or to their neighbouring chunks while the context fits in this many tokens
+RETRIEVAL_CONTEXT_TOKENS = int(os.getenv("RETRIEVAL_CONTEXT_TOKENS", 2000))
+
+# (element type name, element text) pairs produced by `partition_pdf_page`
+PageElement = Tuple[str, str]
+
+
+def partition_pdf_page(pdf_page: bytes) -> List[PageElement]:
+    """Partition a single-page PDF into text and table elements.
+
+    Kept at module level and free of network calls so that it can run in a
+    process pool.
+
+    Args:
+        pdf_page (bytes): The single-page PDF content.
+
+    Returns:
+        List[PageElement]: The type name and text of each chunked element.
+    """
+    raw_pdf_elements = partition_pdf(
+        file=BytesIO(pdf_page),
+        extract_images_in_pdf=False,
+        infer_table_structure=True,
+        chunking_strategy="by_title",
+        max_characters=1500,
+        new_after_n_chars=1200,
+        combine_text_under_n_chars=500,
+    )
+    return [(type(element).__name__, str(element)) for element in raw_pdf_elements]
+
+
+class _ReadWriteLock:
+    """
+    Shared by the readers, exclusive for a writer. A waiting writer blocks the
+    new readers, so that it is not starved by a steady flow of queries, and is
+    let in once the readers in flight are done. Readers are re-entrant within
+    a thread.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._nb_readers = 0
+        self._nb_waiting_writers = 0
+        self._writing = False
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            with self._condition:
+                while self._writing or self._nb_waiting_writers > 0:
+                    self._condition.wait()
+                self._nb_readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                with self._condition:
+                    self._nb_readers -= 1
+                    if self._nb_readers == 0:
+                        self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._nb_waiting_writers += 1
+            while self._writing or self._nb_readers > 0:
+                self._condition.wait()
+            self._nb_waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
 
 
 class MultiModalVectorstore:
@@ -25,47 +131,542 @@ class MultiModalVectorstore:
     and retrieval functionalities.
     """
 
-    def __init__(self):
-        """Initialize the vector store and related configurations."""
+    def __init__(
+        self,
+        embedding_function: Embeddings | None = None,
+        vectorstore_path: str = VECTORSTORE_PATH,
+    ):
+        """Initialize the vector store and related configurations.
+
+        Args:
+            embedding_function (Embeddings | None): Embedding model to use. Defaults to
+                the OpenAI embedding model behind the persistent embedding cache.
+            vectorstore_path (str): Directory of the persistent Chroma collection.
+        """
         self._documents_path = DOCUMENTS_PATH
-        self._vectorstore_path = VECTORSTORE_PATH
+        self._vectorstore_path = vectorstore_path
 
         # Initialize the embedding function and vectorstore
-        self._embedding_function = OpenAIEmbeddings(
+        self._embedding_function = embedding_function or CachedEmbeddings(
+            OpenAIEmbeddings(
+                model=EMBEDDING_MODEL_NAME,
+                dimensions=EMBEDDING_DIMENSION,
+            ),
+            EmbeddingCache(),
             model=EMBEDDING_MODEL_NAME,
-            dimensions=EMBEDDING_DIMENSION,
+            dimension=EMBEDDING_DIMENSION,
         )
-        self._vectorstore = Chroma(
-            collection_name="Oxfam-collection",
-            persist_directory=self._vectorstore_path,
+        # Guards (re)opening the collection and serializes writes between sessions
+        self._lock = threading.RLock()
+        # Taken by the queries of the Chroma client, which is only swapped (and
+        # the previous one closed) once they are done
+        self._client_lock = _ReadWriteLock()
+        self._client = None
+        self._vectorstore = None
+        self._manifest = None
+        self._sparse_index = None
+        self._closed = False
+        self._search_executor = ThreadPoolExecutor(thread_name_prefix="retrieval")
+        self._change_listeners: List[Callable[[Iterable[str]], None]] = []
+        self._open()
+
+    def _open(self, rebuild_sparse_index: bool = False) -> None:
+        """Open the persistent Chroma collection and its retriever.
+
+        Args:
+            rebuild_sparse_index (bool): Rebuild the BM25 index from the stored
+                chunks even if its file looks in sync.
+        """
+        with self._lock:
+            self._client, self._vectorstore = self._connect()
+            self._manifest, self._sparse_index = self._open_indexes(
+                self._client, self._vectorstore, rebuild_sparse_index
+            )
+
+    def _connect(self) -> Tuple[chromadb.ClientAPI, Chroma]:
+        client = chromadb.PersistentClient(path=self._vectorstore_path)
+        vectorstore = Chroma(
+            client=client,
+            collection_name=COLLECTION_NAME,
             embedding_function=self._embedding_function,
         )
-        self._retriever = self._vectorstore.as_retriever(k=3)
+        return client, vectorstore
+
+    def _open_indexes(
+        self,
+        client: chromadb.ClientAPI,
+        vectorstore: Chroma,
+        force_sparse_index_rebuild: bool = False,
+    ) -> Tuple[IngestionManifest, BM25Index]:
+        """Load the ingestion manifest and the BM25 index, rebuilding them from
+        the stored chunks (in a single query) when missing or out of sync."""
+        manifest = IngestionManifest(Path(self._vectorstore_path) / MANIFEST_FILENAME)
+        sparse_index = BM25Index(Path(self._vectorstore_path) / SPARSE_INDEX_FILENAME)
+        collection = client.get_collection(COLLECTION_NAME)
+        nb_stored_chunks = collection.count()
+        nb_chunks_with_metadata = len(
+            collection.get(where={"report_year": {"$gte": 0}}, include=[])["ids"]
+        )
+        if nb_chunks_with_metadata != nb_stored_chunks:
+            self._backfill_metadata(client)
+
+        rebuild_manifest = manifest.get_nb_chunks() != nb_stored_chunks
+        rebuild_sparse_index = (
+            force_sparse_index_rebuild or len(sparse_index) != nb_stored_chunks
+        )
+        if not (rebuild_manifest or rebuild_sparse_index):
+            return manifest, sparse_index
+
+        stored = vectorstore.get(include=["metadatas", "documents"])
+        if rebuild_sparse_index:
+            print("---REBUILD SPARSE INDEX---")
+            sparse_index.rebuild(zip(stored["ids"], stored["documents"]))
+            sparse_index.save()
+        if rebuild_manifest:
+            print("---REBUILD INGESTION MANIFEST---")
+            pages = {}
+            for vector_id, metadata in zip(stored["ids"], stored["metadatas"]):
+                page = (
+                    metadata["filename"],
+                    self._get_page_number(vector_id, metadata),
+                )
+                nb_chunks = pages.get(page, (None, 0))[1]
+                pages[page] = (metadata.get("page_hash"), nb_chunks + 1)
+            manifest.rebuild(
+                (pdf_filename, page_number, page_hash, nb_chunks)
+                for (pdf_filename, page_number), (page_hash, nb_chunks) in pages.items()
+            )
+        return manifest, sparse_index
+
+    def _backfill_metadata(self, client: chromadb.ClientAPI) -> None:
+        """Add the company and report year to chunks stored without them."""
+        print("---BACKFILL PAGE METADATA---")
+        collection = client.get_collection(COLLECTION_NAME)
+        stored = collection.get(include=["metadatas"])
+        ids, metadatas = [], []
+        for document_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            if "report_year" not in metadata:
+                ids.append(document_id)
+                metadatas.append(
+                    {
+                        **metadata,
+                        **extract_file_metadata(metadata["filename"]),
+                        "page_number": self._get_page_number(document_id, metadata),
+                        "element_types": metadata.get("element_types", ""),
+                    }
+                )
+        collection.update(ids=ids, metadatas=metadatas)
+
+    def close(self) -> None:
+        """Release the Chroma client, once the queries in flight are done. The
+        store cannot be queried until reloaded."""
+        with self._lock, self._client_lock.write():
+            if self._closed:
+                return
+            self._sparse_index.save()
+            self._client.close()
+            self._closed = True
+
+    def reload(self) -> None:
+        """Reopen the collection, e.g. after it was modified on disk."""
+        with self._lock:
+            self._swap(rebuild_sparse_index=False)
+
+    def _swap(self, rebuild_sparse_index: bool) -> None:
+        """Replace the client, the manifest and the BM25 index together.
+
+        The new manifest and index are built while the current ones still serve
+        the queries. Then, once the queries in flight are done, the previous
+        client is closed (so that Chroma reads the collection from disk again)
+        and every reference is swapped at once. Must hold `_lock`.
+        """
+        if self._closed:
+            self._client, self._vectorstore = self._connect()
+            self._closed = False
+        manifest, sparse_index = self._open_indexes(
+            self._client, self._vectorstore, rebuild_sparse_index
+        )
+        with self._client_lock.write():
+            # The previous BM25 index is discarded without saving it: the new
+            # one holds every stored chunk and owns the file
+            self._client.close()
+            client, vectorstore = self._connect()
+            (
+                self._client,
+                self._vectorstore,
+                self._manifest,
+                self._sparse_index,
+            ) = (client, vectorstore, manifest, sparse_index)
+
+    def reload_if_modified(self) -> bool:
+        """Reload the collection if another process changed it.
+
+        Every write rewrites the ingestion manifest, so a manifest modified on
+        disk by another process (the ingestion page, another server worker)
+        means that the in-memory manifest and BM25 index are stale. The BM25
+        index is rebuilt from the stored chunks, since the other process only
+        saves it from time to time, and the change listeners (e.g. the answer
+        cache) are notified of the files whose pages changed.
+
+        Returns:
+            bool: Whether the collection was reloaded.
+        """
+        with self._lock:
+            if self._closed or not self._manifest.is_modified_on_disk():
+                return False
+            print("---VECTORSTORE MODIFIED BY ANOTHER PROCESS, RELOAD---")
+            old_pages = self._get_stored_page_hashes()
+            self._swap(rebuild_sparse_index=True)
+            new_pages = self._get_stored_page_hashes()
+        self._notify_change(
+            pdf_filename
+            for pdf_filename in old_pages.keys() | new_pages.keys()
+            if old_pages.get(pdf_filename) != new_pages.get(pdf_filename)
+        )
+        return True
+
+    def _get_stored_page_hashes(self) -> dict[str, dict[int, str | None]]:
+        return {
+            pdf_filename: self._manifest.get_page_hashes(pdf_filename)
+            for pdf_filename in self._manifest.get_stored_pages()
+        }
+
+    @property
+    def embedding_function(self) -> Embeddings:
+        return self._embedding_function
+
+    @property
+    def manifest(self) -> IngestionManifest:
+        """The ingestion status and content hashes of the stored files."""
+        return self._manifest
+
+    def add_change_listener(self, listener: Callable[[Iterable[str]], None]) -> None:
+        """Register a callback called with the filenames added or deleted.
+
+        Args:
+            listener (Callable[[Iterable[str]], None]): The callback, e.g. to
+                invalidate a cache.
+        """
+        self._change_listeners.append(listener)
+
+    def _notify_change(self, filenames: Iterable[str]) -> None:
+        filenames = set(filenames)
+        for listener in self._change_listeners:
+            listener(filenames)
+
+    def get_query_filter(self, query: str) -> dict | None:
+        """Chroma `where` clause restricting the search to the companies and
+        report years named in the query, among the stored reports.
+
+        Args:
+            query (str): The search query.
+
+        Returns:
+            dict | None: The `where` clause, None if the query names none.
+        """
+        files_metadata = [
+            extract_file_metadata(pdf_filename)
+            for pdf_filename in self._manifest.get_stored_pages()
+        ]
+        return extract_query_filter(
+            query,
+            companies=[metadata["company"] for metadata in files_metadata],
+            report_years=[metadata["report_year"] for metadata in files_metadata],
+        )
 
-    def retrieve_documents(self, query: str) -> List[Document]:
+    def retrieve_documents(
+        self,
+        query: str,
+        k: int = RETRIEVAL_K,
+        where: dict | None = None,
+        expand: bool = True,
+    ) -> List[Document]:
         """Retrieve documents based on a query.
 
         Args:
             query (str): The search query.
+            k (int): Number of chunks to retrieve.
+            where (dict | None): Metadata filter, extracted from the query if None.
+            expand (bool): Expand the chunks to pages, else return the chunks.
+
+        Returns:
+            List[Document]: Retrieved documents.
+        """
+        return self.retrieve_documents_with_timings(query, k, where, expand)[0]
+
+    async def aretrieve_documents(
+        self,
+        query: str,
+        k: int = RETRIEVAL_K,
+        where: dict | None = None,
+        expand: bool = True,
+    ) -> List[Document]:
+        """Retrieve documents based on a query without blocking the event loop.
+
+        Chroma has no async client, so the retrieval runs in a worker thread.
+
+        Args:
+            query (str): The search query.
+            k (int): Number of chunks to retrieve.
+            where (dict | None): Metadata filter, extracted from the query if None.
+            expand (bool): Expand the chunks to pages, else return the chunks.
 
         Returns:
             List[Document]: Retrieved documents.
         """
-        return self._retriever.invoke(query)
+        return await asyncio.to_thread(self.retrieve_documents, query, k, where, expand)
+
+    def retrieve_documents_with_timings(
+        self,
+        query: str,
+        k: int = RETRIEVAL_K,
+        where: dict | None = None,
+        expand: bool = True,
+    ) -> Tuple[List[Document], dict[str, float]]:
+        """Retrieve documents based on a query, timing each retrieval stage.
+
+        The search is first narrowed to the chunks matching the metadata filter.
+        In hybrid mode, the dense (Chroma) and sparse (BM25) searches run in
+        parallel and their rankings are combined by reciprocal rank fusion.
+        The best chunks are then expanded to their page or their neighbouring
+        chunks within the context budget (see `expand_chunks`), unless the
+        chunks are wanted as is, e.g. to rerank them first.
+
+        Args:
+            query (str): The search query.
+            k (int): Number of chunks to retrieve.
+            where (dict | None): Metadata filter, extracted from the query if None.
+            expand (bool): Expand the chunks to pages, else return the chunks.
+
+        Returns:
+            Tuple[List[Document], dict[str, float]]: Retrieved documents, one per
+            page (or chunk if not expanded), and the duration of each stage in
+            milliseconds.
+        """
+        with self._client_lock.read():
+            start = time.perf_counter()
+            timings = {}
+
+            if where is None and RETRIEVAL_METADATA_FILTER:
+                where = self.get_query_filter(query)
+                timings["filter"] = (time.perf_counter() - start) * 1000
+                if where is not None:
+                    print(f"---RETRIEVAL FILTER: {where}---")
+
+            def timed(stage: str, search: Callable[[], list]) -> list:
+                stage_start = time.perf_counter()
+                result = search()
+                timings[stage] = (time.perf_counter() - stage_start) * 1000
+                return result
+
+            if RETRIEVAL_MODE == "hybrid":
+                chunks = self._hybrid_search(query, k, where, timed, timings)
+            else:
+                chunks = timed(
+                    "dense",
+                    lambda: self._vectorstore.similarity_search(
+                        query, k=k, filter=where
+                    ),
+                )
+
+            documents = (
+                timed("expansion", lambda: self.expand_chunks(chunks))
+                if expand
+                else chunks
+            )
+            timings["total"] = (time.perf_counter() - start) * 1000
+            for stage, duration in timings.items():
+                metrics.observe(
+                    "retrieval_stage_duration_seconds", duration / 1000, stage=stage
+                )
+            return documents, timings
+
+    def _hybrid_search(
+        self,
+        query: str,
+        k: int,
+        where: dict | None,
+        timed: Callable[[str, Callable[[], list]], list],
+        timings: dict[str, float],
+    ) -> List[Document]:
+        """Fuse the dense and sparse rankings of the chunks matching a query."""
+        fetch_k = max(k, HYBRID_FETCH_K)
+        dense_future = self._search_executor.submit(
+            timed,
+            "dense",
+            lambda: self._vectorstore.similarity_search(query, k=fetch_k, filter=where),
+        )
+        sparse_future = self._search_executor.submit(
+            timed,
+            "sparse",
+            lambda: self._sparse_index.search(
+                query, fetch_k, accept=self._get_document_id_filter(where)
+            ),
+        )
+        dense_documents = dense_future.result()
+        sparse_results = sparse_future.result()
+
+        fusion_start = time.perf_counter()
+        chunks_by_id = {document.id: document for document in dense_documents}
+        rankings = [
+            list(chunks_by_id),
+            [vector_id for vector_id, _ in sparse_results],
+        ]
+        fused_ids = self._reciprocal_rank_fusion(rankings)[:k]
+
+        # Fetch the chunks only found by the sparse search
+        missing_ids = [
+            vector_id for vector_id in fused_ids if vector_id not in chunks_by_id
+        ]
+        if len(missing_ids) > 0:
+            stored = self._vectorstore.get(ids=missing_ids)
+            for vector_id, content, metadata in zip(
+                stored["ids"], stored["documents"], stored["metadatas"]
+            ):
+                chunks_by_id[vector_id] = Document(
+                    page_content=content, metadata=metadata, id=vector_id
+                )
+        chunks = [
+            chunks_by_id[vector_id]
+            for vector_id in fused_ids
+            if vector_id in chunks_by_id
+        ]
+        timings["fusion"] = (time.perf_counter() - fusion_start) * 1000
+        return chunks
+
+    def expand_chunks(self, chunks: List[Document]) -> List[Document]:
+        """Expand retrieved chunks to their page or neighbouring chunks.
+
+        The retrieved chunks are always kept. Then, from the best chunk to the
+        worst, each chunk is widened to its whole page if the context still fits
+        in `RETRIEVAL_CONTEXT_TOKENS`, else to its previous and next chunks if
+        they fit. Chunks of the same page are merged into one document.
+
+        Args:
+            chunks (List[Document]): The retrieved chunks, best first.
+
+        Returns:
+            List[Document]: One document per page, ordered by their best chunk.
+        """
+        with self._client_lock.read():
+            if len(chunks) == 0:
+                return []
+
+            # Content of every chunk of the retrieved pages, by chunk index
+            page_ids = list(
+                dict.fromkeys(chunk.metadata["document_id"] for chunk in chunks)
+            )
+            stored = self._vectorstore.get(where={"document_id": {"$in": page_ids}})
+            page_chunks: dict[str, dict[int, str]] = {}
+            for content, metadata in zip(stored["documents"], stored["metadatas"]):
+                page_chunks.setdefault(metadata["document_id"], {})[
+                    metadata.get("chunk_index", 0)
+                ] = content
+
+            selected: dict[str, set[int]] = {}
+            best_chunks: dict[str, Document] = {}
+            for chunk in chunks:
+                document_id = chunk.metadata["document_id"]
+                chunk_index = chunk.metadata.get("chunk_index", 0)
+                page_chunks.setdefault(document_id, {})[
+                    chunk_index
+                ] = chunk.page_content
+                selected.setdefault(document_id, set()).add(chunk_index)
+                best_chunks.setdefault(document_id, chunk)
+
+            nb_tokens = {}
+
+            def get_nb_tokens(document_id: str, chunk_indices: Iterable[int]) -> int:
+                for chunk_index in chunk_indices:
+                    if (document_id, chunk_index) not in nb_tokens:
+                        nb_tokens[(document_id, chunk_index)] = count_tokens(
+                            page_chunks[document_id][chunk_index]
+                        )
+                return sum(
+                    nb_tokens[(document_id, chunk_index)]
+                    for chunk_index in chunk_indices
+                )
+
+            context_tokens = sum(
+                get_nb_tokens(document_id, chunk_indices)
+                for document_id, chunk_indices in selected.items()
+            )
+            for chunk in chunks:
+                document_id = chunk.metadata["document_id"]
+                chunk_index = chunk.metadata.get("chunk_index", 0)
+                page_chunk_indices = set(page_chunks[document_id])
+                neighbour_indices = page_chunk_indices & {
+                    chunk_index - 1,
+                    chunk_index + 1,
+                }
+                for expansion in (page_chunk_indices, neighbour_indices):
+                    new_indices = expansion - selected[document_id]
+                    expansion_tokens = get_nb_tokens(document_id, new_indices)
+                    if context_tokens + expansion_tokens <= RETRIEVAL_CONTEXT_TOKENS:
+                        selected[document_id] |= new_indices
+                        context_tokens += expansion_tokens
+                        break
+
+            print(
+                f"---RETRIEVED {len(chunks)} CHUNKS FROM {len(selected)} PAGES "
+                f"({context_tokens} TOKENS)---"
+            )
+            documents = []
+            for document_id, chunk_indices in selected.items():
+                metadata = {
+                    key: value
+                    for key, value in best_chunks[document_id].metadata.items()
+                    if key not in ("chunk_index", "element_types")
+                }
+                metadata["chunk_indices"] = sorted(chunk_indices)
+                documents.append(
+                    Document(
+                        page_content="\n".join(
+                            page_chunks[document_id][chunk_index]
+                            for chunk_index in sorted(chunk_indices)
+                        ),
+                        metadata=metadata,
+                        id=document_id,
+                    )
+                )
+            return documents
 
     def get_all_documents_in_vectorstore(self) -> int:
-        return self._vectorstore.get()["documents"]
+        with self._client_lock.read():
+            return self._vectorstore.get()["documents"]
 
     def get_nb_stored_pages_in_vectorstore(
         self, pdf_filename: str, page_number: int
     ) -> int:
-        return len(
-            self._vectorstore.get(
-                where={
-                    "filename": pdf_filename,
-                },
-            )["ids"]
-        )
+        return len(self._manifest.get_stored_pages([pdf_filename])[pdf_filename])
+
+    def get_stored_pages(
+        self, pdf_filenames: List[str] | None = None
+    ) -> dict[str, set[int]]:
+        """Return the stored page numbers of each file, without querying Chroma.
+
+        Args:
+            pdf_filenames (List[str] | None): Files to look up, all stored files if None.
+
+        Returns:
+            dict[str, set[int]]: Stored page numbers by filename.
+        """
+        return self._manifest.get_stored_pages(pdf_filenames)
+
+    def get_ingestion_status(
+        self, pdf_filenames: List[str] | None = None
+    ) -> dict[str, tuple[int, int | None]]:
+        """Return the number of stored pages and of pages of each file, from the
+        manifest, without opening the files or querying Chroma.
+
+        Args:
+            pdf_filenames (List[str] | None): Files to look up, all known files if None.
+
+        Returns:
+            dict[str, tuple[int, int | None]]: By filename, the number of stored
+            pages and the number of pages, None if the file was never ingested.
+        """
+        return self._manifest.get_ingestion_status(pdf_filenames)
 
     def is_document_stored(self, pdf_filename: str, page_number: int) -> bool:
         """Check if a specific PDF page is already stored in the vectorstore.
@@ -77,17 +678,7 @@ class MultiModalVectorstore:
         Returns:
             bool: True if the page is already stored, False otherwise.
         """
-        document_id = self._get_document_id(pdf_filename, page_number)
-        return (
-            len(
-                self._vectorstore.get(
-                    where={
-                        "document_id": document_id,
-                    },
-                )["ids"]
-            )
-            > 0
-        )
+        return self._manifest.is_page_stored(pdf_filename, page_number)
 
     def add_new_pdf_page_to_vectorstore(
         self, pdf_page: BytesIO, pdf_filename: str, page_number: int
@@ -99,65 +690,254 @@ class MultiModalVectorstore:
             pdf_filename (str): The name of the PDF file.
             page_number (int): The page number of the PDF.
         """
-        # Partition the PDF into elements (text, tables, etc.)
-        raw_pdf_elements = partition_pdf(
-            file=pdf_page,
-            extract_images_in_pdf=False,
-            infer_table_structure=True,
-            chunking_strategy="by_title",
-            max_characters=4000,
-            new_after_n_chars=3800,
-            combine_text_under_n_chars=2000,
-        )
+        page_elements = partition_pdf_page(pdf_page.getvalue())
+        page_chunks = self.build_page_chunks(page_elements, pdf_filename, page_number)
+        self.add_pdf_pages_to_vectorstore(page_chunks)
 
-        # Process elements and summarize tables if needed
-        page_elements = [
-            (
-                self._summarize_table_element(element)
-                if "documents.elements.Table" in str(type(element))
-                else str(element)
-            )
-            for element in raw_pdf_elements
-        ]
+    def build_page_chunks(
+        self,
+        page_elements: List[PageElement],
+        pdf_filename: str,
+        page_number: int,
+        page_hash: str | None = None,
+    ) -> List[Document]:
+        """Summarize the tables of a partitioned page and build one Document
+        per chunk, each pointing to its page through its `document_id`.
+
+        Args:
+            page_elements (List[PageElement]): The partitioned page elements.
+            pdf_filename (str): The name of the PDF file.
+            page_number (int): The page number of the PDF.
+            page_hash (str | None): The content hash of the page.
+
+        Returns:
+            List[Document]: The page chunks, ready to be added to the vectorstore.
+        """
+        # An empty page keeps an empty chunk so that it is known as stored
+        if len(page_elements) == 0:
+            page_elements = [("", "")]
 
-        # Create a Document object with metadata
         document_id = self._get_document_id(pdf_filename, page_number)
-        page_document = Document(
-            page_content="\n".join(page_elements),
-            metadata={"document_id": document_id, "filename": pdf_filename},
-        )
+        page_chunks = []
+        for chunk_index, (element_type, element_text) in enumerate(page_elements):
+            # Summarize tables if needed
+            chunk_content = (
+                self._summarize_table_element(element_text)
+                if element_type.startswith("Table")
+                else element_text
+            )
+            chunk = Document(
+                page_content=chunk_content,
+                metadata={
+                    "document_id": document_id,
+                    "filename": pdf_filename,
+                    "page_number": page_number,
+                    **extract_file_metadata(pdf_filename),
+                    "element_types": element_type,
+                    "chunk_index": chunk_index,
+                    "nb_chunks": len(page_elements),
+                },
+                id=self._get_chunk_id(document_id, chunk_index),
+            )
+            if page_hash is not None:
+                chunk.metadata["page_hash"] = page_hash
+            page_chunks.append(chunk)
 
         print(
-            f"Page content for {pdf_filename}, page {page_number}:\n\n{page_document}\n\n"
+            f"Page content for {pdf_filename}, page {page_number}:\n\n"
+            + "\n\n".join(str(chunk) for chunk in page_chunks)
+            + "\n\n"
         )
+        return page_chunks
 
-        # Add the document to the vectorstore
-        self._vectorstore.add_documents(documents=[page_document], ids=[document_id])
+    def copy_stored_page(
+        self,
+        source_filename: str,
+        source_page_number: int,
+        pdf_filename: str,
+        page_number: int,
+    ) -> List[Document] | None:
+        """Build the chunks of a page from an identical page already stored,
+        without partitioning or summarizing it again.
 
-    def delete_file_from_vectorstore(self, pdf_filename: str) -> None:
-        ids_to_delete = self._vectorstore.get(
-            where={
-                "filename": pdf_filename,
-            },
-        )["ids"]
-        if len(ids_to_delete) > 0:
-            return self._vectorstore.delete(
-                ids=ids_to_delete,
+        Args:
+            source_filename (str): The file of the stored page.
+            source_page_number (int): The page number of the stored page.
+            pdf_filename (str): The name of the PDF file of the new page.
+            page_number (int): The page number of the new page.
+
+        Returns:
+            List[Document] | None: The new page chunks, None if the source is gone.
+        """
+        with self._client_lock.read():
+            stored = self._vectorstore.get(
+                where={
+                    "document_id": self._get_document_id(
+                        source_filename, source_page_number
+                    )
+                }
             )
+            if len(stored["ids"]) == 0:
+                return None
+
+            document_id = self._get_document_id(pdf_filename, page_number)
+            page_chunks = []
+            for content, metadata in zip(stored["documents"], stored["metadatas"]):
+                chunk_index = metadata.get("chunk_index", 0)
+                page_chunks.append(
+                    Document(
+                        page_content=content,
+                        metadata={
+                            **metadata,
+                            "document_id": document_id,
+                            "filename": pdf_filename,
+                            "page_number": page_number,
+                            **extract_file_metadata(pdf_filename),
+                            "chunk_index": chunk_index,
+                            "nb_chunks": len(stored["ids"]),
+                        },
+                        id=self._get_chunk_id(document_id, chunk_index),
+                    )
+                )
+            return sorted(page_chunks, key=lambda chunk: chunk.metadata["chunk_index"])
+
+    def add_pdf_pages_to_vectorstore(self, page_chunks: List[Document]) -> None:
+        """Embed and add the chunks of a batch of pages in a single write.
+
+        Chunks previously stored for these pages and not part of the batch, e.g.
+        from an older version of a page, are deleted.
+
+        Args:
+            page_chunks (List[Document]): All the chunks of each page, built by
+                `build_page_chunks` or `copy_stored_page`.
+        """
+        if len(page_chunks) == 0:
+            return
+        chunk_ids = [chunk.id for chunk in page_chunks]
+        pages = {}
+        for chunk in page_chunks:
+            page = (chunk.metadata["filename"], chunk.metadata["page_number"])
+            nb_chunks = pages.get(page, (None, 0))[1]
+            pages[page] = (chunk.metadata.get("page_hash"), nb_chunks + 1)
+        with self._lock:
+            stale_ids = set(
+                self._get_page_chunk_ids(
+                    self._get_document_id(pdf_filename, page_number)
+                    for pdf_filename, page_number in pages
+                )
+            ).difference(chunk_ids)
+            if len(stale_ids) > 0:
+                self._vectorstore.delete(ids=list(stale_ids))
+                self._sparse_index.delete_documents(stale_ids)
+            self._vectorstore.add_documents(documents=page_chunks, ids=chunk_ids)
+            self._sparse_index.add_documents(
+                (chunk.id, chunk.page_content) for chunk in page_chunks
+            )
+            self._manifest.add_pages(
+                (pdf_filename, page_number, page_hash, nb_chunks)
+                for (pdf_filename, page_number), (page_hash, nb_chunks) in pages.items()
+            )
+        self._notify_change(pdf_filename for pdf_filename, _ in pages)
+
+    def delete_file_from_vectorstore(self, pdf_filename: str) -> None:
+        with self._lock:
+            ids_to_delete = self._vectorstore.get(
+                where={
+                    "filename": pdf_filename,
+                },
+            )["ids"]
+            if len(ids_to_delete) > 0:
+                self._vectorstore.delete(
+                    ids=ids_to_delete,
+                )
+                self._sparse_index.delete_documents(ids_to_delete)
+            self._manifest.remove_file(pdf_filename)
+        self._notify_change([pdf_filename])
         return None
 
+    def delete_pages_from_vectorstore(
+        self, pdf_filename: str, page_numbers: Iterable[int]
+    ) -> None:
+        """Delete some pages of a file, e.g. pages removed from a new version.
+
+        Args:
+            pdf_filename (str): The name of the PDF file.
+            page_numbers (Iterable[int]): The pages to delete.
+        """
+        page_numbers = list(page_numbers)
+        if len(page_numbers) == 0:
+            return
+        with self._lock:
+            ids_to_delete = self._get_page_chunk_ids(
+                self._get_document_id(pdf_filename, page_number)
+                for page_number in page_numbers
+            )
+            if len(ids_to_delete) > 0:
+                self._vectorstore.delete(ids=ids_to_delete)
+                self._sparse_index.delete_documents(ids_to_delete)
+            self._manifest.remove_pages(pdf_filename, page_numbers)
+        self._notify_change([pdf_filename])
+
+    def _get_page_chunk_ids(self, document_ids: Iterable[str]) -> List[str]:
+        """IDs of the stored chunks of the given pages."""
+        document_ids = list(document_ids)
+        if len(document_ids) == 0:
+            return []
+        return self._vectorstore.get(
+            where={"document_id": {"$in": document_ids}}, include=[]
+        )["ids"]
+
+    def _get_document_id_filter(
+        self, where: dict | None
+    ) -> Callable[[str], bool] | None:
+        """Turn a file-level `where` clause into a predicate on chunk IDs."""
+        if where is None:
+            return None
+        accepted_filenames = {
+            pdf_filename
+            for pdf_filename in self._manifest.get_stored_pages()
+            if matches_filter(extract_file_metadata(pdf_filename), where)
+        }
+        return lambda vector_id: vector_id.split("::", 1)[0] in accepted_filenames
+
     @staticmethod
-    def _summarize_table_element(table_element: Element) -> str:
+    def _reciprocal_rank_fusion(rankings: List[List[str]]) -> List[str]:
+        """Combine rankings of document IDs, best first.
+
+        Args:
+            rankings (List[List[str]]): Document IDs of each ranking, best first.
+
+        Returns:
+            List[str]: Document IDs ordered by fused score.
+        """
+        scores = {}
+        for ranking in rankings:
+            for rank, document_id in enumerate(ranking):
+                scores[document_id] = scores.get(document_id, 0.0) + 1 / (
+                    RRF_K + rank + 1
+                )
+        return sorted(scores, key=scores.get, reverse=True)
+
+    @staticmethod
+    def _summarize_table_element(table_element: str) -> str:
         """Summarize a table element.
 
         Args:
-            table_element (Element): The table element to summarize.
+            table_element (str): The text of the table element to summarize.
 
         Returns:
             str: The summarized content.
         """
         return summarizer.invoke(inputs={"element": table_element})
 
+    @staticmethod
+    def _get_page_number(vector_id: str, metadata: dict) -> int:
+        """Page number of a stored chunk, parsed from its ID for whole pages
+        stored before the page number was part of the metadata."""
+        if "page_number" in metadata:
+            return metadata["page_number"]
+        return int(vector_id.rsplit("::", 1)[1])
+
     @staticmethod
     def _get_document_id(pdf_filename: str, page_number: int) -> str:
         """Generate a unique document ID for a PDF page.
@@ -170,3 +950,65 @@ class MultiModalVectorstore:
             str: A unique document ID.
         """
         return f"{pdf_filename}::{page_number:05}"
+
+    @staticmethod
+    def _get_chunk_id(document_id: str, chunk_index: int) -> str:
+        """Generate the ID of a chunk from the ID of its page.
+
+        Args:
+            document_id (str): The document ID of the page.
+            chunk_index (int): The position of the chunk in the page.
+
+        Returns:
+            str: A unique chunk ID.
+        """
+        return f"{document_id}::{chunk_index:03}"
+
+
+_shared_vectorstore: MultiModalVectorstore | None = None
+_shared_vectorstore_lock = threading.Lock()
+
+
+def get_vectorstore() -> MultiModalVectorstore:
+    """Return the process-wide vectorstore, opening it on first use.
+
+    Returns:
+        MultiModalVectorstore: The shared vectorstore handle.
+    """
+    global _shared_vectorstore
+    if _shared_vectorstore is None:
+        with _shared_vectorstore_lock:
+            if _shared_vectorstore is None:
+                _shared_vectorstore = MultiModalVectorstore()
+    return _shared_vectorstore
+
+
+def set_vectorstore(db: MultiModalVectorstore) -> None:
+    """Use the given vectorstore as the process-wide one, e.g. a vectorstore
+    embedded locally for the offline benchmarks."""
+    global _shared_vectorstore
+    with _shared_vectorstore_lock:
+        _shared_vectorstore = db
+
+
+def close_vectorstore() -> None:
+    """Close the process-wide vectorstore. The next `get_vectorstore` reopens it."""
+    global _shared_vectorstore
+    with _shared_vectorstore_lock:
+        if _shared_vectorstore is not None:
+            _shared_vectorstore.close()
+        _shared_vectorstore = None
+
+
+def reload_vectorstore() -> MultiModalVectorstore:
+    """Reopen the process-wide vectorstore in place.
+
+    Handles already injected into the graph, the frontend or the evaluator stay
+    valid since the same object is reopened.
+
+    Returns:
+        MultiModalVectorstore: The shared vectorstore handle.
+    """
+    db = get_vectorstore()
+    db.reload()
+    return db
@@ -1,5 +1,8 @@
 import streamlit as st
+from backend.answer_cache import get_answer_cache
 from backend.rag_graph.graph import graph
+from backend.rag_graph.streaming import stream_generation
+from backend.vectorstore import get_vectorstore
 
 
 def show():
@@ -30,21 +33,34 @@ def show():
 
         # Generate assistant response
         with st.chat_message("assistant"):
+            response_placeholder = st.empty()
             try:
                 inputs = {
                     "question": prompt,
                     "history": st.session_state.messages,
                     "max_retries": 3,
                 }
-                for event in graph.stream(inputs, stream_mode="values"):
-                    print(event)
+                config = {"configurable": {"vectorstore": get_vectorstore()}}
+                response, loop_step = "", None
+                for mode, chunk in stream_generation(
+                    graph, inputs, config, answer_cache=get_answer_cache()
+                ):
+                    if mode == "custom":
+                        # A new generation attempt replaces the previous one
+                        if chunk["loop_step"] != loop_step:
+                            response, loop_step = "", chunk["loop_step"]
+                        response += chunk["token"]
+                        response_placeholder.markdown(response + "▌")
+                    else:
+                        print(chunk)
+                        event = chunk
                 response = event["generation"]
             except Exception as e:
                 st.error("Une erreur est survenue. Veuillez réessayer plus tard.")
                 response = f"Erreur : {str(e)}"
 
             # Display final response
-            st.markdown(response)
+            response_placeholder.markdown(response)
 
         # Add assistant response to chat history
         st.session_state.messages.append({"role": "assistant", "content": response})
@@ -1,17 +1,16 @@
 from pathlib import Path
 
 import streamlit as st
-from pypdf import PdfReader
 from streamlit_extras.stylable_container import stylable_container
 
-from backend.vectorstore import MultiModalVectorstore
+from backend.vectorstore import get_vectorstore
 from frontend.utils import (
     upload_file,
     get_number_of_processed_pages,
     delete_file_from_database,
 )
 
-db = MultiModalVectorstore()
+db = get_vectorstore()
 
 BOOK_EMOJI_SHORTCODES = [
     ":closed_book:",
@@ -27,8 +26,10 @@ def load_files_and_data():
         st.session_state.file_data = []
         p = Path("./database/documents")
         p.mkdir(parents=True, exist_ok=True)
-        for file_path in p.rglob("*"):
-            nb_processed_pages, nb_pages = get_number_of_processed_pages(db, file_path)
+        file_paths = list(p.rglob("*"))
+        numbers_of_pages = get_number_of_processed_pages(db, file_paths)
+        for file_path in file_paths:
+            nb_processed_pages, nb_pages = numbers_of_pages[file_path.name]
             st.session_state.file_data.append(
                 {
                     "file_path": file_path,
@@ -154,22 +155,26 @@ def show():
             with pdf_filepath.open("wb") as f:
                 f.write(uploaded_file.getbuffer())
             st.session_state.file_uploaded = pdf_filepath
-            st.session_state.file_data.append(
-                {
-                    "file_path": pdf_filepath,
-                    "nb_processed_pages": 0,
-                    "nb_pages": len(PdfReader(pdf_filepath).pages),
-                }
-            )
+            # Reload the table, the new file is counted once
+            del st.session_state.file_data
+            st.rerun()
+        elif pdf_filepath.read_bytes() != uploaded_file.getvalue():
+            # New version of a stored file: only its changed pages are re-indexed
+            with pdf_filepath.open("wb") as f:
+                f.write(uploaded_file.getbuffer())
+            st.session_state.file_reuploaded = pdf_filepath
             st.rerun()
 
     # Trigger file processing if needed
     if "file_uploaded" in st.session_state:
         upload_file(db, st.session_state["file_uploaded"])
         del st.session_state["file_uploaded"]
+        # Reload the table from the manifest updated by the ingestion
+        del st.session_state.file_data
         st.rerun()
 
     if "file_reuploaded" in st.session_state:
         upload_file(db, st.session_state["file_reuploaded"])
         del st.session_state["file_reuploaded"]
+        del st.session_state.file_data
         st.rerun()
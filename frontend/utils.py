@@ -1,66 +1,69 @@
-from io import BytesIO
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Tuple
 
-from pypdf import PdfReader, PdfWriter
+from pypdf import PdfReader
 import streamlit as st
 
+from backend.ingestion import IngestionPipeline, PageResult
 from backend.vectorstore import MultiModalVectorstore
 
 
 def upload_file(db: MultiModalVectorstore, pdf_filepath: Path):
-    pdf_file = PdfReader(pdf_filepath)
-    total_pages = len(pdf_file.pages)
-
+    total_pages = len(PdfReader(pdf_filepath).pages)
     progress_placeholder = st.progress(0, text=f"Processing {pdf_filepath.name}")
-    for i, page in enumerate(pdf_file.pages):
-        if not db.is_document_stored(pdf_filename=pdf_filepath.name, page_number=i):
-            print(f"PROCESSING {pdf_filepath.name}: PAGE #{i+1}")
-            writer = PdfWriter()
-            writer.add_page(page)
-
-            # Write the single page to a BytesIO object
-            pdf_bytes = BytesIO()
-            writer.write(pdf_bytes)
-            pdf_bytes.seek(0)
-
-            # Add to vector store
-            db.add_new_pdf_page_to_vectorstore(
-                pdf_page=pdf_bytes, pdf_filename=pdf_filepath.name, page_number=i
-            )
+    nb_done_pages = 0
+
+    def on_page_done(result: PageResult) -> None:
+        nonlocal nb_done_pages
+        nb_done_pages += 1
         # Update the progress bar
         progress_placeholder.progress(
-            (i + 1) / total_pages, text=f"Processing page #{i+2} of {pdf_filepath.name}"
+            nb_done_pages / total_pages,
+            text=f"Processed page #{result.page_number + 1} of {pdf_filepath.name}",
         )
 
+    report = IngestionPipeline(db).ingest(pdf_filepath, on_page_done=on_page_done)
+    print(
+        f"{pdf_filepath.name}: {report.processed_pages} pages processed "
+        f"in {report.duration:.1f}s ({report.pages_per_second:.2f} pages/s)"
+    )
+
     progress_placeholder.empty()
+    if len(report.failed_pages) > 0:
+        st.toast(
+            f"{len(report.failed_pages)} page(s) of {pdf_filepath.name} could not be "
+            "processed: "
+            + ", ".join(f"#{result.page_number + 1}" for result in report.failed_pages)
+        )
 
 
 def get_number_of_processed_pages(
-    db: MultiModalVectorstore, pdf_filepath: Path
-) -> Tuple:
-    """Returns the number of processed and total pages in a PDF file.
+    db: MultiModalVectorstore, pdf_filepaths: List[Path]
+) -> Dict[str, Tuple[int, int]]:
+    """Returns the number of processed and total pages of PDF files.
+
+    Both are read from the ingestion manifest in a single call. Only the files
+    never ingested (nor counted) before are opened to count their pages, and
+    their count is recorded in the manifest.
 
     Args:
         db: MultiModalVectorstore object
-        pdf_filepath (Path): Path to the PDF file.
+        pdf_filepaths (List[Path]): Paths to the PDF files.
 
     Returns:
-        tuple: (number of processed pages, total number of pages)
+        dict: (number of processed pages, total number of pages) by filename
     """
-    pdf_reader = PdfReader(pdf_filepath)
-    total_pages = len(pdf_reader.pages)
-
-    processed_pages = next(
-        (
-            i
-            for i in range(total_pages)
-            if not db.is_document_stored(pdf_filepath.name, i)
-        ),
-        total_pages,
+    status = db.get_ingestion_status(
+        [pdf_filepath.name for pdf_filepath in pdf_filepaths]
     )
-
-    return processed_pages, total_pages
+    numbers_of_pages = {}
+    for pdf_filepath in pdf_filepaths:
+        processed_pages, total_pages = status[pdf_filepath.name]
+        if total_pages is None:
+            total_pages = len(PdfReader(pdf_filepath).pages)
+            db.manifest.set_page_count(pdf_filepath.name, total_pages)
+        numbers_of_pages[pdf_filepath.name] = (processed_pages, total_pages)
+    return numbers_of_pages
 
 
 def delete_file_from_database(db: MultiModalVectorstore, pdf_filepath: Path) -> None: